@@ -0,0 +1,292 @@
+"""Headless HTTP API for the agents, summarization and YAML repair in app.py.
+
+A plain ASGI application so it runs under any ASGI server:
+
+    uvicorn api:app --port 8000
+
+Endpoints:
+    GET  /health                 liveness, agent registry version and warm-up timings
+    GET  /agents                 agents from agents.yaml
+    POST /agents/{id}/run        {"prompt", "model"?, "max_tokens"?, "stream"?}
+    POST /summarize              {"text", "model"?, "stream"?}
+    POST /repair-yaml            {"yaml", "model"?}
+
+Streaming responses are server-sent events ("delta", "section", "done" and
+"error" events); otherwise a single JSON body is returned. Provider keys come
+from the server environment, and runs land in the same history and usage
+database as the Streamlit UI.
+"""
+
+import asyncio
+import json
+import os
+import re
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import app as core
+
+API_DEFAULT_MODEL = os.getenv("API_DEFAULT_MODEL", "gemini-2.5-flash")
+# Cap per request; overall API spend is bounded by each key's KEY_DAILY_BUDGET_USD.
+API_BUDGET_USD = float(os.getenv("API_BUDGET_USD", str(core.SESSION_BUDGET_USD)))
+API_MAX_BODY_BYTES = 10 * 1024 * 1024
+
+_RUN_PATH_RE = re.compile(r"^/agents/([^/]+)/run$")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+async def read_json(receive) -> Dict[str, Any]:
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Client disconnected")
+        body += message.get("body", b"")
+        if len(body) > API_MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+        if not message.get("more_body"):
+            break
+    if not body:
+        return {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPError(400, "Body is not valid JSON")
+    if not isinstance(data, dict):
+        raise HTTPError(400, "Body must be a JSON object")
+    return data
+
+
+async def send_json(send, status: int, payload: Any) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def send_events(send, receive, events) -> None:
+    """Stream (event, data) pairs as SSE; stop producing as soon as the client goes away."""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        }
+    )
+
+    async def pump():
+        try:
+            async for event, data in events:
+                await send({"type": "http.response.body", "body": sse_event(event, data), "more_body": True})
+        except (HTTPError, core.MissingAPIKeyError) as e:
+            await send({"type": "http.response.body", "body": sse_event("error", {"detail": str(e)}), "more_body": True})
+        except Exception as e:
+            detail = f"{type(e).__name__}: {e}"
+            await send({"type": "http.response.body", "body": sse_event("error", {"detail": detail}), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    producer = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(disconnected())
+    await asyncio.wait({producer, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    for task in (producer, watcher):
+        task.cancel()
+    await asyncio.gather(producer, watcher, return_exceptions=True)
+
+
+def _int_field(body: Dict[str, Any], key: str, default: int) -> int:
+    value = body.get(key, default)
+    if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= core.MAX_TOKENS_LIMIT:
+        raise HTTPError(400, f"'{key}' must be an integer between 1 and {core.MAX_TOKENS_LIMIT}")
+    return value
+
+
+def _str_field(body: Dict[str, Any], key: str, default: Optional[str] = None) -> str:
+    value = body.get(key, default)
+    if not isinstance(value, str) or not value.strip():
+        raise HTTPError(400, f"'{key}' must be a non-empty string")
+    return value
+
+
+def _model_field(body: Dict[str, Any], default: Optional[str]) -> Optional[str]:
+    if body.get("model") is None:
+        return default
+    return _str_field(body, "model")
+
+
+def create_app(stream_fn: Callable[..., Any] = None, repair_fn: Callable[..., Tuple[str, Dict[str, Any]]] = None):
+    """Build the ASGI app; stream_fn/repair_fn default to app.astream_llm/app.repair_agents_yaml.
+
+    Tests pass an async generator with astream_llm's signature as a fake provider.
+    """
+    stream_fn = stream_fn or core.astream_llm
+    repair_fn = repair_fn or core.repair_agents_yaml
+    registry = core.agent_registry()
+    warm_up: Dict[str, Any] = {}
+
+    def run_agent(agent_id: str, body: Dict[str, Any]):
+        """Validate the request now (so errors get their status code), then return the event stream."""
+        agent = registry.get(agent_id)
+        if agent is None:
+            raise HTTPError(404, f"Unknown agent '{agent_id}'")
+        prompt = _str_field(body, "prompt")
+        model = _model_field(body, agent.get("model") or API_DEFAULT_MODEL)
+        max_tokens = _int_field(body, "max_tokens", core.adaptive_max_tokens(agent, 4096)[0])
+        return agent_events(agent_id, agent, prompt, model, max_tokens)
+
+    async def agent_events(agent_id: str, agent: Dict[str, Any], prompt: str, model: str, max_tokens: int):
+        meta: Dict[str, Any] = {}
+        pieces: List[str] = []
+        async for text in stream_fn(
+            prompt=prompt,
+            system_prompt=agent.get("systemPrompt", ""),
+            model=model,
+            max_tokens=max_tokens,
+            meta=meta,
+            tags=agent.get("tags"),
+        ):
+            pieces.append(text)
+            yield "delta", {"text": text}
+        output = "".join(pieces)
+        core.record_run("agent", agent_id, prompt, output, meta)
+        yield "done", {"output": output, "meta": meta}
+
+    def summarize(body: Dict[str, Any]):
+        text = _str_field(body, "text")
+        model = _model_field(body, API_DEFAULT_MODEL)
+        return summary_events(text, model)
+
+    async def summary_events(text: str, model: str):
+        meta: Dict[str, Any] = {}
+        parser = core.SummarySectionParser()
+        pieces: List[str] = []
+        async for chunk in stream_fn(
+            prompt=text,
+            system_prompt=core.STRUCTURED_SUMMARY_SYSTEM_PROMPT,
+            model=model,
+            max_tokens=core.SUMMARY_MAX_TOKENS,
+            meta=meta,
+        ):
+            pieces.append(chunk)
+            for section in parser.feed(chunk):
+                yield "section", section
+        for section in parser.finish():
+            yield "section", section
+        output = core.sections_to_markdown(parser.finished, parser.missing())
+        # Same kind as UI summaries, so they show in its history and similarity search.
+        core.record_run("doc", "api", text, output, meta)
+        yield "done", {"sections": parser.finished, "missing": parser.missing(), "meta": meta}
+
+    async def route(method: str, path: str, body_reader: Callable[[], Awaitable[Dict[str, Any]]]):
+        """Return ("json", status, payload) or ("sse", events, None)."""
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405, "Method not allowed")
+            return "json", 200, {
+                "status": "ok",
+                "agents_version": list(registry.refresh().version or ()),
+                "warm_up": warm_up,
+            }
+        if path == "/agents":
+            if method != "GET":
+                raise HTTPError(405, "Method not allowed")
+            return "json", 200, {"agents": registry.refresh().agents}
+
+        match = _RUN_PATH_RE.match(path)
+        if match or path in ("/summarize", "/repair-yaml"):
+            if method != "POST":
+                raise HTTPError(405, "Method not allowed")
+            body = await body_reader()
+        else:
+            raise HTTPError(404, "Not found")
+
+        if path == "/repair-yaml":
+            text = _str_field(body, "yaml")
+            model = _model_field(body, None)
+            repaired, report = await asyncio.to_thread(repair_fn, text, model)
+            return "json", 200, {"yaml": repaired, "report": report}
+
+        events = run_agent(match.group(1), body) if match else summarize(body)
+        if body.get("stream"):
+            return "sse", events, None
+        result: Dict[str, Any] = {}
+        async for event, data in events:
+            if event == "done":
+                result = data
+        return "json", 200, result
+
+    async def http(scope, receive, send):
+        keys = core.env_api_keys()
+        # One budget session per request: client addresses are shared behind a
+        # proxy, and a per-client session would never reset.
+        context = {
+            "session_id": f"api:{uuid.uuid4().hex}",
+            "budget": {"session_usd": API_BUDGET_USD, "action": "block"},
+        }
+        match = _RUN_PATH_RE.match(scope["path"])
+        if match:
+            context["agent"] = match.group(1)
+        with core.api_key_scope(keys), core.usage_scope(**context):
+            try:
+                kind, first, payload = await route(scope["method"], scope["path"], lambda: read_json(receive))
+            except HTTPError as e:
+                await send_json(send, e.status, {"detail": e.detail})
+                return
+            except core.BudgetExceededError as e:
+                await send_json(send, 402, {"detail": str(e)})
+                return
+            except core.MissingAPIKeyError as e:
+                await send_json(send, 503, {"detail": str(e)})
+                return
+            except core.UnknownProviderError as e:
+                await send_json(send, 400, {"detail": str(e)})
+                return
+            except Exception as e:
+                await send_json(send, 502, {"detail": f"{type(e).__name__}: {e}"})
+                return
+            if kind == "sse":
+                await send_events(send, receive, first)
+            else:
+                await send_json(send, first, payload)
+
+    async def lifespan(scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if core.WARMUP_ON_START:
+                    warm_up.update(await core.awarm_up())
+                else:
+                    registry.refresh()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def asgi(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(scope, receive, send)
+        elif scope["type"] == "http":
+            await http(scope, receive, send)
+
+    return asgi
+
+
+app = create_app()
@@ -1,14 +1,41 @@
+import asyncio
+import bisect
+import contextvars
+import cProfile
+import csv
+import fnmatch
+import functools
+import hashlib
+import html
+import io
+import itertools
+import json
+import marshal
 import os
+import queue
+import re
+import sqlite3
+import sys
 import textwrap
-from typing import Any, Dict, List, Optional
-
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
 import streamlit as st
 import yaml
 import altair as alt
 
 # External LLM clients
 import google.generativeai as genai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import anthropic
 
 # =========================
@@ -197,6 +224,222 @@ MODEL_OPTIONS = [
     "grok-3-mini",
 ]
 
+# Providers: the built-ins below plus entries from PROVIDERS_FILE (see README).
+# "api" is the wire protocol; "openai" covers any OpenAI-compatible server (xAI,
+# vLLM, llama.cpp, Ollama, ...). Patterns are case-insensitive globs matched
+# against model names; configured providers are tried before the built-ins.
+PROVIDERS_FILE = os.getenv("PROVIDERS_FILE", "providers.yaml")
+PROVIDER_APIS = ["openai", "anthropic", "gemini"]
+BUILTIN_PROVIDERS: List[Dict[str, Any]] = [
+    {"name": "gemini", "api": "gemini", "patterns": ["gemini*"], "key_env": "GEMINI_API_KEY"},
+    {"name": "openai", "api": "openai", "patterns": ["gpt*", "*gpt-*", "*o1*"], "key_env": "OPENAI_API_KEY"},
+    {
+        "name": "grok",
+        "api": "openai",
+        "patterns": ["*grok*"],
+        "key_env": "GROK_API_KEY",
+        "base_url": "https://api.x.ai/v1",
+    },
+    {"name": "anthropic", "api": "anthropic", "patterns": ["*claude*", "*anthropic*"], "key_env": "ANTHROPIC_API_KEY"},
+]
+# Sent as the key to providers configured without key_env (local servers ignore it).
+NO_KEY_REQUIRED = "not-needed"
+
+# Pseudo-model: pick a concrete model per request (see route_models).
+AUTO_MODEL = "auto"
+
+# USD per 1M tokens: (input, output). Used for routing and cost estimates.
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-3-pro-preview": (2.00, 12.00),
+    "claude-3-5-sonnet-20241022": (3.00, 15.00),
+    "claude-3-opus-20240229": (15.00, 75.00),
+    "grok-4-fast-reasoning": (0.20, 0.50),
+    "grok-3-mini": (0.30, 0.50),
+}
+
+# Optional YAML overrides for MODEL_PRICES: {model: {input: x, output: y}}.
+MODEL_PRICES_FILE = os.getenv("MODEL_PRICES_FILE", "model_prices.yaml")
+# Price (USD per 1M input/output tokens) charged to budgets for models without
+# a known price, unless their provider needs no key (a local server: free).
+UNPRICED_MODEL_PRICE = (
+    float(os.getenv("UNPRICED_INPUT_USD", "15")),
+    float(os.getenv("UNPRICED_OUTPUT_USD", "75")),
+)
+
+# Spend limits (USD) checked before each call. "block" refuses the call,
+# "downgrade" switches to the cheapest model that still fits.
+SESSION_BUDGET_USD = float(os.getenv("SESSION_BUDGET_USD", "5"))
+KEY_DAILY_BUDGET_USD = float(os.getenv("KEY_DAILY_BUDGET_USD", "50"))
+BUDGET_ACTIONS = ["downgrade", "block"]
+# Each call reserves its worst-case cost until it settles; reservations left by
+# a process that died mid-call stop counting after this long.
+BUDGET_RESERVATION_TTL_S = 900
+
+# Capability tier (1 = light, 3 = strongest) and context window in tokens.
+MODEL_PROFILES: Dict[str, Dict[str, int]] = {
+    "gpt-4o-mini": {"tier": 1, "context": 128000},
+    "gpt-4.1-mini": {"tier": 2, "context": 1000000},
+    "gemini-2.5-flash": {"tier": 2, "context": 1000000},
+    "gemini-2.5-flash-lite": {"tier": 1, "context": 1000000},
+    "gemini-3-pro-preview": {"tier": 3, "context": 1000000},
+    "claude-3-5-sonnet-20241022": {"tier": 3, "context": 200000},
+    "claude-3-opus-20240229": {"tier": 3, "context": 200000},
+    "grok-4-fast-reasoning": {"tier": 2, "context": 2000000},
+    "grok-3-mini": {"tier": 1, "context": 131072},
+}
+
+# Agent tags that require at least this tier when routing automatically.
+ROUTER_TAG_MIN_TIER = {
+    "coding": 2,
+    "engineering": 2,
+    "debugging": 2,
+    "analysis": 2,
+    "yaml": 2,
+    "reasoning": 3,
+}
+
+# Prompt size (estimated tokens) above which a stronger tier is required.
+ROUTER_PROMPT_TIERS = [(2000, 1), (12000, 2), (None, 3)]
+
+ROUTER_POLICIES = {
+    "cheapest": "Cheapest model meeting p95 latency",
+    "fastest": "Fastest model under cost budget",
+}
+ROUTER_DEFAULT_POLICY = {"policy": "cheapest", "max_p95_s": 8.0, "max_cost_usd": 0.05}
+
+# Recent calls kept per model, and the error rate at which a model counts as down.
+TELEMETRY_WINDOW = 200
+ROUTER_MAX_ERROR_RATE = 0.5
+ROUTER_MAX_ATTEMPTS = 3
+
+# Hedging: launch a backup request once the primary has produced no token by the
+# HEDGE_PERCENTILE of its recent time-to-first-token (or the default delay until
+# enough samples exist). Budget is estimated extra USD per agent per day.
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 5
+HEDGE_DEFAULT_DELAY_S = 3.0
+HEDGE_MIN_DELAY_S = 0.25
+HEDGE_BUDGET_USD = 0.25
+
+# Multi-turn conversations: history is compacted into a running summary once the
+# prompt passes CONVERSATION_COMPACT_AT of its token budget, keeping the last
+# CONVERSATION_KEEP_MESSAGES messages verbatim.
+CONVERSATION_MAX_PROMPT_TOKENS = 16000
+CONVERSATION_COMPACT_AT = 0.75
+CONVERSATION_KEEP_MESSAGES = 6
+CONVERSATION_SUMMARY_TOKENS = 800
+
+# Agent runs size max_tokens from the agent's maxTokens and the p99 of its last
+# ADAPTIVE_TOKENS_WINDOW outputs plus ADAPTIVE_TOKENS_MARGIN, once it has
+# ADAPTIVE_TOKENS_MIN_RUNS of them. Answers cut off at the limit are continued
+# up to AUTO_CONTINUE_MAX times.
+ADAPTIVE_TOKENS_WINDOW = 200
+ADAPTIVE_TOKENS_MIN_RUNS = 10
+ADAPTIVE_TOKENS_MARGIN = 0.25
+ADAPTIVE_TOKENS_FLOOR = 256
+AUTO_CONTINUE_MAX = int(os.getenv("AUTO_CONTINUE_MAX", "3"))
+CONTINUE_PROMPT = (
+    "Your previous answer was cut off by the length limit. Continue exactly where it stopped, "
+    "without repeating anything and without any preamble."
+)
+
+# Local store of past Agent Studio / Document Intelligence runs.
+RUN_HISTORY_DB = os.getenv("RUN_HISTORY_DB", "run_history.sqlite3")
+RUN_HISTORY_PAGE_SIZE = 20
+
+# Local similarity index over past Document Intelligence runs (see
+# SimilarityIndex): hashed word and word-pair vectors, one memory-mapped file
+# per month in SIMILARITY_DIR. A new document at least SIMILARITY_REUSE_MIN
+# similar to one already summarized can reuse that summary without a model call.
+SIMILARITY_DIR = os.getenv("SIMILARITY_DIR", "similarity_index")
+SIMILARITY_DIM = int(os.getenv("SIMILARITY_DIM", "512"))
+SIMILARITY_REUSE_MIN = float(os.getenv("SIMILARITY_REUSE_MIN", "0.95"))
+SIMILARITY_MAX_CHARS = 200_000
+
+# Concurrent extract+summarize jobs for multi-file Document Intelligence batches.
+DOC_BATCH_WORKERS = int(os.getenv("DOC_BATCH_WORKERS", "4"))
+
+# State shared by every server process on this host: "sqlite" (WAL file) or
+# "memory" (single process only).
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "sqlite")
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB", "shared_state.sqlite3")
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", str(24 * 3600)))
+EXTRACTION_CACHE_TTL_S = float(os.getenv("EXTRACTION_CACHE_TTL_S", str(7 * 24 * 3600)))
+# Telemetry is re-read from the shared store at most this often per process.
+TELEMETRY_REFRESH_S = 1.0
+
+# PDF boilerplate stripping: a line among the first/last few of a page that recurs
+# on at least this share of pages is treated as a header/footer.
+BOILERPLATE_EDGE_LINES = 3
+BOILERPLATE_MIN_SHARE = 0.5
+# Pages with fewer non-space characters than this after cleaning are dropped.
+PAGE_MIN_CHARS = 20
+
+# Provider cassettes: "record" saves every provider call (with stream chunk
+# timings) to LLM_CASSETTE_DIR, "replay" serves them offline, "auto" replays
+# when a cassette exists and records otherwise. LLM_CASSETTE_SPEED scales the
+# replayed timing (2 = twice as fast, 0 = no delays).
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off")
+LLM_CASSETTE_DIR = os.getenv("LLM_CASSETTE_DIR", "cassettes")
+LLM_CASSETTE_SPEED = float(os.getenv("LLM_CASSETTE_SPEED", "1"))
+
+# Per-provider circuit breakers, fed by live provider calls. A breaker opens when
+# at least BREAKER_MIN_CALLS calls in the last BREAKER_WINDOW_S failed at
+# BREAKER_ERROR_RATE or more (calls slower than BREAKER_SLOW_CALL_S count as
+# failures), rejects calls for a cooldown that doubles on each failed trial,
+# then lets a single trial call through.
+BREAKER_WINDOW_S = 120.0
+BREAKER_MIN_CALLS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_SLOW_CALL_S = 60.0
+BREAKER_COOLDOWN_S = 15.0
+BREAKER_MAX_COOLDOWN_S = 300.0
+HEALTH_DEGRADED_ERROR_RATE = 0.2
+# Seconds between background probes of providers with server-side keys; 0 disables.
+HEALTH_PROBE_INTERVAL_S = float(os.getenv("HEALTH_PROBE_INTERVAL_S", "0"))
+
+# Provider calls in this process are admitted by a scheduler: at most
+# SCHEDULER_MAX_CONCURRENCY at once, SCHEDULER_SESSION_CONCURRENCY per session,
+# and SCHEDULER_INTERACTIVE_RESERVE slots only interactive work may use.
+SCHEDULER_PRIORITIES = ["interactive", "batch", "background"]
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "16"))
+SCHEDULER_SESSION_CONCURRENCY = int(os.getenv("SCHEDULER_SESSION_CONCURRENCY", "4"))
+SCHEDULER_INTERACTIVE_RESERVE = int(os.getenv("SCHEDULER_INTERACTIVE_RESERVE", "4"))
+SCHEDULER_METRICS_WINDOW = 500
+
+# Server warm-up: preload registries, theme CSS and provider connections once per
+# process (on the first script run, or at API startup) instead of in a user's first
+# request. Connections are opened for providers with server-side keys only.
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") not in ("", "0")
+
+# Opt-in rerun profiling; the debug panel appears with ?debug=1 or APP_DEBUG=1.
+APP_DEBUG = os.getenv("APP_DEBUG", "") not in ("", "0")
+PROFILE_MODES = ["off", "timing", "cprofile", "sampling"]
+PROFILE_HISTORY = 50
+# Sessions whose reruns are kept (least recently active dropped first).
+PROFILE_SESSIONS = 200
+PROFILE_SAMPLE_INTERVAL_S = 0.005
+
+# Sections of a structured document summary, with heading keywords that identify them.
+SUMMARY_SECTIONS: Dict[str, Tuple[str, ...]] = {
+    "Overview": ("overview", "executivesummary", "summary"),
+    "Key points": ("keypoint", "keyinsight", "keyfinding", "highlights"),
+    "Risks or caveats": ("risk", "caveat", "unknown", "limitation"),
+    "Suggested next steps": ("nextstep", "suggested", "recommend", "actionitem"),
+}
+
+AGENTS_YAML_PATH = os.getenv("AGENTS_YAML_PATH", "agents.yaml")
+
+# Prefer the libyaml-backed loader; fall back to the pure-Python one.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Upper bound for any max_tokens value (matches the Agent Studio input).
+MAX_TOKENS_LIMIT = 32768
+
 # Metrics / charts (mock)
 MOCK_METRICS = {
     "total_runs": 1289,
@@ -241,6 +484,9 @@ LABELS = {
         "grok_key": "Grok API Key",
         "status_operational": "Operational",
         "status_missing": "Key Missing",
+        "status_degraded": "Degraded",
+        "status_down": "Down",
+        "status_unknown": "No recent calls",
         "dashboard_title": "Control Center",
         "dashboard_subtitle": "Real-time overview of your artistic AI workspace.",
         "total_runs": "Total Runs",
@@ -300,6 +546,9 @@ LABELS = {
         "grok_key": "Grok API 金鑰",
         "status_operational": "運作中",
         "status_missing": "尚未設定金鑰",
+        "status_degraded": "效能下降",
+        "status_down": "服務中斷",
+        "status_unknown": "近期無呼叫",
         "dashboard_title": "控制中心",
         "dashboard_subtitle": "即時掌握你的藝術 AI 工作室狀態。",
         "total_runs": "總執行次數",
@@ -492,15 +741,37 @@ def init_session_state():
     ss.setdefault("theme", "dark")
     ss.setdefault("painter_style", "van_gogh")
     ss.setdefault("view", "dashboard")
-    ss.setdefault("agents", load_agents())
-    ss.setdefault("yaml_text", dump_agents_yaml(ss["agents"]))
-    ss.setdefault("skill_md", load_skill_md())
+    if "agents" not in ss:
+        registry = agent_registry().refresh()
+        ss["agents"] = registry.agents
+        ss["agents_version"] = registry.version
+        ss.setdefault("yaml_text", registry.text)
+    # Guarded rather than setdefault: the defaults are costly to build and this runs every rerun.
+    if "yaml_text" not in ss:
+        ss["yaml_text"] = dump_agents_yaml(ss["agents"])
+    ss.setdefault("agents_yaml_loaded", ss["yaml_text"])
+    if "skill_md" not in ss:
+        ss["skill_md"] = load_skill_md()
     ss.setdefault("agent_prompt", "")
     ss.setdefault("agent_output", "")
-    ss.setdefault("agent_model", "gemini-2.5-flash")
+    # "" runs each agent on its own model; a pick or an override replaces it.
+    ss.setdefault("agent_model", "")
     ss.setdefault("agent_override_model", "")
     ss.setdefault("agent_max_tokens", 12000)
+    ss.setdefault("agent_adaptive_tokens", True)
+    ss.setdefault("agent_auto_continue", True)
     ss.setdefault("agent_view_mode", "Text")
+    ss.setdefault("router_policy", dict(ROUTER_DEFAULT_POLICY))
+    ss.setdefault("agent_route_info", {})
+    ss.setdefault("agent_hedge", False)
+    ss.setdefault("agent_backup_model", "")
+    ss.setdefault("agent_conversation_mode", False)
+    ss.setdefault("conversations", {})
+    ss.setdefault("session_id", uuid.uuid4().hex)
+    ss.setdefault("budget", {"session_usd": SESSION_BUDGET_USD, "action": BUDGET_ACTIONS[0]})
+    ss.setdefault("doc_structured", True)
+    ss.setdefault("doc_reuse_similar", True)
+    ss.setdefault("profile_mode", "off")
     # API keys (user-supplied)
     ss.setdefault("gemini_key_user", "")
     ss.setdefault("openai_key_user", "")
@@ -508,42 +779,119 @@ def init_session_state():
     ss.setdefault("grok_key_user", "")
 
 
-def load_agents() -> List[Dict[str, Any]]:
-    path = "agents.yaml"
+def load_agents(path: str = AGENTS_YAML_PATH) -> List[Dict[str, Any]]:
     if os.path.exists(path):
         try:
             with open(path, "r", encoding="utf-8") as f:
-                data = yaml.safe_load(f) or {}
-            if isinstance(data, dict) and isinstance(data.get("agents"), list):
-                return data["agents"]
-            if isinstance(data, list):
-                return data
+                agents, issues = validate_agents_yaml(f.read())
+            if agents is not None and not has_errors(issues):
+                return agents
         except Exception:
             pass
     return DEFAULT_AGENTS
 
 
+class AgentRegistry:
+    """agents.yaml loaded once and reloaded only when the file changes on disk.
+
+    The parsed agents are published to shared state, so after an edit only the
+    first process to notice validates the file and the others reuse its result.
+    text is the file as written (comments and all) when it is in the canonical
+    'agents:' layout, otherwise a fresh dump; sessions start their editor from it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.version: Optional[Tuple[int, int]] = None
+        self.agents: List[Dict[str, Any]] = []
+        self.text = ""
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self) -> "AgentRegistry":
+        try:
+            st_ = os.stat(self.path)
+            version = (st_.st_mtime_ns, st_.st_size)
+        except OSError:
+            version = (0, 0)
+        with self._lock:
+            if version != self.version:
+                state = shared_state()
+                published = state.get("agent_registry", self.path)
+                if published and tuple(published["version"]) == version:
+                    self.agents = published["agents"]
+                else:
+                    self.agents = load_agents(self.path)
+                    state.set("agent_registry", self.path, {"version": list(version), "agents": self.agents})
+                self.by_id = {a["id"]: a for a in self.agents if isinstance(a, dict) and "id" in a}
+                self.text = self._editor_text()
+                self.version = version
+        return self
+
+    def _editor_text(self) -> str:
+        if self.agents != DEFAULT_AGENTS:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    raw = f.read()
+                if _split_agent_chunks(raw) is not None:
+                    return raw
+            except OSError:
+                pass
+        return dump_agents_yaml(self.agents)
+
+    def get(self, agent_id: str) -> Optional[Dict[str, Any]]:
+        return self.refresh().by_id.get(agent_id)
+
+
+@st.cache_resource
+def agent_registry() -> AgentRegistry:
+    return AgentRegistry(AGENTS_YAML_PATH)
+
+
+def sync_session_agents() -> None:
+    """Pick up agents.yaml changes (from any process) unless this session has edited its YAML."""
+    ss = st.session_state
+    registry = agent_registry().refresh()
+    if ss.get("agents_version") == registry.version:
+        return
+    if ss["yaml_text"] == ss["agents_yaml_loaded"]:
+        ss["agents"] = registry.agents
+        ss["yaml_text"] = ss["agents_yaml_loaded"] = registry.text
+    ss["agents_version"] = registry.version
+
+
 def dump_agents_yaml(agents: List[Dict[str, Any]]) -> str:
     return yaml.safe_dump({"agents": agents}, sort_keys=False, allow_unicode=True)
 
 
-def load_skill_md() -> str:
-    path = "SKILL.md"
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
-        except Exception:
-            pass
-    return DEFAULT_SKILL_MD
+def load_skill_md(path: str = "SKILL.md") -> str:
+    try:
+        st_ = os.stat(path)
+    except OSError:
+        return DEFAULT_SKILL_MD
+    return _read_skill_md(path, st_.st_mtime_ns, st_.st_size)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_skill_md(path: str, mtime_ns: int, size: int) -> str:
+    # Keyed on the file's mtime and size, so an edited SKILL.md is read again.
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except Exception:
+        return DEFAULT_SKILL_MD
 
 
 def apply_wow_theme():
-    lang = st.session_state["language"]
-    labels = LABELS[lang]
-    style_key = st.session_state["painter_style"]
+    labels = LABELS[st.session_state["language"]]
+    st.markdown(theme_css(st.session_state["painter_style"], st.session_state["theme"]), unsafe_allow_html=True)
+    st.markdown(f"### {labels['app_title']}")
+
+
+@functools.lru_cache(maxsize=None)
+def theme_css(style_key: str, theme: str) -> str:
+    """The <style> bundle for a painter style and light/dark theme; built once per pair."""
     style = PAINTER_CSS.get(style_key, PAINTER_CSS["van_gogh"])
-    theme = st.session_state["theme"]
 
     # Slight variation for light/dark
     bg = style["bg"]
@@ -626,105 +974,566 @@ def apply_wow_theme():
     }}
     </style>
     """
-    st.markdown(css, unsafe_allow_html=True)
-    st.markdown(f"### {labels['app_title']}")
+    return css
 
 
 def get_language_labels() -> Dict[str, str]:
     return LABELS[st.session_state["language"]]
 
 
-def get_api_keys() -> Dict[str, str]:
+# Context variables rather than thread-locals so scopes also isolate asyncio tasks.
+_KEY_SCOPE: contextvars.ContextVar = contextvars.ContextVar("api_key_scope", default=None)
+
+
+@contextmanager
+def api_key_scope(keys: Dict[str, str]):
+    """Make get_api_keys() return keys in this context (worker threads have no session_state)."""
+    token = _KEY_SCOPE.set(keys)
+    try:
+        yield
+    finally:
+        _KEY_SCOPE.reset(token)
+
+
+def env_api_keys() -> Dict[str, str]:
+    """Server-side keys only, for headless callers."""
     return {
-        "gemini": os.getenv("GEMINI_API_KEY") or st.session_state["gemini_key_user"],
-        "openai": os.getenv("OPENAI_API_KEY") or st.session_state["openai_key_user"],
-        "anthropic": os.getenv("ANTHROPIC_API_KEY") or st.session_state["anthropic_key_user"],
-        "grok": os.getenv("GROK_API_KEY") or st.session_state["grok_key_user"],
+        name: os.getenv(cfg["key_env"], "") if cfg.get("key_env") else NO_KEY_REQUIRED
+        for name, cfg in provider_registry().providers.items()
     }
 
 
+def get_api_keys() -> Dict[str, str]:
+    scoped = _KEY_SCOPE.get()
+    if scoped is not None:
+        return dict(scoped)
+    env = env_api_keys()
+    return {p: env[p] or st.session_state.get(f"{p}_key_user", "") for p in env}
+
+
+class MissingAPIKeyError(RuntimeError):
+    pass
+
+
+class UnknownProviderError(RuntimeError):
+    """No configured provider serves the requested model."""
+
+
+# =========================
+# Provider Registry
+# =========================
+
+class ProviderRegistry:
+    """Providers by name, and which of them serves a given model name.
+
+    Configured providers are matched before built-ins; a model listed under a
+    provider's models always belongs to it. default (if set) takes models that
+    match nothing.
+    """
+
+    def __init__(self, providers: List[Dict[str, Any]], default: Optional[str] = None, issues: List[str] = None):
+        self.providers: Dict[str, Dict[str, Any]] = {p["name"]: p for p in providers}
+        self.default = default
+        self.issues = issues or []
+        self._listed = {m.lower(): p["name"] for p in providers for m in p.get("models", {})}
+
+    def match(self, model: str) -> Optional[str]:
+        m = model.lower()
+        if m in self._listed:
+            return self._listed[m]
+        for name, cfg in self.providers.items():
+            if any(fnmatch.fnmatchcase(m, pattern) for pattern in cfg["patterns"]):
+                return name
+        return None
+
+    def models(self) -> Dict[str, Dict[str, Any]]:
+        """Models declared in PROVIDERS_FILE: name -> {tier, context, input, output} (all optional)."""
+        return {m: spec for cfg in self.providers.values() for m, spec in cfg.get("models", {}).items()}
+
+
+def _provider_entry_issues(entry: Dict[str, Any], builtin: bool) -> List[str]:
+    name = entry.get("name")
+    where = f"provider {name!r}" if name else "provider entry"
+    issues = []
+    unknown = set(entry) - {"name", "api", "patterns", "base_url", "key_env", "max_concurrency", "timeout_s", "models"}
+    if unknown:
+        issues.append(f"{where}: unknown field(s) {', '.join(sorted(unknown))}")
+    if not builtin:
+        if entry.get("api") not in PROVIDER_APIS:
+            issues.append(f"{where}: 'api' must be one of {', '.join(PROVIDER_APIS)}")
+        if not entry.get("patterns") and not entry.get("models"):
+            issues.append(f"{where}: needs 'patterns' or 'models' to match any model")
+    elif "api" in entry and entry["api"] != next(p["api"] for p in BUILTIN_PROVIDERS if p["name"] == name):
+        issues.append(f"{where}: the api of a built-in provider cannot be changed")
+    patterns = entry.get("patterns", [])
+    if not isinstance(patterns, list) or not all(isinstance(x, str) and x for x in patterns):
+        issues.append(f"{where}: 'patterns' must be a list of strings")
+    for field in ("base_url", "key_env"):
+        if field in entry and entry[field] is not None and not isinstance(entry[field], str):
+            issues.append(f"{where}: '{field}' must be a string")
+    if entry.get("base_url") and (entry.get("api") == "gemini" or name == "gemini"):
+        issues.append(f"{where}: base_url is not supported for the gemini api")
+    limit = entry.get("max_concurrency")
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+        issues.append(f"{where}: 'max_concurrency' must be a positive integer")
+    timeout = entry.get("timeout_s")
+    if timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0):
+        issues.append(f"{where}: 'timeout_s' must be a positive number of seconds")
+    models = entry.get("models", {})
+    if isinstance(models, list):
+        models = {m: {} for m in models}
+    if not isinstance(models, dict) or not all(isinstance(v, dict) for v in models.values()):
+        issues.append(f"{where}: 'models' must be a list of names or a mapping of name -> {{tier, context, input, output}}")
+    return issues
+
+
+def build_provider_registry(yaml_text: str) -> ProviderRegistry:
+    """Merge PROVIDERS_FILE content into the built-ins; invalid entries are skipped and reported."""
+    builtins = {p["name"]: dict(p) for p in BUILTIN_PROVIDERS}
+    configured: List[Dict[str, Any]] = []
+    issues: List[str] = []
+    try:
+        data = yaml.load(yaml_text, Loader=YAML_LOADER) if yaml_text.strip() else {}
+    except yaml.YAMLError as e:
+        data = {}
+        issues.append(f"{PROVIDERS_FILE}: not valid YAML ({e})")
+    if not isinstance(data, dict):
+        issues.append(f"{PROVIDERS_FILE}: top level must be a mapping with a 'providers' list")
+        data = {}
+    entries = data.get("providers") or []
+    if not isinstance(entries, list):
+        issues.append(f"{PROVIDERS_FILE}: 'providers' must be a list")
+        entries = []
+
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) or not entry["name"]:
+            issues.append(f"{PROVIDERS_FILE}: every provider needs a 'name'")
+            continue
+        name = entry["name"]
+        entry_issues = _provider_entry_issues(entry, builtin=name in builtins)
+        if entry_issues:
+            issues.extend(entry_issues)
+            continue
+        if any(p["name"] == name for p in configured):
+            issues.append(f"provider {name!r}: defined more than once; later entry ignored")
+            continue
+        cfg = {**builtins.pop(name, {}), **{k: v for k, v in entry.items() if v is not None}}
+        cfg["patterns"] = [p.lower() for p in cfg.get("patterns", [])]
+        models = cfg.get("models") or {}
+        cfg["models"] = {m: {} for m in models} if isinstance(models, list) else dict(models)
+        configured.append(cfg)
+
+    providers = configured + [{**p, "models": {}} for p in builtins.values()]
+    default = data.get("default")
+    if default is not None and default not in {p["name"] for p in providers}:
+        issues.append(f"{PROVIDERS_FILE}: default provider {default!r} is not defined")
+        default = None
+    return ProviderRegistry(providers, default, issues)
+
+
+def provider_registry() -> ProviderRegistry:
+    """The registry for PROVIDERS_FILE as it is on disk now (rebuilt when the file changes)."""
+    try:
+        st_ = os.stat(PROVIDERS_FILE)
+        version = (st_.st_mtime_ns, st_.st_size)
+    except OSError:
+        version = None
+    return _load_provider_registry(PROVIDERS_FILE, version)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_provider_registry(path: str, version: Optional[Tuple[int, int]]) -> ProviderRegistry:
+    if version is None:
+        return build_provider_registry("")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return build_provider_registry(f.read())
+    except OSError as e:
+        registry = build_provider_registry("")
+        registry.issues.append(f"{path}: {e}")
+        return registry
+
+
+def known_provider(model: str) -> Optional[str]:
+    return provider_registry().match(model)
+
+
 def detect_provider(model: str) -> str:
-    m = model.lower()
-    if m.startswith("gemini"):
-        return "gemini"
-    if m.startswith("gpt") or "gpt-" in m or "o1" in m:
-        return "openai"
-    if "grok" in m:
-        return "grok"
-    if "claude" in m or "anthropic" in m:
-        return "anthropic"
-    # Fallback: default to gemini
-    return "gemini"
+    registry = provider_registry()
+    provider = registry.match(model) or registry.default
+    if provider is None:
+        raise UnknownProviderError(
+            f"No provider serves model '{model}'. Add a pattern for it to {PROVIDERS_FILE} "
+            f"or set a default provider there."
+        )
+    return provider
+
+
+def provider_config(provider: str) -> Dict[str, Any]:
+    cfg = provider_registry().providers.get(provider)
+    if cfg is None:
+        raise UnknownProviderError(f"Unknown provider '{provider}'.")
+    return cfg
+
+
+def provider_api(provider: str) -> str:
+    """Wire protocol of a provider: "openai", "anthropic" or "gemini"."""
+    return provider_config(provider)["api"]
 
 
+def model_options() -> List[str]:
+    """Models offered in pickers and to auto routing: MODEL_OPTIONS plus declared ones."""
+    declared = [m for m in provider_registry().models() if m not in MODEL_OPTIONS]
+    return MODEL_OPTIONS + declared
+
+
+def model_profile(model: str) -> Dict[str, int]:
+    """Tier and context window from MODEL_PROFILES, or from the model's PROVIDERS_FILE entry."""
+    spec = provider_registry().models().get(model)
+    if spec is not None:
+        base = MODEL_PROFILES.get(model, {"tier": 1, "context": 0})
+        return {"tier": int(spec.get("tier", base["tier"])), "context": int(spec.get("context", base["context"]))}
+    return MODEL_PROFILES.get(model, {"tier": 1, "context": 0})
+
+
+@functools.lru_cache(maxsize=64)
+def _sdk_client(api: str, base_url: Optional[str], timeout_s: Optional[float], api_key: str) -> Any:
+    kwargs: Dict[str, Any] = {"api_key": api_key, "base_url": base_url}
+    if timeout_s:
+        kwargs["timeout"] = timeout_s
+    if api == "openai":
+        return OpenAI(**kwargs)
+    if api == "anthropic":
+        return anthropic.Anthropic(**kwargs)
+    return None
+
+
+def provider_client(provider: str, api_key: str) -> Any:
+    """SDK client for (provider, key), reused so calls share its HTTP connection pool.
+
+    Gemini has no client object (genai.configure is module-global); None is returned.
+    """
+    cfg = provider_config(provider)
+    return _sdk_client(cfg["api"], cfg.get("base_url"), cfg.get("timeout_s"), api_key)
+
+
+# Async clients hold connections bound to one event loop, so they are pooled per loop.
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[Any, Dict[Tuple[Any, ...], Any]]" = weakref.WeakKeyDictionary()
+
+
+def aprovider_client(provider: str, api_key: str) -> Any:
+    """Async twin of provider_client for the running event loop."""
+    cfg = provider_config(provider)
+    clients = _ASYNC_CLIENTS.setdefault(asyncio.get_running_loop(), {})
+    key = (cfg["api"], cfg.get("base_url"), cfg.get("timeout_s"), api_key)
+    if key not in clients:
+        kwargs: Dict[str, Any] = {"api_key": api_key, "base_url": cfg.get("base_url")}
+        if cfg.get("timeout_s"):
+            kwargs["timeout"] = cfg["timeout_s"]
+        if cfg["api"] == "openai":
+            clients[key] = AsyncOpenAI(**kwargs)
+        elif cfg["api"] == "anthropic":
+            clients[key] = anthropic.AsyncAnthropic(**kwargs)
+        else:
+            clients[key] = None
+    return clients[key]
+
+
+def _gemini_options(provider: str) -> Dict[str, Any]:
+    timeout = provider_config(provider).get("timeout_s")
+    return {"request_options": {"timeout": timeout}} if timeout else {}
+
+
+# =========================
+# LLM Calls
+# =========================
+
 def call_llm(
     prompt: str,
     system_prompt: Optional[str],
     model: str,
     max_tokens: int,
+    tags: Optional[List[str]] = None,
+    policy: Optional[Dict[str, Any]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    """Call a model and record telemetry.
+
+    model may be AUTO_MODEL, in which case route_models() picks candidates
+    (using tags and policy) and later ones are tried if earlier ones fail.
+    history holds earlier {"role": "user"|"assistant", "content": ...} turns.
+    If meta is given it is filled with details about the call that was made.
+    """
+    meta = {} if meta is None else meta
+    if model != AUTO_MODEL:
+        return _call_llm_recorded(prompt, system_prompt, model, max_tokens, meta, history)
+
+    candidates = route_models(prompt, system_prompt, max_tokens, tags=tags, policy=policy, history=history)
+    meta["candidates"] = candidates
+    if not candidates:
+        raise MissingAPIKeyError("No model available for automatic routing; configure an API key.")
+    last_error: Optional[Exception] = None
+    for candidate in candidates[:ROUTER_MAX_ATTEMPTS]:
+        try:
+            return _call_llm_recorded(prompt, system_prompt, candidate, max_tokens, meta, history)
+        except LlmCancelledError:
+            raise
+        except Exception as e:
+            meta.setdefault("failed", []).append(f"{candidate}: {e}")
+            last_error = e
+    raise RuntimeError(f"All routed models failed; last error: {last_error}")
+
+
+def _call_llm_recorded(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    meta: Dict[str, Any],
+    history: Optional[List[Dict[str, str]]] = None,
 ) -> str:
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + history_tokens(history)
+    requested = model
+    model, reservation = enforce_budget(model, input_tokens, max_tokens)
+    if model != requested:
+        meta["downgraded_from"] = requested
+    provider = detect_provider(model)
+    meta.update({"model": model, "provider": provider})
+    start = time.perf_counter()
+    try:
+        out, usage = _call_provider(prompt, system_prompt, model, max_tokens, history)
+    except (MissingAPIKeyError, ProviderUnavailableError):
+        release_budget(reservation)
+        raise
+    except LlmCancelledError as e:
+        meta["stopped"] = True
+        meta["latency_s"] = time.perf_counter() - start
+        telemetry().record_cancelled(model, meta["latency_s"], len(e.partial))
+        meta.update(record_usage(model, {}, input_tokens, e.partial, reservation=reservation))
+        raise
+    except Exception:
+        release_budget(reservation)
+        telemetry().record(model, time.perf_counter() - start, ok=False)
+        raise
+    latency = time.perf_counter() - start
+    meta["latency_s"] = latency
+    telemetry().record(model, latency, ok=True, output_chars=len(out))
+    meta.update(record_usage(model, usage, input_tokens, out, reservation=reservation))
+    return out
+
+
+def _call_provider_live(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """Blocking completion; returns (text, usage) where usage is the provider's token counts."""
     provider = detect_provider(model)
     keys = get_api_keys()
     api_key = keys.get(provider)
 
     if not api_key:
-        raise RuntimeError(f"No API key available for provider '{provider}'.")
+        raise MissingAPIKeyError(f"No API key available for provider '{provider}'.")
+    api = provider_api(provider)
 
-    if provider == "gemini":
+    if api == "gemini":
         genai.configure(api_key=api_key)
         gm = genai.GenerativeModel(model)
-        full_prompt = prompt
-        if system_prompt:
-            full_prompt = system_prompt.strip() + "\n\nUser:\n" + prompt
         resp = gm.generate_content(
-            full_prompt,
+            _gemini_contents(prompt, system_prompt, history),
             generation_config={"max_output_tokens": max_tokens or 1024},
+            **_gemini_options(provider),
         )
-        return resp.text or ""
-
-    if provider == "openai":
-        client = OpenAI(api_key=api_key)
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
+        return resp.text or "", _usage_from_response(api, resp)
+
+    if api == "openai":
+        client = provider_client(provider, api_key)
         resp = client.chat.completions.create(
             model=model,
-            messages=messages,
-            max_tokens=max_tokens or 1024,
-        )
-        return resp.choices[0].message.content or ""
-
-    if provider == "anthropic":
-        client = anthropic.Anthropic(api_key=api_key)
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-        resp = client.messages.create(
-            model=model,
+            messages=_chat_messages(prompt, system_prompt, history),
             max_tokens=max_tokens or 1024,
-            messages=messages,
         )
+        return resp.choices[0].message.content or "", _usage_from_response(api, resp)
+
+    if api == "anthropic":
+        client = provider_client(provider, api_key)
+        resp = client.messages.create(**_anthropic_kwargs(prompt, system_prompt, model, max_tokens, history))
         chunks = []
         for block in resp.content:
             if getattr(block, "type", None) == "text":
                 chunks.append(block.text)
-        return "".join(chunks)
-
-    if provider == "grok":
-        # xAI Grok: OpenAI-compatible base URL
-        client = OpenAI(api_key=api_key, base_url="https://api.x.ai/v1")
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-        resp = client.chat.completions.create(
+        return "".join(chunks), _usage_from_response(api, resp)
+
+    raise RuntimeError(f"Unsupported provider: {provider}")
+
+
+def _usage_from_response(api: str, resp: Any) -> Dict[str, int]:
+    """Exact token counts from a provider response (or final stream state); {} if absent.
+
+    truncated=1 is added when the response stopped because it reached max_tokens.
+    """
+    usage = {"truncated": 1} if _stopped_at_limit(api, resp) else {}
+    if api == "gemini":
+        um = getattr(resp, "usage_metadata", None)
+        if um is not None:
+            usage["input_tokens"] = getattr(um, "prompt_token_count", 0) or 0
+            usage["output_tokens"] = getattr(um, "candidates_token_count", 0) or 0
+        return usage
+    counts = getattr(resp, "usage", None)
+    if counts is None:
+        return usage
+    if api == "anthropic":
+        usage.update(input_tokens=counts.input_tokens or 0, output_tokens=counts.output_tokens or 0)
+    else:
+        usage.update(input_tokens=counts.prompt_tokens or 0, output_tokens=counts.completion_tokens or 0)
+    return usage
+
+
+def _stopped_at_limit(api: str, resp: Any) -> bool:
+    """Whether a response (or final stream state) ended because it reached max_tokens."""
+    try:
+        if api == "gemini":
+            reason = resp.candidates[0].finish_reason
+            return getattr(reason, "name", reason) in ("MAX_TOKENS", 2)
+        if api == "anthropic":
+            return getattr(resp, "stop_reason", None) == "max_tokens"
+        choices = getattr(resp, "choices", None)
+        return bool(choices) and getattr(choices[0], "finish_reason", None) == "length"
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return False
+
+
+def _chat_messages(
+    prompt: str, system_prompt: Optional[str], history: Optional[List[Dict[str, str]]] = None
+) -> List[Dict[str, str]]:
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend({"role": m["role"], "content": m["content"]} for m in history or [])
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _anthropic_kwargs(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> Dict[str, Any]:
+    # Anthropic takes the system prompt as a top-level field, not a message.
+    kwargs: Dict[str, Any] = {
+        "model": model,
+        "max_tokens": max_tokens or 1024,
+        "messages": _chat_messages(prompt, None, history),
+    }
+    if system_prompt:
+        kwargs["system"] = system_prompt
+    return kwargs
+
+
+def _gemini_contents(
+    prompt: str, system_prompt: Optional[str], history: Optional[List[Dict[str, str]]] = None
+) -> Any:
+    full_prompt = prompt
+    if system_prompt:
+        full_prompt = system_prompt.strip() + "\n\nUser:\n" + prompt
+    if not history:
+        return full_prompt
+    # Multi-turn: system text leads the first user turn so the prefix stays stable.
+    contents = []
+    for i, m in enumerate(history):
+        text = m["content"]
+        if i == 0 and system_prompt:
+            text = system_prompt.strip() + "\n\nUser:\n" + text
+        contents.append({"role": "model" if m["role"] == "assistant" else "user", "parts": [text]})
+    contents.append({"role": "user", "parts": [prompt]})
+    return contents
+
+
+def _gemini_chunks(resp: Any, usage: Dict[str, int]):
+    for chunk in resp:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. a final safety/finish chunk).
+            continue
+        if text:
+            yield text
+    usage.update(_usage_from_response("gemini", resp))
+
+
+def _gemini_cancel(resp: Any) -> None:
+    # The SDK keeps the transport stream on the response: a gRPC call or a
+    # REST response iterator, both of which cancel() the underlying request.
+    stream = getattr(resp, "_iterator", None)
+    cancel = getattr(stream, "cancel", None) or getattr(stream, "close", None)
+    if callable(cancel):
+        cancel()
+
+
+def _openai_chunks(stream: Any, usage: Dict[str, int]):
+    for ev in stream:
+        if ev.choices and ev.choices[0].delta.content:
+            yield ev.choices[0].delta.content
+        # The finish reason arrives before the (choice-less) usage event.
+        if _stopped_at_limit("openai", ev):
+            usage["truncated"] = 1
+        if getattr(ev, "usage", None) is not None:
+            usage.update(_usage_from_response("openai", ev))
+
+
+def _anthropic_chunks(stream: Any, usage: Dict[str, int]):
+    yield from stream.text_stream
+    usage.update(_usage_from_response("anthropic", stream.get_final_message()))
+
+
+def _open_llm_stream_live(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    history: Optional[List[Dict[str, str]]] = None,
+    usage: Optional[Dict[str, int]] = None,
+) -> Tuple[Any, Callable[[], None]]:
+    """Start a streaming completion against the provider; see open_llm_stream."""
+    usage = {} if usage is None else usage
+    provider = detect_provider(model)
+    if not api_key:
+        raise MissingAPIKeyError(f"No API key available for provider '{provider}'.")
+    api = provider_api(provider)
+
+    if api == "gemini":
+        genai.configure(api_key=api_key)
+        gm = genai.GenerativeModel(model)
+        resp = gm.generate_content(
+            _gemini_contents(prompt, system_prompt, history),
+            generation_config={"max_output_tokens": max_tokens or 1024},
+            stream=True,
+            **_gemini_options(provider),
+        )
+        return _gemini_chunks(resp, usage), lambda: _gemini_cancel(resp)
+
+    if api == "openai":
+        client = provider_client(provider, api_key)
+        stream = client.chat.completions.create(
             model=model,
-            messages=messages,
+            messages=_chat_messages(prompt, system_prompt, history),
             max_tokens=max_tokens or 1024,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        return resp.choices[0].message.content or ""
+        return _openai_chunks(stream, usage), stream.close
+
+    if api == "anthropic":
+        client = provider_client(provider, api_key)
+        kwargs = _anthropic_kwargs(prompt, system_prompt, model, max_tokens, history)
+        stream = client.messages.stream(**kwargs).__enter__()
+        return _anthropic_chunks(stream, usage), stream.close
 
     raise RuntimeError(f"Unsupported provider: {provider}")
 
@@ -757,167 +1566,4515 @@ def ai_repair_yaml(yaml_text: str, model: str) -> str:
     ).strip()
 
     prompt = f"Here is the possibly invalid agents.yaml text:\n\n{yaml_text}"
-    return call_llm(prompt=prompt, system_prompt=system_prompt, model=model, max_tokens=4096).strip()
+    return call_llm_cached(prompt=prompt, system_prompt=system_prompt, model=model, max_tokens=4096).strip()
 
 
-def summarize_document(text: str, model: str) -> str:
-    system_prompt = textwrap.dedent(
-        """
-        You are a precise summarization engine for arbitrary documents.
+SUMMARY_SYSTEM_PROMPT = textwrap.dedent(
+    """
+    You are a precise summarization engine for arbitrary documents.
 
-        Produce a concise, structured summary with:
+    Produce a concise, structured summary with:
 
-        - Overview (2–3 sentences)
-        - Key points (bullet list)
-        - Risks or caveats (if any)
-        - Suggested next steps
+    - Overview (2–3 sentences)
+    - Key points (bullet list)
+    - Risks or caveats (if any)
+    - Suggested next steps
 
-        Write clearly and avoid hallucinations. If content is very short, still respect the structure.
-        """
+    Write clearly and avoid hallucinations. If content is very short, still respect the structure.
+    """
+).strip()
+
+STRUCTURED_SUMMARY_SYSTEM_PROMPT = textwrap.dedent(
+    """
+    You are a precise summarization engine for arbitrary documents.
+
+    Produce a concise summary using exactly these Markdown headings, in this order:
+
+    ## Overview
+    (2–3 sentences)
+
+    ## Key points
+    (bullet list)
+
+    ## Risks or caveats
+    (bullet list; write "None identified." if there are none)
+
+    ## Suggested next steps
+    (bullet list)
+
+    Output nothing before the first heading. Avoid hallucinations.
+    """
+).strip()
+
+SUMMARY_MAX_TOKENS = 2048
+
+
+def summarize_document(text: str, model: str, meta: Optional[Dict[str, Any]] = None) -> str:
+    return call_llm_cached(
+        prompt=text, system_prompt=SUMMARY_SYSTEM_PROMPT, model=model, max_tokens=SUMMARY_MAX_TOKENS, meta=meta
     ).strip()
-    return call_llm(prompt=text, system_prompt=system_prompt, model=model, max_tokens=2048).strip()
+
+
+def stream_structured_summary(text: str, model: str, meta: Optional[Dict[str, Any]] = None):
+    """Stream a summary and yield (parser, finished_sections) after every chunk.
+
+    finished_sections lists sections completed by that chunk; the parser exposes
+    the section still being written via parser.current().
+    """
+    parser = SummarySectionParser()
+    for chunk in stream_llm(
+        prompt=text,
+        system_prompt=STRUCTURED_SUMMARY_SYSTEM_PROMPT,
+        model=model,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        meta=meta,
+    ):
+        yield parser, parser.feed(chunk)
+    yield parser, parser.finish()
 
 
 def safe_parse_yaml_agents(yaml_text: str) -> Optional[List[Dict[str, Any]]]:
     try:
-        data = yaml.safe_load(yaml_text) or {}
-        if isinstance(data, dict) and isinstance(data.get("agents"), list):
-            return data["agents"]
-        if isinstance(data, list):
-            return data
-        # attempt to treat as dict of agents
-        if isinstance(data, dict):
-            return list(data.values())
+        agents, issues = validate_agents_yaml(yaml_text)
     except Exception:
         return None
-    return None
+    if has_errors(issues):
+        return None
+    return agents
 
 
 # =========================
-# Sidebar: Controls & Keys
+# Shared State
 # =========================
 
-def render_sidebar():
-    init_session_state()
-    labels = get_language_labels()
-
-    with st.sidebar:
-        # WOW header
-        st.markdown("#### 🎨 Artistic Intelligence Workspace")
-        st.caption("Multi-agent AI studio with painter-style theming")
-
-        # View selection
-        view = st.radio(
-            "View",
-            options=["dashboard", "agent_studio", "doc_intel"],
-            format_func=lambda v: {
-                "dashboard": labels["view_dashboard"],
-                "agent_studio": labels["view_agent_studio"],
-                "doc_intel": labels["view_doc_intel"],
-            }[v],
-            index=["dashboard", "agent_studio", "doc_intel"].index(
-                st.session_state["view"]
-            ),
-        )
-        st.session_state["view"] = view
+class MemorySharedState:
+    """Process-local backend with the SharedState interface (single worker, tests)."""
+
+    def __init__(self):
+        self._values: Dict[Tuple[str, str], Tuple[Any, Optional[float]]] = {}
+        self._events: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            item = self._values.get((namespace, key))
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.time():
+                del self._values[(namespace, key)]
+                return None
+            return value
+
+    def set(self, namespace: str, key: str, value: Any, ttl_s: Optional[float] = None) -> None:
+        expires = time.time() + ttl_s if ttl_s else None
+        with self._lock:
+            self._values[(namespace, key)] = (value, expires)
+
+    def clear(self, namespace: str) -> None:
+        with self._lock:
+            for k in [k for k in self._values if k[0] == namespace]:
+                del self._values[k]
+
+    def add_event(self, stream: str, entry: Dict[str, Any], keep: int) -> None:
+        with self._lock:
+            self._events.setdefault(stream, deque(maxlen=keep)).append(entry)
+
+    def events(self, stream: str, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._events.get(stream, ()))[-limit:]
+
+    def streams(self) -> List[str]:
+        with self._lock:
+            return list(self._events)
+
+
+class SQLiteSharedState:
+    """Key/value store and event log in one SQLite file (WAL) shared by all processes.
+
+    Values are JSON. Writers serialise on SQLite's lock (busy timeout), readers
+    never block; expired keys and old events are pruned as writes go by.
+    """
 
-        st.markdown("---")
-        st.markdown(f"**{labels['language']}**")
-        lang = st.radio(
-            "Language",
-            options=["en", "tc"],
-            format_func=lambda v: "EN" if v == "en" else "繁體中文",
-            index=["en", "tc"].index(st.session_state["language"]),
-        )
-        st.session_state["language"] = lang
-        labels = get_language_labels()
+    PRUNE_EVERY = 200
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._writes = 0
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS kv (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires REAL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY,
+                    stream TEXT NOT NULL,
+                    entry TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_stream_id ON events(stream, id)")
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires >= ?)",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace: str, key: str, value: Any, ttl_s: Optional[float] = None) -> None:
+        expires = time.time() + ttl_s if ttl_s else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv(namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires),
+            )
+            self._maybe_prune()
+
+    def clear(self, namespace: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kv WHERE namespace = ?", (namespace,))
+
+    def add_event(self, stream: str, entry: Dict[str, Any], keep: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO events(stream, entry) VALUES (?, ?)", (stream, json.dumps(entry)))
+            # Ids are shared by every stream, so the cutoff is this stream's keep-th newest row.
+            self._conn.execute(
+                "DELETE FROM events WHERE stream = ? AND id < "
+                "(SELECT id FROM events WHERE stream = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (stream, stream, keep - 1),
+            )
+            self._maybe_prune()
 
-        st.markdown(f"**{labels['theme']}**")
-        theme = st.radio(
-            "Theme",
-            options=["dark", "light"],
-            format_func=lambda v: labels["dark"] if v == "dark" else labels["light"],
-            index=["dark", "light"].index(st.session_state["theme"]),
-        )
-        st.session_state["theme"] = theme
+    def events(self, stream: str, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entry FROM events WHERE stream = ? ORDER BY id DESC LIMIT ?", (stream, limit)
+            ).fetchall()
+        return [json.loads(r[0]) for r in reversed(rows)]
 
-        st.markdown(f"**{labels['painter_style']}**")
-        col1, col2 = st.columns([3, 1])
-        with col1:
-            style = st.selectbox(
-                "Painter",
-                options=PAINTER_STYLES,
-                index=PAINTER_STYLES.index(st.session_state["painter_style"]),
-            )
-            st.session_state["painter_style"] = style
-        with col2:
-            if st.button(labels["jackpot"]):
-                import random
+    def streams(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT DISTINCT stream FROM events")]
 
-                st.session_state["painter_style"] = random.choice(PAINTER_STYLES)
+    def _maybe_prune(self) -> None:
+        # Caller holds the lock inside a transaction.
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
 
-        st.markdown("---")
-        st.markdown(f"**{labels['api_keys']}**")
 
-        env_keys = {
-            "gemini": bool(os.getenv("GEMINI_API_KEY")),
-            "openai": bool(os.getenv("OPENAI_API_KEY")),
-            "anthropic": bool(os.getenv("ANTHROPIC_API_KEY")),
-            "grok": bool(os.getenv("GROK_API_KEY")),
-        }
+@st.cache_resource
+def shared_state():
+    if SHARED_STATE_BACKEND == "memory":
+        return MemorySharedState()
+    return SQLiteSharedState(SHARED_STATE_DB)
 
-        def api_key_row(name: str, env_present: bool, state_key: str, label_key: str):
-            st.markdown(f"_{labels[label_key]}_")
-            if env_present:
-                st.text_input(
-                    labels[label_key],
-                    value="(using environment key)",
-                    type="password",
-                    disabled=True,
-                )
-                st.markdown(
-                    f"<span class='wow-badge'>🔒 {labels['status_operational']}</span>",
-                    unsafe_allow_html=True,
-                )
-            else:
-                val = st.text_input(
-                    labels[label_key],
-                    value=st.session_state[state_key],
-                    type="password",
-                )
-                st.session_state[state_key] = val
-                if val:
-                    st.markdown(
-                        f"<span class='wow-badge'>🟢 {labels['status_operational']}</span>",
-                        unsafe_allow_html=True,
-                    )
-                else:
-                    st.markdown(
-                        f"<span class='wow-badge'>🔴 {labels['status_missing']}</span>",
-                        unsafe_allow_html=True,
-                    )
 
-        api_key_row("gemini", env_keys["gemini"], "gemini_key_user", "gemini_key")
-        api_key_row("openai", env_keys["openai"], "openai_key_user", "openai_key")
-        api_key_row("anthropic", env_keys["anthropic"], "anthropic_key_user", "anthropic_key")
-        api_key_row("grok", env_keys["grok"], "grok_key_user", "grok_key")
+def cache_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def call_llm_cached(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    meta: Optional[Dict[str, Any]] = None,
+) -> str:
+    """call_llm for deterministic tasks (summaries, repairs), answered from the shared response cache."""
+    key = cache_key(prompt, system_prompt, model, max_tokens)
+    state = shared_state()
+    hit = state.get("responses", key)
+    if hit is not None:
+        if meta is not None:
+            meta.update(hit.get("meta", {}))
+            meta["cached"] = True
+        return hit["text"]
+    meta = {} if meta is None else meta
+    out = call_llm(prompt=prompt, system_prompt=system_prompt, model=model, max_tokens=max_tokens, meta=meta)
+    state.set("responses", key, {"text": out, "meta": {"model": meta.get("model", model)}}, RESPONSE_CACHE_TTL_S)
+    return out
+
+
+# =========================
+# Provider Health
+# =========================
+
+class ProviderUnavailableError(RuntimeError):
+    """A provider's circuit breaker is open; the call was rejected without trying."""
+
+
+def is_provider_fault(error: Exception) -> bool:
+    """Whether an error says something about provider health (not a bad request or missing key)."""
+    if isinstance(
+        error, (MissingAPIKeyError, UnknownProviderError, CassetteMissError, BudgetExceededError, LlmCancelledError)
+    ):
+        return False
+    code = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(code, int) and 400 <= code < 500:
+        return code in (408, 429)
+    return True
+
+
+class ProviderHealth:
+    """Sliding-window error rate and latency per provider, with a circuit breaker each."""
+
+    def __init__(self):
+        self._calls: Dict[str, deque] = {}
+        self._breakers: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, provider: str) -> Dict[str, Any]:
+        return self._breakers.setdefault(
+            provider,
+            {"state": "closed", "opened_at": 0.0, "cooldown": BREAKER_COOLDOWN_S, "trial": 0.0, "last_error": ""},
+        )
+
+    def _window(self, provider: str, now: float) -> deque:
+        calls = self._calls.setdefault(provider, deque())
+        while calls and calls[0][0] < now - BREAKER_WINDOW_S:
+            calls.popleft()
+        return calls
+
+    def allow(self, provider: str) -> None:
+        """Raise ProviderUnavailableError unless a call to provider may go ahead now."""
+        now = time.time()
+        with self._lock:
+            b = self._breaker(provider)
+            if b["state"] == "closed":
+                return
+            if b["state"] == "open" and now - b["opened_at"] >= b["cooldown"]:
+                b["state"] = "half_open"
+            # A trial that never reported back (abandoned stream) expires.
+            if b["state"] == "half_open" and now - b["trial"] > BREAKER_SLOW_CALL_S:
+                b["trial"] = now
+                return
+            wait = max(0.0, b["opened_at"] + b["cooldown"] - now)
+            raise ProviderUnavailableError(
+                f"{provider} is failing ({b['last_error'] or 'errors'}); not retrying for {wait:.0f}s."
+            )
+
+    def available(self, provider: str) -> bool:
+        """Like allow() but without claiming the trial slot (for routing decisions)."""
+        with self._lock:
+            b = self._breaker(provider)
+            if b["state"] == "open":
+                return time.time() - b["opened_at"] >= b["cooldown"]
+            return not (b["state"] == "half_open" and time.time() - b["trial"] <= BREAKER_SLOW_CALL_S)
+
+    def record(self, provider: str, ok: bool, latency_s: float, error: str = "") -> None:
+        now = time.time()
+        ok = ok and latency_s <= BREAKER_SLOW_CALL_S
+        with self._lock:
+            calls = self._window(provider, now)
+            calls.append((now, ok, latency_s))
+            b = self._breaker(provider)
+            b["trial"] = 0.0
+            if not ok:
+                b["last_error"] = error or f"slow response ({latency_s:.0f}s)"
+            if b["state"] == "half_open" or (b["state"] == "open" and ok):
+                if ok:
+                    # Start the window afresh from the successful trial.
+                    b.update(state="closed", cooldown=BREAKER_COOLDOWN_S)
+                    calls.clear()
+                    calls.append((now, ok, latency_s))
+                else:
+                    b.update(state="open", opened_at=now, cooldown=min(b["cooldown"] * 2, BREAKER_MAX_COOLDOWN_S))
+            elif b["state"] == "closed" and len(calls) >= BREAKER_MIN_CALLS:
+                failures = sum(1 for _, good, _ in calls if not good)
+                if failures / len(calls) >= BREAKER_ERROR_RATE:
+                    b.update(state="open", opened_at=now)
+
+    def release(self, provider: str) -> None:
+        """End a trial call that produced no verdict (e.g. a missing key)."""
+        with self._lock:
+            self._breaker(provider)["trial"] = 0.0
+
+    def status(self, provider: str) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            calls = list(self._window(provider, now))
+            b = dict(self._breaker(provider))
+        latencies = [lat for _, ok, lat in calls if ok]
+        error_rate = sum(1 for _, ok, _ in calls if not ok) / len(calls) if calls else 0.0
+        if b["state"] == "open":
+            state = "down"
+        elif b["state"] == "half_open" or (calls and error_rate >= HEALTH_DEGRADED_ERROR_RATE):
+            state = "degraded"
+        elif calls:
+            state = "ok"
+        else:
+            state = "unknown"
+        return {
+            "state": state,
+            "calls": len(calls),
+            "error_rate": error_rate,
+            "p50_s": percentile(latencies, 50),
+            "last_error": b["last_error"],
+        }
+
+
+def _probe_provider(provider: str, api_key: str) -> None:
+    """Cheapest authenticated request each SDK offers (model listing)."""
+    api = provider_api(provider)
+    if api == "gemini":
+        genai.configure(api_key=api_key)
+        next(iter(genai.list_models()), None)
+    elif api == "openai":
+        provider_client(provider, api_key).with_options(timeout=10).models.list()
+    elif api == "anthropic":
+        provider_client(provider, api_key).with_options(timeout=10).models.list(limit=1)
+
+
+def _probe_loop(health: ProviderHealth, interval_s: float) -> None:
+    # Only server-side keys: the thread has no session. Probes cover providers
+    # without recent traffic and let an open breaker recover without user calls.
+    while True:
+        time.sleep(interval_s)
+        for provider, api_key in env_api_keys().items():
+            if not api_key:
+                continue
+            status = health.status(provider)
+            if status["state"] == "ok":
+                continue
+            start = time.perf_counter()
+            try:
+                _probe_provider(provider, api_key)
+                health.record(provider, True, time.perf_counter() - start)
+            except Exception as e:
+                if is_provider_fault(e):
+                    health.record(provider, False, time.perf_counter() - start, error=type(e).__name__)
+
+
+@st.cache_resource
+def provider_health() -> ProviderHealth:
+    health = ProviderHealth()
+    if HEALTH_PROBE_INTERVAL_S > 0:
+        threading.Thread(target=_probe_loop, args=(health, HEALTH_PROBE_INTERVAL_S), daemon=True).start()
+    return health
+
+
+@contextmanager
+def guarded_call_errors(health: ProviderHealth, provider: str, start: float):
+    try:
+        yield
+    except Exception as e:
+        if is_provider_fault(e):
+            health.record(provider, False, time.perf_counter() - start, error=type(e).__name__)
+        else:
+            health.release(provider)
+        raise
+
+
+@contextmanager
+def guarded_call(provider: str):
+    """Admit a live provider call through its breaker and record how it went."""
+    health = provider_health()
+    health.allow(provider)
+    start = time.perf_counter()
+    with guarded_call_errors(health, provider, start):
+        yield
+    health.record(provider, True, time.perf_counter() - start)
+
+
+def guarded_stream(provider: str, open_stream: Callable[[], Tuple[Any, Callable[[], None]]]):
+    """guarded_call for streams: health is judged on time to first token and how the stream ends."""
+    health = provider_health()
+    health.allow(provider)
+    start = time.perf_counter()
+    with guarded_call_errors(health, provider, start):
+        chunks, close = open_stream()
+
+    def guarded():
+        ttft = None
+        with guarded_call_errors(health, provider, start):
+            try:
+                for text in chunks:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield text
+            except GeneratorExit:
+                # Stopped by the consumer: only a first token says anything about health.
+                if ttft is None:
+                    health.release(provider)
+                else:
+                    health.record(provider, True, ttft)
+                raise
+        health.record(provider, True, ttft if ttft is not None else time.perf_counter() - start)
+
+    return guarded(), close
+
+
+async def aguarded_stream(provider: str, open_stream):
+    """Async twin of guarded_stream; open_stream is a coroutine function."""
+    health = provider_health()
+    health.allow(provider)
+    start = time.perf_counter()
+    with guarded_call_errors(health, provider, start):
+        chunks, close = await open_stream()
+
+    async def guarded():
+        ttft = None
+        with guarded_call_errors(health, provider, start):
+            try:
+                async for text in chunks:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield text
+            except (GeneratorExit, asyncio.CancelledError):
+                if ttft is None:
+                    health.release(provider)
+                else:
+                    health.record(provider, True, ttft)
+                raise
+        health.record(provider, True, ttft if ttft is not None else time.perf_counter() - start)
+
+    return guarded(), close
+
+
+# =========================
+# Cancellation
+# =========================
+
+class LlmCancelledError(RuntimeError):
+    """The user stopped the call; partial holds the text received before that."""
+
+    def __init__(self, partial: str = ""):
+        super().__init__("Stopped by user.")
+        self.partial = partial
+
+
+class CancelScope:
+    """Stop switch shared by every provider call made under cancel_scope(scope).
+
+    Open provider streams register their close callables here, so cancel()
+    aborts them from any thread; received text is collected in chunks.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.chunks: List[str] = []
+        self._closers: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, close: Callable[[], None]) -> None:
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._closers.append(close)
+                return
+        close()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled.set()
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                pass
+
+    @property
+    def partial(self) -> str:
+        return "".join(self.chunks)
+
+
+_CANCEL_SCOPE: contextvars.ContextVar = contextvars.ContextVar("cancel_scope", default=None)
+
+
+@contextmanager
+def cancel_scope(scope: CancelScope):
+    token = _CANCEL_SCOPE.set(scope)
+    try:
+        yield scope
+    finally:
+        _CANCEL_SCOPE.reset(token)
+
+
+def current_cancel_scope() -> Optional[CancelScope]:
+    return _CANCEL_SCOPE.get()
+
+
+def _cancellable_chunks(chunks, scope: CancelScope):
+    try:
+        for text in chunks:
+            if scope.cancelled.is_set():
+                break
+            scope.chunks.append(text)
+            yield text
+    except Exception:
+        if not scope.cancelled.is_set():
+            raise
+    # A closed stream may simply end; report it as a stop rather than a complete answer.
+    if scope.cancelled.is_set():
+        raise LlmCancelledError(scope.partial)
+
+
+def run_stoppable(
+    fn: Callable[[], Any],
+    on_progress: Callable[[str], None],
+    on_stop: Callable[[str], None],
+    poll_s: float = 0.1,
+) -> Any:
+    """Run fn on a worker thread under a fresh CancelScope; return its result.
+
+    The calling (script) thread calls on_progress(partial_text) every poll_s,
+    which gives Streamlit a point to interrupt it when the user clicks Stop or
+    leaves. On interruption the scope is cancelled (closing provider streams
+    and freeing the worker), on_stop(partial_text) runs, and the interruption
+    propagates.
+    """
+    scope = CancelScope()
+    keys = get_api_keys()
+    context = current_usage_context()
+    result: Dict[str, Any] = {}
+
+    def work():
+        with api_key_scope(keys), usage_scope(**context), cancel_scope(scope):
+            try:
+                result["value"] = fn()
+            except BaseException as e:
+                result["error"] = e
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    try:
+        while worker.is_alive():
+            on_progress(scope.partial)
+            worker.join(poll_s)
+    except BaseException:
+        scope.cancel()
+        worker.join(1.0)
+        on_stop(scope.partial)
+        raise
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+# =========================
+# LLM Scheduling
+# =========================
+
+def _resolve_future(future: "asyncio.Future") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class LlmScheduler:
+    """Admission control for provider calls: priority classes, fair per-session queues, caps.
+
+    Waiting work is granted interactive first, then batch, then background.
+    Within a class, sessions take turns (round robin) so one session's backlog
+    cannot starve another's. Batch and background never use the last
+    SCHEDULER_INTERACTIVE_RESERVE slots, so interactive latency stays flat
+    while batches run. A provider's max_concurrency (PROVIDERS_FILE) caps its
+    running calls; work for other providers is granted around it.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        session_concurrency: int = SCHEDULER_SESSION_CONCURRENCY,
+        interactive_reserve: int = SCHEDULER_INTERACTIVE_RESERVE,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.session_concurrency = max(1, session_concurrency)
+        self.shared_limit = max(1, self.max_concurrency - interactive_reserve)
+        self._queues: Dict[str, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in SCHEDULER_PRIORITIES}
+        self._running: Dict[str, int] = {p: 0 for p in SCHEDULER_PRIORITIES}
+        self._running_by_session: Dict[str, int] = {}
+        self._running_by_provider: Dict[str, int] = {}
+        self._waits: Dict[str, deque] = {p: deque(maxlen=SCHEDULER_METRICS_WINDOW) for p in SCHEDULER_PRIORITIES}
+        self._granted: Dict[str, int] = {p: 0 for p in SCHEDULER_PRIORITIES}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, priority: str, session: str, provider: str = "", loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> Dict[str, Any]:
+        """Queue a request for a slot; wait on ticket["granted"] (or await ticket["future"]
+        when loop is given), then release() it."""
+        if priority not in self._queues:
+            priority = SCHEDULER_PRIORITIES[0]
+        cfg = provider_registry().providers.get(provider, {})
+        ticket = {
+            "priority": priority,
+            "session": session,
+            "provider": provider,
+            "provider_limit": cfg.get("max_concurrency"),
+            "enqueued": time.perf_counter(),
+            "granted": threading.Event(),
+            "loop": loop,
+            "future": loop.create_future() if loop is not None else None,
+            "released": False,
+        }
+        with self._lock:
+            self._queues[priority].setdefault(session, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def _dispatch(self) -> None:
+        # Caller holds the lock.
+        while sum(self._running.values()) < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            p, session, provider = ticket["priority"], ticket["session"], ticket["provider"]
+            self._running[p] += 1
+            self._running_by_session[session] = self._running_by_session.get(session, 0) + 1
+            self._running_by_provider[provider] = self._running_by_provider.get(provider, 0) + 1
+            self._granted[p] += 1
+            self._waits[p].append(time.perf_counter() - ticket["enqueued"])
+            ticket["granted"].set()
+            if ticket["future"] is not None:
+                try:
+                    ticket["loop"].call_soon_threadsafe(_resolve_future, ticket["future"])
+                except RuntimeError:
+                    pass  # loop closed; release() still frees the slot
+
+    def _next_ticket(self) -> Optional[Dict[str, Any]]:
+        shared_running = sum(n for p, n in self._running.items() if p != "interactive")
+        for p in SCHEDULER_PRIORITIES:
+            if p != "interactive" and shared_running >= self.shared_limit:
+                return None
+            queues = self._queues[p]
+            for session in list(queues):
+                if self._running_by_session.get(session, 0) >= self.session_concurrency:
+                    continue
+                waiting = queues[session]
+                ticket = next((t for t in waiting if not self._provider_full(t)), None)
+                if ticket is None:
+                    continue
+                waiting.remove(ticket)
+                del queues[session]
+                if waiting:
+                    queues[session] = waiting  # back of the line: round robin
+                return ticket
+        return None
+
+    def _provider_full(self, ticket: Dict[str, Any]) -> bool:
+        limit = ticket["provider_limit"]
+        return bool(limit) and self._running_by_provider.get(ticket["provider"], 0) >= limit
+
+    def release(self, ticket: Dict[str, Any]) -> None:
+        """Give back a granted slot or withdraw a waiting request; safe to call twice."""
+        with self._lock:
+            if ticket["released"]:
+                return
+            ticket["released"] = True
+            if ticket["granted"].is_set():
+                self._running[ticket["priority"]] -= 1
+                session, provider = ticket["session"], ticket["provider"]
+                self._running_by_session[session] -= 1
+                if not self._running_by_session[session]:
+                    del self._running_by_session[session]
+                self._running_by_provider[provider] -= 1
+                if not self._running_by_provider[provider]:
+                    del self._running_by_provider[provider]
+            else:
+                queue_ = self._queues[ticket["priority"]].get(ticket["session"])
+                if queue_ is not None:
+                    queue_.remove(ticket)
+                    if not queue_:
+                        del self._queues[ticket["priority"]][ticket["session"]]
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority: Optional[str] = None, session: Optional[str] = None, provider: str = ""):
+        """Hold a slot for the duration of the block (defaults from the usage context)."""
+        ticket = self.submit(*self._defaults(priority, session), provider=provider)
+        try:
+            ticket["granted"].wait()
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    async def aslot_acquire(
+        self, priority: Optional[str] = None, session: Optional[str] = None, provider: str = ""
+    ):
+        """Async acquire for event-loop callers; cancellation withdraws the request."""
+        ticket = self.submit(
+            *self._defaults(priority, session), provider=provider, loop=asyncio.get_running_loop()
+        )
+        try:
+            await ticket["future"]
+        except BaseException:
+            self.release(ticket)
+            raise
+        return ticket
+
+    @staticmethod
+    def _defaults(priority: Optional[str], session: Optional[str]) -> Tuple[str, str]:
+        if priority is None or session is None:
+            context = current_usage_context()
+            priority = priority or context.get("priority") or SCHEDULER_PRIORITIES[0]
+            session = session if session is not None else context.get("session_id", "")
+        return priority, session
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = []
+            for p in SCHEDULER_PRIORITIES:
+                waits = list(self._waits[p])
+                rows.append(
+                    {
+                        "class": p,
+                        "running": self._running[p],
+                        "queued": sum(len(q) for q in self._queues[p].values()),
+                        "sessions waiting": len(self._queues[p]),
+                        "granted": self._granted[p],
+                        "wait p50 (ms)": round(percentile(waits, 50) * 1000, 1) if waits else None,
+                        "wait p95 (ms)": round(percentile(waits, 95) * 1000, 1) if waits else None,
+                    }
+                )
+            return rows
+
+
+@st.cache_resource
+def llm_scheduler() -> LlmScheduler:
+    return LlmScheduler()
+
+
+def _release_when_done(chunks, ticket: Dict[str, Any]):
+    try:
+        yield from chunks
+    finally:
+        llm_scheduler().release(ticket)
+
+
+async def _arelease_when_done(chunks, ticket: Dict[str, Any]):
+    try:
+        async for text in chunks:
+            yield text
+    finally:
+        llm_scheduler().release(ticket)
+
+
+def _call_provider(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """Blocking completion; returns (text, usage). Waits for a scheduler slot first.
+
+    Under a cancel scope the call is made as a stream, so Stop can abort it for
+    every provider.
+    """
+    if current_cancel_scope() is not None:
+        usage: Dict[str, int] = {}
+        api_key = get_api_keys().get(detect_provider(model), "")
+        chunks, _ = open_llm_stream(prompt, system_prompt, model, max_tokens, api_key, history, usage)
+        return "".join(chunks), usage
+    with llm_scheduler().slot(provider=detect_provider(model)):
+        return _call_provider_cassette(prompt, system_prompt, model, max_tokens, history)
+
+
+def open_llm_stream(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    history: Optional[List[Dict[str, str]]] = None,
+    usage: Optional[Dict[str, int]] = None,
+) -> Tuple[Any, Callable[[], None]]:
+    """Start a streaming completion.
+
+    Returns (chunks, close): an iterator of text pieces and a callable that
+    aborts the underlying HTTP stream. close may be called from another thread.
+    The key is passed in because worker threads cannot read st.session_state.
+    If usage is given it is filled with token counts once the stream ends.
+    Waits for a scheduler slot, which is held until the stream ends or closes.
+    """
+    scheduler = llm_scheduler()
+    scope = current_cancel_scope()
+    ticket = scheduler.submit(*scheduler._defaults(None, None), provider=detect_provider(model))
+    try:
+        while not ticket["granted"].wait(0.1):
+            if scope is not None and scope.cancelled.is_set():
+                raise LlmCancelledError(scope.partial)
+        chunks, close = _open_llm_stream_cassette(prompt, system_prompt, model, max_tokens, api_key, history, usage)
+    except BaseException:
+        scheduler.release(ticket)
+        raise
+    if scope is not None:
+        chunks = _cancellable_chunks(chunks, scope)
+    chunks = _release_when_done(chunks, ticket)
+    # A stream that is never iterated still gives its slot back once dropped.
+    weakref.finalize(chunks, scheduler.release, ticket)
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            scheduler.release(ticket)
+
+    if scope is not None:
+        scope.register(close_and_release)
+    return chunks, close_and_release
+
+
+async def _aopen_llm_stream(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    history: Optional[List[Dict[str, str]]],
+    usage: Dict[str, int],
+):
+    """Async twin of open_llm_stream. Returns (async iterator of text, async close)."""
+    scheduler = llm_scheduler()
+    ticket = await scheduler.aslot_acquire(provider=detect_provider(model))
+    try:
+        chunks, close = await _aopen_llm_stream_cassette(
+            prompt, system_prompt, model, max_tokens, api_key, history, usage
+        )
+    except BaseException:
+        scheduler.release(ticket)
+        raise
+    chunks = _arelease_when_done(chunks, ticket)
+    weakref.finalize(chunks, scheduler.release, ticket)
+
+    async def close_and_release():
+        try:
+            await close()
+        finally:
+            scheduler.release(ticket)
+
+    return chunks, close_and_release
+
+
+# =========================
+# Provider Cassettes
+# =========================
+
+class CassetteMissError(RuntimeError):
+    """Replay mode found no recording for a request."""
+
+
+class CassetteStore:
+    """One JSON file per distinct provider request, holding the response and its timing.
+
+    A cassette has the total latency, the text, the provider usage and, for
+    streamed calls, [seconds_since_start, text] chunks. Either kind can replay
+    a streamed or blocking call.
+    """
+
+    def __init__(self, directory: str, mode: str = "off", speed: float = 1.0):
+        self.directory = directory
+        self.mode = mode
+        self.speed = speed
+
+    def key(self, prompt, system_prompt, model, max_tokens, history) -> str:
+        return cache_key(detect_provider(model), model, system_prompt, prompt, history or [], max_tokens)
+
+    def path(self, model: str, key: str) -> str:
+        safe_model = re.sub(r"[^A-Za-z0-9._-]", "_", model)
+        return os.path.join(self.directory, f"{safe_model}-{key[:16]}.json")
+
+    def load(self, model: str, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path(model, key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, model: str, key: str, request: Dict[str, Any], response: Dict[str, Any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path(model, key) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"request": request, "response": response}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path(model, key))
+
+    def lookup(self, model: str, key: str) -> Optional[Dict[str, Any]]:
+        """Recorded response to replay, None to go live; raises in strict replay mode."""
+        if self.mode not in ("replay", "auto"):
+            return None
+        cassette = self.load(model, key)
+        if cassette is None and self.mode == "replay":
+            raise CassetteMissError(f"No cassette for this {model} request in {self.directory}.")
+        return cassette["response"] if cassette else None
+
+    def recording(self) -> bool:
+        return self.mode in ("record", "auto")
+
+    def delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed > 0 else 0.0
+
+
+@st.cache_resource
+def cassettes() -> CassetteStore:
+    return CassetteStore(LLM_CASSETTE_DIR, LLM_CASSETTE_MODE, LLM_CASSETTE_SPEED)
+
+
+def _cassette_request(prompt, system_prompt, model, max_tokens, history) -> Dict[str, Any]:
+    return {
+        "model": model,
+        "system_prompt": system_prompt,
+        "prompt": prompt,
+        "history": history or [],
+        "max_tokens": max_tokens,
+    }
+
+
+def _replay_chunks(response: Dict[str, Any]) -> List[Tuple[float, str]]:
+    chunks = response.get("chunks")
+    if chunks:
+        return [(float(t), text) for t, text in chunks]
+    return [(float(response.get("latency_s", 0.0)), response.get("text", ""))]
+
+
+def _call_provider_cassette(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """Blocking completion through the cassette store (when enabled) and breaker."""
+    store = cassettes()
+    if store.mode == "off":
+        with guarded_call(detect_provider(model)):
+            return _call_provider_live(prompt, system_prompt, model, max_tokens, history)
+    key = store.key(prompt, system_prompt, model, max_tokens, history)
+    recorded = store.lookup(model, key)
+    if recorded is not None:
+        time.sleep(store.delay(recorded.get("latency_s", 0.0)))
+        return recorded.get("text", ""), dict(recorded.get("usage") or {})
+    start = time.perf_counter()
+    with guarded_call(detect_provider(model)):
+        text, usage = _call_provider_live(prompt, system_prompt, model, max_tokens, history)
+    if store.recording():
+        store.save(
+            model,
+            key,
+            _cassette_request(prompt, system_prompt, model, max_tokens, history),
+            {"latency_s": time.perf_counter() - start, "text": text, "usage": usage},
+        )
+    return text, usage
+
+
+def _open_llm_stream_cassette(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    history: Optional[List[Dict[str, str]]] = None,
+    usage: Optional[Dict[str, int]] = None,
+) -> Tuple[Any, Callable[[], None]]:
+    """Streaming completion through the cassette store (when enabled) and breaker."""
+    usage = {} if usage is None else usage
+    store = cassettes()
+
+    def live():
+        return guarded_stream(
+            detect_provider(model),
+            lambda: _open_llm_stream_live(prompt, system_prompt, model, max_tokens, api_key, history, usage),
+        )
+
+    if store.mode == "off":
+        return live()
+    key = store.key(prompt, system_prompt, model, max_tokens, history)
+    recorded = store.lookup(model, key)
+    if recorded is not None:
+        stopped = threading.Event()
+
+        def replay():
+            start = time.perf_counter()
+            for offset, text in _replay_chunks(recorded):
+                wait = store.delay(offset) - (time.perf_counter() - start)
+                if wait > 0 and stopped.wait(wait):
+                    return
+                if stopped.is_set():
+                    return
+                yield text
+            usage.update(recorded.get("usage") or {})
+
+        return replay(), stopped.set
+
+    start = time.perf_counter()
+    chunks, close = live()
+    if not store.recording():
+        return chunks, close
+
+    def record():
+        timed: List[List[Any]] = []
+        for text in chunks:
+            timed.append([time.perf_counter() - start, text])
+            yield text
+        store.save(
+            model,
+            key,
+            _cassette_request(prompt, system_prompt, model, max_tokens, history),
+            {
+                "latency_s": time.perf_counter() - start,
+                "text": "".join(t for _, t in timed),
+                "usage": dict(usage),
+                "chunks": timed,
+            },
+        )
+
+    return record(), close
+
+
+async def _aopen_llm_stream_cassette(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    history: Optional[List[Dict[str, str]]],
+    usage: Dict[str, int],
+):
+    """Async twin of _open_llm_stream_cassette."""
+    store = cassettes()
+
+    async def live():
+        return await aguarded_stream(
+            detect_provider(model),
+            lambda: _aopen_llm_stream_live(prompt, system_prompt, model, max_tokens, api_key, history, usage),
+        )
+
+    if store.mode == "off":
+        return await live()
+    key = store.key(prompt, system_prompt, model, max_tokens, history)
+    recorded = store.lookup(model, key)
+    if recorded is not None:
+
+        async def replay():
+            start = time.perf_counter()
+            for offset, text in _replay_chunks(recorded):
+                wait = store.delay(offset) - (time.perf_counter() - start)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                yield text
+            usage.update(recorded.get("usage") or {})
+
+        async def close():
+            pass
+
+        return replay(), close
+
+    start = time.perf_counter()
+    chunks, close = await live()
+    if not store.recording():
+        return chunks, close
+
+    async def record():
+        timed: List[List[Any]] = []
+        async for text in chunks:
+            timed.append([time.perf_counter() - start, text])
+            yield text
+        store.save(
+            model,
+            key,
+            _cassette_request(prompt, system_prompt, model, max_tokens, history),
+            {
+                "latency_s": time.perf_counter() - start,
+                "text": "".join(t for _, t in timed),
+                "usage": dict(usage),
+                "chunks": timed,
+            },
+        )
+
+    return record(), close
+
+
+# =========================
+# LLM Telemetry
+# =========================
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+class Telemetry:
+    """Rolling window of recent calls per model, kept in shared state so every process sees it."""
+
+    def __init__(self, state, window: int = TELEMETRY_WINDOW):
+        self.state = state
+        self.window = window
+        self._read: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        model: str,
+        latency_s: float,
+        ok: bool,
+        output_chars: int = 0,
+        ttft_s: Optional[float] = None,
+    ) -> None:
+        entry = {
+            "ts": time.time(),
+            "latency_s": latency_s,
+            "ok": ok,
+            "output_chars": output_chars,
+            "ttft_s": ttft_s,
+        }
+        self.state.add_event(f"telemetry:{model}", entry, self.window)
+        with self._lock:
+            self._read.pop(model, None)
+
+    def calls(self, model: str) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._read.get(model)
+            if cached and now - cached[0] < TELEMETRY_REFRESH_S:
+                return cached[1]
+        calls = self.state.events(f"telemetry:{model}", self.window)
+        with self._lock:
+            self._read[model] = (now, calls)
+        return calls
+
+    def stats(self, model: str) -> Dict[str, Any]:
+        calls = self.calls(model)
+        latencies = [c["latency_s"] for c in calls if c["ok"]]
+        errors = sum(1 for c in calls if not c["ok"])
+        return {
+            "calls": len(calls),
+            "error_rate": errors / len(calls) if calls else 0.0,
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "avg_output_chars": sum(c["output_chars"] for c in calls if c["ok"]) / len(latencies)
+            if latencies
+            else None,
+        }
+
+    def ttft_percentile(self, model: str, q: float) -> Tuple[Optional[float], int]:
+        """Percentile of time-to-first-token over streamed calls, and the sample count."""
+        samples = [c["ttft_s"] for c in self.calls(model) if c["ok"] and c["ttft_s"] is not None]
+        return percentile(samples, q), len(samples)
+
+    def models(self) -> List[str]:
+        return [s.split(":", 1)[1] for s in self.state.streams() if s.startswith("telemetry:")]
+
+    def record_cancelled(self, model: str, elapsed_s: float, output_chars: int) -> None:
+        """A call stopped by the user or a departed client; kept apart from success/error stats."""
+        entry = {"ts": time.time(), "model": model, "elapsed_s": elapsed_s, "output_chars": output_chars}
+        self.state.add_event("cancellations", entry, self.window)
+
+    def cancellations(self) -> List[Dict[str, Any]]:
+        return self.state.events("cancellations", self.window)
+
+
+@st.cache_resource
+def telemetry() -> Telemetry:
+    return Telemetry(shared_state())
+
+
+# =========================
+# Token & Cost Accounting
+# =========================
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+def model_prices() -> Dict[str, Tuple[float, float]]:
+    """MODEL_PRICES, then prices declared in PROVIDERS_FILE, then MODEL_PRICES_FILE overrides."""
+    prices = dict(MODEL_PRICES)
+    for model, spec in provider_registry().models().items():
+        if "input" in spec or "output" in spec:
+            prices[model] = (float(spec.get("input", 0)), float(spec.get("output", 0)))
+    prices.update(_price_overrides())
+    return prices
+
+
+@st.cache_resource
+def _price_overrides() -> Dict[str, Tuple[float, float]]:
+    prices: Dict[str, Tuple[float, float]] = {}
+    if os.path.exists(MODEL_PRICES_FILE):
+        try:
+            with open(MODEL_PRICES_FILE, "r", encoding="utf-8") as f:
+                data = yaml.load(f, Loader=YAML_LOADER) or {}
+            for model, price in data.items():
+                if isinstance(price, dict):
+                    prices[model] = (float(price["input"]), float(price["output"]))
+                else:
+                    prices[model] = (float(price[0]), float(price[1]))
+        except Exception:
+            pass
+    return prices
+
+
+_USAGE_SCOPE: contextvars.ContextVar = contextvars.ContextVar("usage_scope", default=None)
+
+
+@contextmanager
+def usage_scope(**context: Any):
+    """Attribute calls on this thread to e.g. agent=... / session_id=... for accounting.
+
+    Worker threads re-enter the caller's current_usage_context() so that the
+    session's budget settings also apply there.
+    """
+    token = _USAGE_SCOPE.set({**(_USAGE_SCOPE.get() or {}), **context})
+    try:
+        yield
+    finally:
+        _USAGE_SCOPE.reset(token)
+
+
+def current_usage_context() -> Dict[str, Any]:
+    context = dict(_USAGE_SCOPE.get() or {})
+    if "session_id" not in context:
+        try:
+            context["session_id"] = st.session_state.get("session_id", "")
+            context["budget"] = dict(st.session_state.get("budget") or {})
+        except Exception:
+            context["session_id"] = ""
+    context.setdefault("agent", "")
+    return context
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    # Never store keys; a short hash is enough to aggregate per key.
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12] if api_key else ""
+
+
+class UsageLedger:
+    """Per-call token/cost records in SQLite, aggregated on demand."""
+
+    DIMENSIONS = ("agent", "session_id", "key_hash", "day", "model")
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    ts REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    session_id TEXT,
+                    agent TEXT,
+                    model TEXT,
+                    key_hash TEXT,
+                    input_tokens INTEGER,
+                    output_tokens INTEGER,
+                    cost_usd REAL,
+                    exact INTEGER
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS usage_session ON usage(session_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS usage_key_day ON usage(key_hash, day)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS usage_day ON usage(day)")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS reservations (
+                    id INTEGER PRIMARY KEY,
+                    day TEXT NOT NULL,
+                    session_id TEXT,
+                    key_hash TEXT,
+                    cost_usd REAL NOT NULL,
+                    expires REAL NOT NULL
+                )
+                """
+            )
+
+    def add(self, entry: Dict[str, Any], reservation: Optional[int] = None) -> None:
+        """Record one call; the call's reservation (if any) is settled in the same transaction."""
+        with self._lock, self._conn:
+            if reservation:
+                self._conn.execute("DELETE FROM reservations WHERE id = ?", (reservation,))
+            self._conn.execute(
+                "INSERT INTO usage (ts, day, session_id, agent, model, key_hash, input_tokens, "
+                "output_tokens, cost_usd, exact) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry["ts"], entry["day"], entry["session_id"], entry["agent"], entry["model"],
+                    entry["key_hash"], entry["input_tokens"], entry["output_tokens"], entry["cost_usd"],
+                    int(entry["exact"]),
+                ),
+            )
+
+    def reserve(
+        self, cost: float, session_id: str, session_limit: float, key_hash: str, key_limit: float
+    ) -> Optional[int]:
+        """Hold cost against the session and key/day budgets; None (nothing held) if either would be exceeded.
+
+        Check and hold happen in one write transaction, so concurrent callers,
+        in this process or another, each see the others' holds.
+        """
+        now = time.time()
+        day = time.strftime("%Y-%m-%d")
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM reservations WHERE expires < ?", (now,))
+            for where, params, limit in (
+                ("session_id = ?", (session_id,), session_limit),
+                ("key_hash = ? AND day = ?", (key_hash, day), key_limit),
+            ):
+                if not params[0]:
+                    continue
+                committed = sum(
+                    self._conn.execute(f"SELECT COALESCE(SUM(cost_usd), 0) FROM {table} WHERE {where}", params)
+                    .fetchone()[0]
+                    for table in ("usage", "reservations")
+                )
+                if committed + cost > limit:
+                    return None
+            cur = self._conn.execute(
+                "INSERT INTO reservations (day, session_id, key_hash, cost_usd, expires) VALUES (?, ?, ?, ?, ?)",
+                (day, session_id, key_hash, cost, now + BUDGET_RESERVATION_TTL_S),
+            )
+            return cur.lastrowid
+
+    def release(self, reservation: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM reservations WHERE id = ?", (reservation,))
+
+    def spent(self, session_id: Optional[str] = None, key_hash: Optional[str] = None, day: Optional[str] = None) -> float:
+        where, params = [], []
+        for column, value in (("session_id", session_id), ("key_hash", key_hash), ("day", day)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        sql = "SELECT COALESCE(SUM(cost_usd), 0) FROM usage"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    def totals(self, by: str, day: Optional[str] = None) -> List[Dict[str, Any]]:
+        if by not in self.DIMENSIONS:
+            raise ValueError(f"Unknown usage dimension: {by}")
+        sql = (
+            f"SELECT {by} AS name, COUNT(*) AS calls, SUM(input_tokens) AS input_tokens, "
+            f"SUM(output_tokens) AS output_tokens, ROUND(SUM(cost_usd), 6) AS cost_usd FROM usage"
+        )
+        params: List[Any] = []
+        if day:
+            sql += " WHERE day = ?"
+            params.append(day)
+        sql += f" GROUP BY {by} ORDER BY cost_usd DESC"
+        with self._lock:
+            cur = self._conn.execute(sql, params)
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, row)) for row in cur]
+
+
+@st.cache_resource
+def usage_ledger() -> UsageLedger:
+    return UsageLedger(RUN_HISTORY_DB)
+
+
+def record_usage(
+    model: str,
+    usage: Dict[str, int],
+    input_tokens_estimate: int,
+    output: str,
+    api_key: Optional[str] = None,
+    reservation: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Price one call and add it to the ledger; returns the fields to merge into meta.
+
+    Provider counts are used when present, otherwise the ~4 chars/token estimate.
+    reservation (from reserve_budget) is settled: replaced by the actual cost.
+    """
+    exact = "output_tokens" in usage
+    input_tokens = usage.get("input_tokens", input_tokens_estimate)
+    output_tokens = usage.get("output_tokens", estimate_tokens(output))
+    cost = estimate_cost_usd(model, input_tokens, output_tokens)
+    if api_key is None:
+        api_key = get_api_keys().get(detect_provider(model))
+    context = current_usage_context()
+    try:
+        usage_ledger().add(
+            {
+                "ts": time.time(),
+                "day": time.strftime("%Y-%m-%d"),
+                "session_id": context["session_id"],
+                "agent": context["agent"],
+                "model": model,
+                "key_hash": key_fingerprint(api_key),
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cost_usd": cost,
+                "exact": exact,
+            },
+            reservation,
+        )
+    except sqlite3.Error:
+        pass
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_usd": cost,
+        "usage_exact": exact,
+        "truncated": bool(usage.get("truncated")),
+    }
+
+
+def current_budget() -> Dict[str, Any]:
+    return dict(current_usage_context().get("budget") or {})
+
+
+def reserve_budget(model: str, input_tokens: int, max_tokens: int) -> Optional[int]:
+    """Reserve a worst-case call (full max_tokens output) against the session and key budgets.
+
+    Returns the reservation to pass to record_usage/release_budget, or None if the call does not fit.
+    """
+    context = current_usage_context()
+    cost = estimate_cost_usd(model, input_tokens, max_tokens)
+    return usage_ledger().reserve(
+        cost,
+        context["session_id"],
+        current_budget().get("session_usd", SESSION_BUDGET_USD),
+        key_fingerprint(get_api_keys().get(detect_provider(model))),
+        KEY_DAILY_BUDGET_USD,
+    )
+
+
+def release_budget(reservation: Optional[int]) -> None:
+    """Drop a reservation whose call was not recorded (failed before any usage); no-op once settled."""
+    if reservation:
+        try:
+            usage_ledger().release(reservation)
+        except sqlite3.Error:
+            pass
+
+
+def enforce_budget(model: str, input_tokens: int, max_tokens: int) -> Tuple[str, int]:
+    """(model to use, its budget reservation) under the current budgets, or raise BudgetExceededError.
+
+    The caller must settle the reservation with record_usage or release_budget.
+    """
+    reservation = reserve_budget(model, input_tokens, max_tokens)
+    if reservation is not None:
+        return model, reservation
+    if current_budget().get("action", BUDGET_ACTIONS[0]) == "downgrade":
+        keys = get_api_keys()
+        cheaper = sorted(
+            (m for m in model_options() if keys.get(detect_provider(m)) and m in model_prices()),
+            key=lambda m: estimate_cost_usd(m, input_tokens, max_tokens),
+        )
+        for candidate in cheaper:
+            reservation = reserve_budget(candidate, input_tokens, max_tokens)
+            if reservation is not None:
+                return candidate, reservation
+    raise BudgetExceededError(
+        f"Budget exceeded: a call to {model} could cost up to "
+        f"${estimate_cost_usd(model, input_tokens, max_tokens):.4f}."
+    )
+
+
+# =========================
+# Auto Model Routing
+# =========================
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for routing and budgeting.
+    return len(text or "") // 4 + 1
+
+
+def history_tokens(history: Optional[List[Dict[str, str]]]) -> int:
+    return sum(estimate_tokens(m["content"]) for m in history or [])
+
+
+def model_price(model: str) -> Tuple[float, float]:
+    """Known price, free for keyless (local) providers, otherwise the conservative UNPRICED_MODEL_PRICE."""
+    price = model_prices().get(model)
+    if price is not None:
+        return price
+    try:
+        if not provider_config(detect_provider(model)).get("key_env"):
+            return 0.0, 0.0
+    except UnknownProviderError:
+        pass
+    return UNPRICED_MODEL_PRICE
+
+
+def estimate_cost_usd(model: str, input_tokens: int, output_tokens: int) -> float:
+    price = model_price(model)
+    return (input_tokens * price[0] + output_tokens * price[1]) / 1_000_000
+
+
+def required_tier(input_tokens: int, tags: Optional[List[str]]) -> int:
+    tier = 1
+    for limit, size_tier in ROUTER_PROMPT_TIERS:
+        if limit is None or input_tokens <= limit:
+            tier = size_tier
+            break
+    for tag in tags or []:
+        tier = max(tier, ROUTER_TAG_MIN_TIER.get(str(tag).lower(), 1))
+    return tier
+
+
+def route_models(
+    prompt: str,
+    system_prompt: Optional[str],
+    max_tokens: int,
+    tags: Optional[List[str]] = None,
+    policy: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> List[str]:
+    """Rank usable models for one request, best first.
+
+    Models are usable when their provider has a key and a closed circuit breaker
+    and their recent error rate is below ROUTER_MAX_ERROR_RATE. Models meeting the policy constraint and the
+    required tier come first; the rest follow as fallbacks.
+    """
+    policy = {**ROUTER_DEFAULT_POLICY, **(policy or {})}
+    keys = get_api_keys()
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + history_tokens(history)
+    tier = required_tier(input_tokens, tags)
+    tel = telemetry()
+    health = provider_health()
+
+    scored = []
+    for model in model_options():
+        profile = model_profile(model)
+        provider = detect_provider(model)
+        if not keys.get(provider) or input_tokens + max_tokens > profile["context"]:
+            continue
+        if not health.available(provider):
+            continue
+        stats = tel.stats(model)
+        if stats["calls"] >= 3 and stats["error_rate"] >= ROUTER_MAX_ERROR_RATE:
+            continue
+        expected_out = (
+            int(stats["avg_output_chars"] // 4) if stats["avg_output_chars"] else max_tokens // 4
+        )
+        cost = estimate_cost_usd(model, input_tokens, min(expected_out, max_tokens))
+        # Latency limits only apply to measured models; unmeasured ones rank after
+        # every measured model on speed rather than counting as instant.
+        p95 = stats["p95_s"]
+        unmeasured = p95 is None
+        if policy["policy"] == "fastest":
+            meets = cost <= policy["max_cost_usd"]
+            key = (unmeasured, p95 or 0.0, cost)
+        else:
+            meets = unmeasured or p95 <= policy["max_p95_s"]
+            key = (cost, unmeasured, p95 or 0.0)
+        scored.append((profile["tier"] < tier, not meets, key, model))
+    scored.sort()
+    return [model for *_, model in scored]
+
+
+# =========================
+# Streaming Calls
+# =========================
+
+def stream_llm(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    meta: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    tags: Optional[List[str]] = None,
+    policy: Optional[Dict[str, Any]] = None,
+):
+    """Generator counterpart of call_llm: yields text pieces as they arrive.
+
+    Applies routing and budgets up front and records telemetry and usage when
+    the stream ends, fails, or the consumer stops iterating early (which
+    closes the provider stream).
+    """
+    meta = {} if meta is None else meta
+    if model == AUTO_MODEL:
+        candidates = route_models(prompt, system_prompt, max_tokens, tags=tags, policy=policy, history=history)
+        if not candidates:
+            raise MissingAPIKeyError("No model available for automatic routing; configure an API key.")
+        model = candidates[0]
+        meta["candidates"] = candidates
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + history_tokens(history)
+    requested = model
+    model, reservation = enforce_budget(model, input_tokens, max_tokens)
+    if model != requested:
+        meta["downgraded_from"] = requested
+    provider = detect_provider(model)
+    api_key = get_api_keys().get(provider)
+    meta.update({"model": model, "provider": provider})
+
+    usage: Dict[str, int] = {}
+    pieces: List[str] = []
+    start = time.perf_counter()
+    try:
+        chunks, close = open_llm_stream(prompt, system_prompt, model, max_tokens, api_key, history, usage)
+    except BaseException:
+        release_budget(reservation)
+        raise
+    completed = False
+    try:
+        for text in chunks:
+            if "ttft_s" not in meta:
+                meta["ttft_s"] = time.perf_counter() - start
+            pieces.append(text)
+            yield text
+        completed = True
+    except (GeneratorExit, LlmCancelledError):
+        close()
+        meta["stopped"] = True
+        raise
+    except Exception:
+        telemetry().record(model, time.perf_counter() - start, ok=False)
+        raise
+    finally:
+        output = "".join(pieces)
+        meta["latency_s"] = time.perf_counter() - start
+        if completed:
+            telemetry().record(
+                model, meta["latency_s"], ok=True, output_chars=len(output), ttft_s=meta.get("ttft_s")
+            )
+        elif meta.get("stopped"):
+            telemetry().record_cancelled(model, meta["latency_s"], len(output))
+        meta.update(record_usage(model, usage, input_tokens, output, api_key=api_key, reservation=reservation))
+
+
+async def _aopen_llm_stream_live(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    history: Optional[List[Dict[str, str]]],
+    usage: Dict[str, int],
+):
+    """Async twin of open_llm_stream using each SDK's async client.
+
+    Returns (async iterator of text, async close).
+    """
+    provider = detect_provider(model)
+    if not api_key:
+        raise MissingAPIKeyError(f"No API key available for provider '{provider}'.")
+    api = provider_api(provider)
+
+    if api == "gemini":
+        genai.configure(api_key=api_key)
+        gm = genai.GenerativeModel(model)
+        resp = await gm.generate_content_async(
+            _gemini_contents(prompt, system_prompt, history),
+            generation_config={"max_output_tokens": max_tokens or 1024},
+            stream=True,
+            **_gemini_options(provider),
+        )
+
+        async def gemini_chunks():
+            async for chunk in resp:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue
+                if text:
+                    yield text
+            usage.update(_usage_from_response("gemini", resp))
+
+        async def gemini_close():
+            _gemini_cancel(resp)
+
+        return gemini_chunks(), gemini_close
+
+    if api == "openai":
+        client = aprovider_client(provider, api_key)
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=_chat_messages(prompt, system_prompt, history),
+            max_tokens=max_tokens or 1024,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+
+        async def openai_chunks():
+            async for ev in stream:
+                if ev.choices and ev.choices[0].delta.content:
+                    yield ev.choices[0].delta.content
+                if _stopped_at_limit(api, ev):
+                    usage["truncated"] = 1
+                if getattr(ev, "usage", None) is not None:
+                    usage.update(_usage_from_response(api, ev))
+
+        return openai_chunks(), stream.close
+
+    if api == "anthropic":
+        client = aprovider_client(provider, api_key)
+        stream = await client.messages.stream(
+            **_anthropic_kwargs(prompt, system_prompt, model, max_tokens, history)
+        ).__aenter__()
+
+        async def anthropic_chunks():
+            async for text in stream.text_stream:
+                yield text
+            usage.update(_usage_from_response("anthropic", await stream.get_final_message()))
+
+        return anthropic_chunks(), stream.close
+
+    raise RuntimeError(f"Unsupported provider: {provider}")
+
+
+async def astream_llm(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    meta: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    tags: Optional[List[str]] = None,
+    policy: Optional[Dict[str, Any]] = None,
+):
+    """Async generator counterpart of stream_llm for event-loop servers (see api.py).
+
+    Ledger writes (budget reservation, usage) run in a worker thread: they can
+    wait on SQLite's write lock, which must not stall the event loop.
+    """
+    meta = {} if meta is None else meta
+    if model == AUTO_MODEL:
+        candidates = route_models(prompt, system_prompt, max_tokens, tags=tags, policy=policy, history=history)
+        if not candidates:
+            raise MissingAPIKeyError("No model available for automatic routing; configure an API key.")
+        model = candidates[0]
+        meta["candidates"] = candidates
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + history_tokens(history)
+    requested = model
+    model, reservation = await asyncio.to_thread(enforce_budget, model, input_tokens, max_tokens)
+    if model != requested:
+        meta["downgraded_from"] = requested
+    provider = detect_provider(model)
+    api_key = get_api_keys().get(provider)
+    meta.update({"model": model, "provider": provider})
+
+    usage: Dict[str, int] = {}
+    pieces: List[str] = []
+    start = time.perf_counter()
+    try:
+        chunks, close = await _aopen_llm_stream(prompt, system_prompt, model, max_tokens, api_key, history, usage)
+    except BaseException:
+        await asyncio.shield(asyncio.to_thread(release_budget, reservation))
+        raise
+    completed = False
+    try:
+        async for text in chunks:
+            if "ttft_s" not in meta:
+                meta["ttft_s"] = time.perf_counter() - start
+            pieces.append(text)
+            yield text
+        completed = True
+    except (GeneratorExit, asyncio.CancelledError):
+        await close()
+        meta["stopped"] = True
+        raise
+    except Exception:
+        telemetry().record(model, time.perf_counter() - start, ok=False)
+        raise
+    finally:
+        output = "".join(pieces)
+        meta["latency_s"] = time.perf_counter() - start
+        if completed:
+            telemetry().record(
+                model, meta["latency_s"], ok=True, output_chars=len(output), ttft_s=meta.get("ttft_s")
+            )
+        elif meta.get("stopped"):
+            telemetry().record_cancelled(model, meta["latency_s"], len(output))
+        meta.update(
+            await asyncio.shield(
+                asyncio.to_thread(
+                    record_usage, model, usage, input_tokens, output, api_key=api_key, reservation=reservation
+                )
+            )
+        )
+
+
+class SummarySectionParser:
+    """Incrementally split streamed Markdown into SUMMARY_SECTIONS.
+
+    Only complete lines are examined, so total work is linear in the output.
+    A section is finished when the next recognised heading starts or the
+    stream ends. Text without any recognised heading degrades to a single
+    "Summary" section.
+    """
+
+    _HEADING_RE = re.compile(r"^\s*(?:#{1,6}\s*)?(\*\*)?\s*(?:\d+[.)]\s*)?([^*#:]{3,60}?)\s*:?\s*(\*\*)?\s*:?\s*$")
+
+    def __init__(self, sections: Dict[str, Tuple[str, ...]] = SUMMARY_SECTIONS):
+        self.sections = sections
+        self.finished: List[Dict[str, Any]] = []
+        self.title: Optional[str] = None
+        self._lines: List[str] = []
+        self._pending = ""
+
+    def _match_heading(self, line: str) -> Optional[str]:
+        stripped = line.strip()
+        looks_like_heading = stripped.startswith("#") or (
+            stripped.startswith("**") and stripped.rstrip(":").endswith("**")
+        ) or (stripped.endswith(":") and len(stripped) <= 40)
+        if not looks_like_heading:
+            return None
+        m = self._HEADING_RE.match(line)
+        if not m:
+            return None
+        norm = re.sub(r"[^a-z]", "", m.group(2).lower())
+        for title, keywords in self.sections.items():
+            if title not in self._seen() and any(norm.startswith(k) for k in keywords):
+                return title
+        return None
+
+    def _seen(self) -> List[str]:
+        return [s["title"] for s in self.finished] + ([self.title] if self.title else [])
+
+    def _close_current(self, out: List[Dict[str, Any]]) -> None:
+        content = "\n".join(self._lines).strip()
+        if self.title is not None or content:
+            section = {"title": self.title or "Summary", "content": content}
+            if self.title is None:
+                section["unstructured"] = True
+            self.finished.append(section)
+            out.append(section)
+        self._lines = []
+
+    def _line(self, line: str, out: List[Dict[str, Any]]) -> None:
+        title = self._match_heading(line)
+        if title is None:
+            self._lines.append(line)
+            return
+        if self.title is None and not "\n".join(self._lines).strip():
+            self._lines = []
+        else:
+            self._close_current(out)
+        self.title = title
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        self._pending += chunk
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            self._line(line, out)
+        return out
+
+    def finish(self) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        if self._pending:
+            self._line(self._pending, out)
+            self._pending = ""
+        self._close_current(out)
+        self.title = None
+        return out
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        """The section being written right now (content may end mid-line)."""
+        if self.title is None and not self._lines and not self._pending:
+            return None
+        content = "\n".join(self._lines + [self._pending]).strip()
+        return {"title": self.title or "Summary", "content": content}
+
+    def missing(self) -> List[str]:
+        """Expected sections never seen; empty when the output had no structure at all."""
+        seen = self._seen()
+        if not any(t in self.sections for t in seen):
+            return []
+        return [t for t in self.sections if t not in seen]
+
+
+def sections_to_markdown(sections: List[Dict[str, Any]], missing: Optional[List[str]] = None) -> str:
+    parts = [f"## {s['title']}\n\n{s['content']}" for s in sections]
+    parts.extend(f"## {t}\n\n_(not provided)_" for t in missing or [])
+    return "\n\n".join(parts).strip()
+
+
+# =========================
+# Hedged Requests
+# =========================
+
+class StreamRun:
+    """One streaming completion consumed on a background thread.
+
+    notify is set on first token and on completion so a waiter can watch
+    several runs at once. reservation (from reserve_budget) is settled by record().
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_tokens: int,
+        api_key: str,
+        notify: Optional[threading.Event] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        reservation: Optional[int] = None,
+    ):
+        self.model = model
+        self.reservation = reservation
+        self.chunks: List[str] = []
+        self.error: Optional[Exception] = None
+        self.cancelled = False
+        self.ttft_s: Optional[float] = None
+        self.latency_s: Optional[float] = None
+        self.first_token = threading.Event()
+        self.done = threading.Event()
+        self._notify = notify or threading.Event()
+        self._close: Optional[Callable[[], None]] = None
+        self.usage: Dict[str, int] = {}
+        self.input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + history_tokens(history)
+        self.api_key = api_key
+        self._args = (prompt, system_prompt, model, max_tokens, api_key, history, self.usage)
+        # The thread has no session; carry the caller's usage, scheduling and cancel context over.
+        self._context = current_usage_context()
+        self._cancel_scope = current_cancel_scope()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "StreamRun":
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        # A child scope, so a user stop reaches this run without mixing its text
+        # with a competing hedge run in the parent's partial output.
+        child = None
+        if self._cancel_scope is not None:
+            child = CancelScope()
+            self._cancel_scope.register(child.cancel)
+        with usage_scope(**self._context), cancel_scope(child):
+            self._consume()
+
+    def _consume(self) -> None:
+        try:
+            chunks, self._close = open_llm_stream(*self._args)
+            for text in chunks:
+                if self.cancelled:
+                    break
+                if self.ttft_s is None:
+                    self.ttft_s = time.perf_counter() - self._started
+                    self.first_token.set()
+                    self._notify.set()
+                self.chunks.append(text)
+        except Exception as e:
+            if not self.cancelled:
+                self.error = e
+        finally:
+            if self.cancelled:
+                self._safe_close()
+            self.latency_s = time.perf_counter() - self._started
+            self.done.set()
+            self._notify.set()
+
+    def _safe_close(self) -> None:
+        try:
+            if self._close is not None:
+                self._close()
+        except Exception:
+            pass
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self._safe_close()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    @property
+    def responded(self) -> bool:
+        """Produced a token, or finished cleanly with an empty answer."""
+        return self.first_token.is_set() or (self.done.is_set() and self.error is None and not self.cancelled)
+
+    def record(self) -> Dict[str, Any]:
+        if isinstance(self.error, MissingAPIKeyError):
+            release_budget(self.reservation)
+            return {}
+        # Cancelled runs may still have been billed for what they produced.
+        accounted = record_usage(
+            self.model, self.usage, self.input_tokens, self.text, api_key=self.api_key, reservation=self.reservation
+        )
+        if self.cancelled:
+            return accounted
+        if isinstance(self.error, LlmCancelledError):
+            telemetry().record_cancelled(self.model, self.latency_s or 0.0, len(self.text))
+            return accounted
+        telemetry().record(
+            self.model,
+            self.latency_s or 0.0,
+            ok=self.error is None,
+            output_chars=len(self.text),
+            ttft_s=self.ttft_s,
+        )
+        return accounted
+
+
+class HedgeStats:
+    """Per-agent hedging counters and daily extra-cost budget.
+
+    One row per hedged-capable request in SQLite, so every worker process
+    shares the budget and the numbers survive restarts. A backup holds its
+    estimated cost when it launches; record() replaces that with the cost
+    actually billed.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS hedges (
+                    id INTEGER PRIMARY KEY,
+                    ts REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    agent TEXT NOT NULL,
+                    hedged INTEGER NOT NULL,
+                    backup_won INTEGER NOT NULL DEFAULT 0,
+                    cost_usd REAL NOT NULL DEFAULT 0
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS hedges_agent_day ON hedges(agent, day)")
+
+    def try_spend(self, agent_id: str, cost_usd: float, budget_usd: float) -> Optional[int]:
+        """Hold cost_usd against the agent's budget for today; the hold's id, or None if it does not fit."""
+        day = time.strftime("%Y-%m-%d")
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            spent = self._conn.execute(
+                "SELECT COALESCE(SUM(cost_usd), 0) FROM hedges WHERE agent = ? AND day = ?", (agent_id, day)
+            ).fetchone()[0]
+            if spent + cost_usd > budget_usd:
+                return None
+            return self._conn.execute(
+                "INSERT INTO hedges (ts, day, agent, hedged, cost_usd) VALUES (?, ?, ?, 1, ?)",
+                (time.time(), day, agent_id, cost_usd),
+            ).lastrowid
+
+    def record(
+        self, agent_id: str, hold: Optional[int] = None, backup_won: bool = False, cost_usd: float = 0.0
+    ) -> None:
+        """Count one request; for a hedged one (hold from try_spend), settle the backup's actual cost."""
+        with self._lock, self._conn:
+            if hold:
+                self._conn.execute(
+                    "UPDATE hedges SET backup_won = ?, cost_usd = ? WHERE id = ?", (int(backup_won), cost_usd, hold)
+                )
+            else:
+                self._conn.execute(
+                    "INSERT INTO hedges (ts, day, agent, hedged) VALUES (?, ?, ?, 0)",
+                    (time.time(), time.strftime("%Y-%m-%d"), agent_id),
+                )
+
+    def snapshot(self, day: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT agent, COUNT(*), SUM(hedged), SUM(backup_won), SUM(cost_usd) FROM hedges "
+                "WHERE day = ? GROUP BY agent ORDER BY agent",
+                (day or time.strftime("%Y-%m-%d"),),
+            ).fetchall()
+        return {
+            agent: {"requests": n, "hedged": hedged, "backup_wins": wins, "spent_usd": spent}
+            for agent, n, hedged, wins, spent in rows
+        }
+
+
+@st.cache_resource
+def hedge_stats() -> HedgeStats:
+    return HedgeStats(RUN_HISTORY_DB)
+
+
+def hedge_delay_s(model: str) -> float:
+    p, samples = telemetry().ttft_percentile(model, HEDGE_PERCENTILE)
+    if p is None or samples < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_S
+    return max(p, HEDGE_MIN_DELAY_S)
+
+
+def pick_backup_model(primary: str, candidates: List[str]) -> Optional[str]:
+    """Prefer a candidate on another provider, then any other model."""
+    others = [m for m in candidates if m != primary]
+    for m in others:
+        if detect_provider(m) != detect_provider(primary):
+            return m
+    return others[0] if others else None
+
+
+def call_llm_hedged(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    backup_model: Optional[str] = None,
+    agent_id: str = "",
+    hedge_budget_usd: float = HEDGE_BUDGET_USD,
+    tags: Optional[List[str]] = None,
+    policy: Optional[Dict[str, Any]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    """Stream from model; if no token arrives by hedge_delay_s, also ask backup_model.
+
+    Whichever run produces a token first wins and the other is cancelled. The
+    backup is only launched while the agent's daily hedge budget allows it.
+    """
+    meta = {} if meta is None else meta
+    keys = get_api_keys()
+    candidates = route_models(prompt, system_prompt, max_tokens, tags=tags, policy=policy, history=history)
+    if model == AUTO_MODEL:
+        if not candidates:
+            raise MissingAPIKeyError("No model available for automatic routing; configure an API key.")
+        model = candidates[0]
+        meta["candidates"] = candidates
+    if not backup_model:
+        backup_model = pick_backup_model(model, candidates)
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + history_tokens(history)
+    requested = model
+    model, reservation = enforce_budget(model, input_tokens, max_tokens)
+    if model != requested:
+        meta["downgraded_from"] = requested
+
+    progress = threading.Event()
+    primary = StreamRun(
+        prompt, system_prompt, model, max_tokens, keys.get(detect_provider(model)), progress, history, reservation
+    ).start()
+    runs = [primary]
+    deadline = time.perf_counter() + hedge_delay_s(model)
+    while not (primary.first_token.is_set() or primary.done.is_set()):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        progress.wait(remaining)
+        progress.clear()
+
+    backup = hold = None
+    if not primary.responded and backup_model and keys.get(detect_provider(backup_model)):
+        est = estimate_cost_usd(backup_model, input_tokens, max_tokens // 4)
+        backup_reservation = reserve_budget(backup_model, input_tokens, max_tokens)
+        if backup_reservation is not None:
+            hold = hedge_stats().try_spend(agent_id, est, hedge_budget_usd)
+        if hold is not None:
+            backup = StreamRun(
+                prompt, system_prompt, backup_model, max_tokens,
+                keys.get(detect_provider(backup_model)), progress, history, backup_reservation,
+            ).start()
+            runs.append(backup)
+        else:
+            release_budget(backup_reservation)
+
+    winner = None
+    while winner is None:
+        winner = next((r for r in runs if r.responded), None)
+        if winner is None and all(r.done.is_set() for r in runs):
+            break
+        if winner is None:
+            progress.wait()
+            progress.clear()
+
+    for r in runs:
+        if r is not winner:
+            r.cancel()
+    if winner is not None:
+        winner.done.wait()
+    accounted = {id(r): r.record() for r in runs}
+
+    hedge_stats().record(
+        agent_id,
+        hold,
+        backup_won=backup is not None and winner is backup,
+        cost_usd=accounted[id(backup)].get("cost_usd", 0.0) if backup is not None else 0.0,
+    )
+    meta.update({"hedged": backup is not None, "backup_model": backup_model if backup else None})
+    if winner is None or winner.error is not None:
+        raise (winner or primary).error or RuntimeError("LLM call failed")
+    meta.update({
+        "model": winner.model,
+        "provider": detect_provider(winner.model),
+        "latency_s": winner.latency_s,
+        "ttft_s": winner.ttft_s,
+        **accounted[id(winner)],
+    })
+    return winner.text
+
+
+# =========================
+# Multi-turn Conversations
+# =========================
+
+def new_conversation() -> Dict[str, Any]:
+    # messages is the full transcript; only messages[summary_upto:] are sent
+    # verbatim, everything before is represented by summary.
+    # A background compaction only ever writes "compacted"; the session's own
+    # thread moves it into summary/summary_upto (see apply_compaction).
+    return {
+        "messages": [], "summary": "", "summary_upto": 0, "compacting": False, "compacted": None, "compact_error": "",
+    }
+
+
+def apply_compaction(conv: Dict[str, Any]) -> None:
+    """Adopt a finished background compaction if it was built on the current summary."""
+    done, conv["compacted"] = conv.get("compacted"), None
+    if done is not None and done["from"] == conv["summary_upto"]:
+        conv["summary"], conv["summary_upto"] = done["summary"], done["upto"]
+
+
+def conversation_context(conv: Dict[str, Any], system_prompt: Optional[str]) -> Tuple[str, List[Dict[str, str]]]:
+    """System prompt and history to send for the next turn.
+
+    Between compactions this is append-only, so the prefix stays byte-identical
+    and providers can reuse their prompt cache.
+    """
+    apply_compaction(conv)
+    system = (system_prompt or "").strip()
+    if conv["summary"]:
+        system += "\n\nSummary of the earlier conversation:\n" + conv["summary"]
+    return system, conv["messages"][conv["summary_upto"]:]
+
+
+def conversation_budget(model: str, max_tokens: int) -> int:
+    context = model_profile(model)["context"]
+    if not context:
+        return CONVERSATION_MAX_PROMPT_TOKENS
+    return max(1024, min(CONVERSATION_MAX_PROMPT_TOKENS, context - max_tokens))
+
+
+def conversation_tokens(conv: Dict[str, Any], system_prompt: Optional[str]) -> int:
+    system, history = conversation_context(conv, system_prompt)
+    return estimate_tokens(system) + history_tokens(history)
+
+
+def summarize_turns(previous_summary: str, messages: List[Dict[str, str]], model: str) -> str:
+    system_prompt = textwrap.dedent(
+        """
+        You maintain a running summary of a conversation between a user and an assistant.
+
+        Merge the previous summary with the new turns into one updated summary that keeps:
+        - facts, decisions and constraints the user stated
+        - answers and artifacts the assistant produced (briefly)
+        - open questions and pending tasks
+
+        Write compact bullet points, at most 300 words. Output only the summary.
+        """
+    ).strip()
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+    prompt = f"Previous summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"
+    return call_llm(
+        prompt=prompt, system_prompt=system_prompt, model=model, max_tokens=CONVERSATION_SUMMARY_TOKENS
+    ).strip()
+
+
+def compact_conversation(conv: Dict[str, Any], model: str, background: bool = True) -> None:
+    """Fold all but the last CONVERSATION_KEEP_MESSAGES unsummarized messages into the summary.
+
+    A blocking compaction does not wait for a background one; whichever result
+    no longer matches summary_upto is dropped by apply_compaction.
+    """
+    apply_compaction(conv)
+    if background and conv["compacting"]:
+        return
+    upto = len(conv["messages"]) - CONVERSATION_KEEP_MESSAGES
+    # Keep user/assistant pairs together.
+    upto -= (upto - conv["summary_upto"]) % 2
+    if upto <= conv["summary_upto"]:
+        return
+    base = conv["summary_upto"]
+    fold = conv["messages"][base:upto]
+    previous = conv["summary"]
+    keys = get_api_keys()
+    context = current_usage_context()
+
+    priority = "background" if background else "interactive"
+
+    def work():
+        with api_key_scope(keys), usage_scope(**{**context, "priority": priority}):
+            try:
+                summary = summarize_turns(previous, fold, model)
+                conv["compact_error"] = ""
+                # One assignment, so a reader never sees a summary without its upto.
+                conv["compacted"] = {"from": base, "upto": upto, "summary": summary}
+            except Exception as e:
+                conv["compact_error"] = str(e)
+
+    def work_in_background():
+        try:
+            work()
+        finally:
+            conv["compacting"] = False
+
+    if background:
+        conv["compacting"] = True
+        threading.Thread(target=work_in_background, daemon=True).start()
+    else:
+        work()
+        apply_compaction(conv)
+
+
+def run_conversation_turn(
+    conv: Dict[str, Any],
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    call: Callable[..., str] = None,
+    **kwargs: Any,
+) -> str:
+    """Send one user turn with the conversation's history and append the reply.
+
+    Compaction normally runs in the background after a turn; it only blocks
+    when the next prompt would exceed the budget outright.
+    """
+    call = call or call_llm
+    budget = conversation_budget(model, max_tokens)
+    if conversation_tokens(conv, system_prompt) + estimate_tokens(prompt) > budget:
+        compact_conversation(conv, model, background=False)
+    system, history = conversation_context(conv, system_prompt)
+    out = call(prompt=prompt, system_prompt=system, model=model, max_tokens=max_tokens, history=history, **kwargs)
+    conv["messages"].extend([{"role": "user", "content": prompt}, {"role": "assistant", "content": out}])
+    if conversation_tokens(conv, system_prompt) > budget * CONVERSATION_COMPACT_AT:
+        compact_conversation(conv, model, background=True)
+    return out
+
+
+# =========================
+# Adaptive Output Length
+# =========================
+
+def adaptive_max_tokens(agent: Dict[str, Any], default: int) -> Tuple[int, Dict[str, Any]]:
+    """max_tokens for one run of agent, and how it was chosen.
+
+    The agent's maxTokens (or default) caps it; with enough history it is the
+    p99 of recent output lengths plus a margin, but never below the floor.
+    """
+    limit = int(agent.get("maxTokens") or default)
+    try:
+        recent = run_history().output_tokens("agent", agent.get("id", ""), ADAPTIVE_TOKENS_WINDOW)
+    except sqlite3.Error:
+        recent = []
+    info: Dict[str, Any] = {"limit": limit, "runs": len(recent)}
+    if len(recent) < ADAPTIVE_TOKENS_MIN_RUNS:
+        return limit, info
+    info["p99"] = percentile(recent, 99)
+    sized = int(info["p99"] * (1 + ADAPTIVE_TOKENS_MARGIN))
+    return max(min(ADAPTIVE_TOKENS_FLOOR, limit), min(limit, sized)), info
+
+
+def call_llm_continued(
+    prompt: str,
+    system_prompt: Optional[str],
+    model: str,
+    max_tokens: int,
+    call: Callable[..., str] = None,
+    max_continuations: int = AUTO_CONTINUE_MAX,
+    history: Optional[List[Dict[str, str]]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    **kwargs: Any,
+) -> str:
+    """call(...) (default call_llm), then ask the same model to continue while the answer stops at max_tokens.
+
+    The parts are joined; meta keeps the first call's details with tokens, cost
+    and latency summed over all parts, plus "continuations".
+    """
+    call = call or call_llm
+    meta = {} if meta is None else meta
+    out = call(
+        prompt=prompt, system_prompt=system_prompt, model=model, max_tokens=max_tokens, history=history, meta=meta, **kwargs
+    )
+    meta["continuations"] = 0
+    while meta.get("truncated") and meta["continuations"] < max_continuations:
+        turns = list(history or []) + [{"role": "user", "content": prompt}, {"role": "assistant", "content": out}]
+        part: Dict[str, Any] = {}
+        out += call(
+            prompt=CONTINUE_PROMPT,
+            system_prompt=system_prompt,
+            model=meta.get("model", model),
+            max_tokens=max_tokens,
+            history=turns,
+            meta=part,
+            **kwargs,
+        )
+        for key in ("input_tokens", "output_tokens", "cost_usd", "latency_s"):
+            meta[key] = meta.get(key, 0) + part.get(key, 0)
+        meta["truncated"] = part.get("truncated", False)
+        meta["continuations"] += 1
+    return out
+
+
+# =========================
+# Run History
+# =========================
+
+class RunHistory:
+    """SQLite store of past runs with an FTS5 index over agent, prompt and output.
+
+    Listing queries never read full prompts/outputs; get() loads one run.
+    Falls back to LIKE search when the SQLite build lacks FTS5.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    ts REAL NOT NULL,
+                    kind TEXT NOT NULL,
+                    agent TEXT,
+                    model TEXT,
+                    prompt TEXT,
+                    output TEXT,
+                    latency_s REAL,
+                    input_tokens INTEGER,
+                    output_tokens INTEGER,
+                    stopped INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            # Databases created before runs recorded Stop lack the column.
+            if "stopped" not in {row["name"] for row in self._conn.execute("PRAGMA table_info(runs)")}:
+                self._conn.execute("ALTER TABLE runs ADD COLUMN stopped INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS runs_kind_id ON runs(kind, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS runs_kind_agent_id ON runs(kind, agent, id)")
+            try:
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5("
+                    "agent, prompt, output, content='runs', content_rowid='id')"
+                )
+                self._conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS runs_ai AFTER INSERT ON runs BEGIN "
+                    "INSERT INTO runs_fts(rowid, agent, prompt, output) "
+                    "VALUES (new.id, new.agent, new.prompt, new.output); END"
+                )
+                self._conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS runs_ad AFTER DELETE ON runs BEGIN "
+                    "INSERT INTO runs_fts(runs_fts, rowid, agent, prompt, output) "
+                    "VALUES ('delete', old.id, old.agent, old.prompt, old.output); END"
+                )
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    def add(
+        self,
+        kind: str,
+        agent: str,
+        model: str,
+        prompt: str,
+        output: str,
+        latency_s: Optional[float] = None,
+        input_tokens: Optional[int] = None,
+        output_tokens: Optional[int] = None,
+        stopped: bool = False,
+    ) -> int:
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO runs (ts, kind, agent, model, prompt, output, latency_s, input_tokens, output_tokens, "
+                "stopped) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), kind, agent, model, prompt, output, latency_s, input_tokens, output_tokens, int(stopped)),
+            )
+            return cur.lastrowid
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        # Quote each term so user input can't produce FTS syntax errors; prefix-match the last one.
+        terms = ['"' + t.replace('"', '""') + '"' for t in query.split()]
+        if terms:
+            terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(
+        self, query: str = "", kind: Optional[str] = None, limit: int = RUN_HISTORY_PAGE_SIZE, offset: int = 0
+    ) -> List[Dict[str, Any]]:
+        """One page of runs, newest first, optionally filtered by full-text query."""
+        cols = "r.id, r.ts, r.kind, r.agent, r.model, r.latency_s, r.input_tokens, r.output_tokens"
+        where, params = [], []
+        if kind:
+            where.append("r.kind = ?")
+            params.append(kind)
+        query = query.strip()
+        if query and self.fts:
+            sql = (
+                f"SELECT {cols}, snippet(runs_fts, 2, '[', ']', '…', 16) AS preview "
+                "FROM runs_fts JOIN runs r ON r.id = runs_fts.rowid WHERE runs_fts MATCH ?"
+            )
+            params.insert(0, self._fts_query(query))
+            if where:
+                sql += " AND " + " AND ".join(where)
+            sql += " ORDER BY rank LIMIT ? OFFSET ?"
+        else:
+            if query:
+                where.append("(r.prompt LIKE ? OR r.output LIKE ? OR r.agent LIKE ?)")
+                params.extend([f"%{query}%"] * 3)
+            sql = f"SELECT {cols}, substr(r.output, 1, 160) AS preview FROM runs r"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += " ORDER BY r.id DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+    def get(self, run_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return dict(row) if row else None
+
+    def iter_runs(self, kind: str, after_id: int, upto_id: int, batch: int = 500):
+        """(id, ts, prompt) of runs of kind with after_id < id <= upto_id, oldest first, read in batches."""
+        last = after_id
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, ts, prompt FROM runs WHERE kind = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?",
+                    (kind, last, upto_id, batch),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row["id"], row["ts"], row["prompt"] or ""
+            last = rows[-1]["id"]
+
+    def output_tokens(self, kind: str, agent: str, limit: int) -> List[int]:
+        """Output token counts of the agent's last limit completed runs of kind, newest first.
+
+        Runs cut short with Stop are left out: their partial output says nothing about answer length.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT output_tokens FROM runs WHERE kind = ? AND agent = ? AND output_tokens IS NOT NULL "
+                "AND NOT stopped ORDER BY id DESC LIMIT ?",
+                (kind, agent, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def max_id(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM runs").fetchone()[0]
+
+    def count(self, kind: Optional[str] = None) -> int:
+        with self._lock:
+            if kind:
+                return self._conn.execute("SELECT COUNT(*) FROM runs WHERE kind = ?", (kind,)).fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+
+@st.cache_resource
+def run_history() -> RunHistory:
+    return RunHistory(RUN_HISTORY_DB)
+
+
+def record_run(kind: str, agent: str, prompt: str, output: str, meta: Dict[str, Any]) -> None:
+    """Persist a finished run; history must never break the main flow.
+
+    Complete document runs are also added to the similarity index.
+    """
+    try:
+        run_id = run_history().add(
+            kind,
+            agent,
+            meta.get("model", ""),
+            prompt,
+            output,
+            latency_s=meta.get("latency_s"),
+            input_tokens=meta.get("input_tokens", estimate_tokens(prompt)),
+            output_tokens=meta.get("output_tokens", estimate_tokens(output)),
+            stopped=bool(meta.get("stopped")),
+        )
+    except sqlite3.Error:
+        return
+    if kind == "doc" and not meta.get("stopped"):
+        try:
+            similarity_index().add([(run_id, time.time(), prompt)])
+        except (OSError, ValueError):
+            pass
+
+
+def render_run_history(kind: str, state_key: str, clear_keys: Tuple[str, ...] = ()) -> None:
+    """Searchable, lazily paged list of past runs; 'Open' restores one into state_key.
+
+    clear_keys names widget states to drop so widgets pick up the restored value.
+    """
+    history = run_history()
+    query = st.text_input("Search past runs", key=f"history_query_{kind}")
+    pages_key = f"history_pages_{kind}"
+    if st.session_state.get(f"{pages_key}_query") != query:
+        st.session_state[pages_key] = 1
+        st.session_state[f"{pages_key}_query"] = query
+    pages = st.session_state.setdefault(pages_key, 1)
+
+    start = time.perf_counter()
+    rows = history.search(query, kind=kind, limit=pages * RUN_HISTORY_PAGE_SIZE)
+    st.caption(f"{len(rows)} result(s) in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for row in rows:
+        c1, c2 = st.columns([5, 1])
+        with c1:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["ts"]))
+            latency = f" · {row['latency_s']:.1f}s" if row["latency_s"] else ""
+            st.markdown(f"**{row['agent']}** · {row['model']} · {when}{latency}")
+            st.caption(row["preview"] or "")
+        with c2:
+            if st.button("Open", key=f"history_open_{kind}_{row['id']}"):
+                run = history.get(row["id"])
+                if run:
+                    st.session_state[state_key] = run["output"]
+                    for key in clear_keys:
+                        st.session_state.pop(key, None)
+                    st.rerun()
+    if len(rows) == pages * RUN_HISTORY_PAGE_SIZE and st.button("Load more", key=f"history_more_{kind}"):
+        st.session_state[pages_key] = pages + 1
+        st.rerun()
+
+
+# =========================
+# Similarity Index
+# =========================
+
+_SIMILARITY_WORD_RE = re.compile(r"[^\W_]{2,}")
+
+
+def hashed_vector(text: str, dim: int = SIMILARITY_DIM) -> np.ndarray:
+    """Unit-length signed feature-hashing vector of text's words and adjacent word pairs.
+
+    Counts are damped with log1p so long documents are not dominated by common words.
+    """
+    words = _SIMILARITY_WORD_RE.findall(text[:SIMILARITY_MAX_CHARS].lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not features:
+        return np.zeros(dim, dtype=np.float32)
+    hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+    # The top hash bit picks the sign, the rest the bucket.
+    signs = np.where(hashes >> 31, -1.0, 1.0)
+    counts = np.bincount((hashes & 0x7FFFFFFF) % dim, weights=signs, minlength=dim)
+    vec = (np.sign(counts) * np.log1p(np.abs(counts))).astype(np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+class SimilarityIndex:
+    """Top-k cosine search over hashed document vectors, sharded by month.
+
+    Each shard is an append-only file of (run_id, vector) records named
+    YYYY-MM.d{dim}.vec. Queries memory-map the shards, so the OS page cache
+    holds the vectors and records appended by other processes show up on the
+    next query. Records point at RunHistory rows; a run indexed twice is
+    reported once.
+    """
+
+    def __init__(self, directory: str, dim: int = SIMILARITY_DIM):
+        self.directory = directory
+        self.dim = dim
+        self.record = np.dtype([("id", "<i8"), ("v", "<f4", (dim,))])
+        self._maps: Dict[str, Tuple[int, np.ndarray]] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _shards(self) -> List[str]:
+        suffix = f".d{self.dim}.vec"
+        return sorted(os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith(suffix))
+
+    def _records(self, path: str) -> np.ndarray:
+        """A shard's complete records, re-mapped only when the file has grown."""
+        rows = os.path.getsize(path) // self.record.itemsize
+        cached = self._maps.get(path)
+        if cached is None or cached[0] != rows:
+            records = np.memmap(path, dtype=self.record, mode="r", shape=(rows,)) if rows else np.empty(0, self.record)
+            cached = self._maps[path] = (rows, records)
+        return cached[1]
+
+    def add(self, docs: Sequence[Tuple[int, float, str]]) -> None:
+        """Index (run_id, ts, text) documents; each goes to the shard of its ts month."""
+        by_month: Dict[str, List[Tuple[int, str]]] = {}
+        for run_id, ts, text in docs:
+            by_month.setdefault(time.strftime("%Y-%m", time.localtime(ts)), []).append((run_id, text))
+        for month, items in by_month.items():
+            records = np.zeros(len(items), dtype=self.record)
+            records["id"] = [run_id for run_id, _ in items]
+            records["v"] = [hashed_vector(text, self.dim) for _, text in items]
+            # One append per batch of whole records, so readers never see a torn row.
+            with self._lock, open(os.path.join(self.directory, f"{month}.d{self.dim}.vec"), "ab") as f:
+                f.write(records.tobytes())
+
+    def query(self, text: str, k: int = 5) -> List[Tuple[int, float]]:
+        """The k most similar indexed runs as (run_id, cosine), best first."""
+        q = hashed_vector(text, self.dim)
+        if not q.any():
+            return []
+        hits: List[Tuple[float, int]] = []
+        for path in self._shards():
+            records = self._records(path)
+            if not len(records):
+                continue
+            scores = records["v"] @ q
+            # Over-fetch a little so duplicates of one run cannot crowd out others.
+            n = min(len(scores), k * 2)
+            top = np.argpartition(-scores, n - 1)[:n]
+            hits.extend(zip(scores[top].tolist(), records["id"][top].tolist()))
+        best: List[Tuple[int, float]] = []
+        seen = set()
+        for score, run_id in sorted(hits, reverse=True):
+            if run_id not in seen:
+                seen.add(run_id)
+                best.append((run_id, score))
+        return best[:k]
+
+    def __len__(self) -> int:
+        return sum(os.path.getsize(p) // self.record.itemsize for p in self._shards())
+
+    def backfill(self, history: RunHistory, batch: int = 200) -> int:
+        """Index document runs recorded before this index existed; resumable, returns runs added.
+
+        The first call fixes the range (runs up to the current max id) in a
+        progress file; runs recorded after that are added by record_run().
+        """
+        progress_path = os.path.join(self.directory, f"backfill.d{self.dim}.json")
+        try:
+            with open(progress_path, "r", encoding="utf-8") as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            progress = {"upto": history.max_id(), "done": 0}
+        added = 0
+        runs = history.iter_runs("doc", progress["done"], progress["upto"])
+        while True:
+            pending = [doc for _, doc in zip(range(batch), runs)]
+            if pending:
+                self.add(pending)
+                added += len(pending)
+                progress["done"] = pending[-1][0]
+            else:
+                progress["done"] = progress["upto"]
+            tmp = progress_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(progress, f)
+            os.replace(tmp, progress_path)
+            if not pending:
+                return added
+
+
+@st.cache_resource
+def similarity_index() -> SimilarityIndex:
+    """The process's index; past runs are backfilled in the background on first use."""
+    index = SimilarityIndex(SIMILARITY_DIR)
+    threading.Thread(
+        target=lambda: index.backfill(run_history()), name="similarity-backfill", daemon=True
+    ).start()
+    return index
+
+
+def related_runs(text: str, k: int = 5) -> List[Dict[str, Any]]:
+    """Past document runs most similar to text: history rows plus "similarity", best first."""
+    try:
+        hits = similarity_index().query(text, k)
+    except (OSError, ValueError):
+        return []
+    runs = []
+    for run_id, score in hits:
+        run = run_history().get(run_id)
+        if run is not None and run["kind"] == "doc":
+            runs.append({**run, "similarity": score})
+    return runs
+
+
+# =========================
+# Document Batches
+# =========================
+
+_PAGE_NUMBER_RE = re.compile(r"^(?:page\s*)?[-–]?\s*\d{1,4}\s*[-–]?(?:\s*(?:of|/)\s*\d{1,4})?$", re.IGNORECASE)
+_HYPHEN_BREAK_RE = re.compile(r"(\w)-\n(?=[a-z])")
+_SPACES_RE = re.compile(r"[ \t\u00a0]+")
+_PAGE_REF_RE = re.compile(r"\bpage\s*\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?\b", re.IGNORECASE)
+_DATE_RE = re.compile(r"\b(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[./-]\d{1,2}[./-]\d{2,4}|\d{1,2}:\d{2}(?::\d{2})?)\b")
+_NUMBER_RE = re.compile(r"\d+")
+BOILERPLATE_MAX_NUMBERS = 3
+
+
+def _boilerplate_keys(line: str, page_index: int) -> set:
+    """Keys under which an edge line on page page_index counts as repeated.
+
+    Page references ("Page 3 of 40") and dates are masked out. Any other
+    number must either repeat exactly or move with the page index, so lines
+    like "Subtotal for page: $1,234.01" only repeat if they are identical.
+    """
+    text = _DATE_RE.sub("<date>", _PAGE_REF_RE.sub("page #", line.lower()))
+    parts = _NUMBER_RE.split(text)
+    numbers = _NUMBER_RE.findall(text)
+    if not numbers or len(numbers) > BOILERPLATE_MAX_NUMBERS:
+        return {text}
+    keys = set()
+    for tracked in itertools.product((False, True), repeat=len(numbers)):
+        key = parts[0]
+        for number, track, part in zip(numbers, tracked, parts[1:]):
+            key += (f"<p{int(number) - page_index}>" if track else number) + part
+        keys.add(key)
+    return keys
+
+
+def clean_document_pages(pages: List[str], report: Optional[Dict[str, Any]] = None) -> str:
+    """Join extracted pages, minus repeated headers/footers, page numbers and wasted whitespace.
+
+    Linear in the input: one pass counts edge lines across pages, one pass
+    rewrites. report (if given) receives page/line counts and token savings.
+    """
+    page_lines = [
+        [_SPACES_RE.sub(" ", ln).strip() for ln in _HYPHEN_BREAK_RE.sub(r"\1", page).splitlines()]
+        for page in pages
+    ]
+    page_lines = [[ln for ln in lines if ln] for lines in page_lines]
+
+    counts: Dict[str, int] = {}
+    for p, lines in enumerate(page_lines):
+        edge = lines[:BOILERPLATE_EDGE_LINES] + lines[-BOILERPLATE_EDGE_LINES:]
+        for key in set().union(*(_boilerplate_keys(ln, p) for ln in edge)):
+            counts[key] = counts.get(key, 0) + 1
+    threshold = max(3, int(len(pages) * BOILERPLATE_MIN_SHARE + 0.999))
+    repeated = {k for k, n in counts.items() if n >= threshold}
+
+    kept_pages: List[str] = []
+    stripped = 0
+    for p, lines in enumerate(page_lines):
+        n = len(lines)
+        body = []
+        for i, ln in enumerate(lines):
+            at_edge = i < BOILERPLATE_EDGE_LINES or i >= n - BOILERPLATE_EDGE_LINES
+            if at_edge and (_PAGE_NUMBER_RE.match(ln) or not repeated.isdisjoint(_boilerplate_keys(ln, p))):
+                stripped += 1
+                continue
+            body.append(ln)
+        text = "\n".join(body)
+        if len(text) - text.count(" ") - text.count("\n") >= PAGE_MIN_CHARS:
+            kept_pages.append(text)
+
+    out = "\n\n".join(kept_pages)
+    if report is not None:
+        before = estimate_tokens("\n\n".join(pages))
+        after = estimate_tokens(out)
+        report.update(
+            pages=len(pages),
+            dropped_pages=len(pages) - len(kept_pages),
+            stripped_lines=stripped,
+            tokens_before=before,
+            tokens_after=after,
+            tokens_saved_pct=round(100 * (before - after) / before, 1) if before else 0.0,
+        )
+    return out
+
+
+def extract_document_text(
+    name: str, data: bytes, mime: Optional[str] = None, report: Optional[Dict[str, Any]] = None
+) -> str:
+    """Plain text from an uploaded .txt/.md/.pdf file; PDFs go through clean_document_pages."""
+    ext = os.path.splitext(name)[1].lower()
+    if mime in ("text/plain", "text/markdown") or ext in (".txt", ".md", ".markdown"):
+        return data.decode("utf-8", errors="replace")
+    if mime == "application/pdf" or ext == ".pdf":
+        # PDF parsing is the slow part; share results across sessions and processes.
+        key = "clean:" + hashlib.sha256(data).hexdigest()
+        state = shared_state()
+        cached = state.get("extractions", key)
+        if cached is None:
+            from pypdf import PdfReader
+
+            reader = PdfReader(io.BytesIO(data))
+            pages = [p.extract_text() or "" for p in reader.pages]
+            clean_report: Dict[str, Any] = {}
+            cached = {"text": clean_document_pages(pages, clean_report), "report": clean_report}
+            state.set("extractions", key, cached, EXTRACTION_CACHE_TTL_S)
+        if report is not None:
+            report.update(cached["report"])
+        return cached["text"]
+    raise ValueError("Unsupported file type; please use txt/md/pdf.")
+
+
+def run_document_batch(
+    files: List[Tuple[str, bytes, Optional[str]]],
+    model: str,
+    workers: int = DOC_BATCH_WORKERS,
+    heartbeat_s: float = 0.25,
+):
+    """Extract and summarize files concurrently; yields (index, update) as jobs progress.
+
+    update["status"] moves through extracting -> summarizing -> done | error.
+    Must be consumed on the Streamlit thread; the workers never touch st.*.
+    While nothing changes, (None, {}) heartbeats are yielded every
+    heartbeat_s so the caller can redraw (and Streamlit can interrupt it).
+    Closing the generator early cancels queued jobs and in-flight calls.
+    """
+    updates: "queue.Queue[Tuple[int, Dict[str, Any]]]" = queue.Queue()
+    keys = get_api_keys()
+    context = current_usage_context()
+    stop = CancelScope()
+
+    def job(index: int, name: str, data: bytes, mime: Optional[str]) -> None:
+        if stop.cancelled.is_set():
+            return
+        scope = CancelScope()
+        stop.register(scope.cancel)
+        with api_key_scope(keys), usage_scope(**{**context, "priority": "batch"}), cancel_scope(scope):
+            try:
+                updates.put((index, {"status": "extracting"}))
+                clean_report: Dict[str, Any] = {}
+                text = extract_document_text(name, data, mime, report=clean_report).strip()
+                if not text:
+                    raise ValueError("No extractable text.")
+                updates.put((index, {
+                    "status": "summarizing",
+                    "chars": len(text),
+                    "tokens_saved_pct": clean_report.get("tokens_saved_pct"),
+                }))
+                meta: Dict[str, Any] = {}
+                summary = summarize_document(text, model=model, meta=meta)
+                record_run("doc", name, text, summary, meta)
+                updates.put((index, {
+                    "status": "done",
+                    "summary": summary,
+                    "model": meta.get("model", ""),
+                    "latency_s": meta.get("latency_s"),
+                    "cost_usd": meta.get("cost_usd"),
+                }))
+            except Exception as e:
+                updates.put((index, {"status": "error", "error": str(e)}))
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(files))))
+    remaining = len(files)
+    try:
+        for index, (name, data, mime) in enumerate(files):
+            pool.submit(job, index, name, data, mime)
+        while remaining:
+            try:
+                index, update = updates.get(timeout=heartbeat_s)
+            except queue.Empty:
+                yield None, {}
+                continue
+            if update["status"] in ("done", "error"):
+                remaining -= 1
+            yield index, update
+    finally:
+        if remaining:
+            stop.cancel()
+        pool.shutdown(wait=not remaining, cancel_futures=True)
+
+
+def batch_archive(results: List[Dict[str, Any]]) -> bytes:
+    """Zip of one Markdown summary per finished file plus an index."""
+    buf = io.BytesIO()
+    index = io.StringIO()
+    writer = csv.writer(index, lineterminator="\n")
+    writer.writerow(["file", "status", "model", "summary", "error"])
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        used = set()
+        for r in results:
+            base = os.path.splitext(r["file"])[0] or "document"
+            arcname, n = f"{base}.summary.md", 2
+            while arcname in used:
+                arcname, n = f"{base}-{n}.summary.md", n + 1
+            if r.get("status") == "done":
+                used.add(arcname)
+                zf.writestr(arcname, r["summary"])
+            writer.writerow([
+                r["file"],
+                r.get("status", ""),
+                r.get("model", ""),
+                arcname if r.get("status") == "done" else "",
+                r.get("error", ""),
+            ])
+        zf.writestr("index.csv", index.getvalue())
+    return buf.getvalue()
+
+
+def batch_rows(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "file": r["file"],
+            "status": r.get("status", "queued"),
+            "chars": r.get("chars"),
+            "tokens saved (%)": r.get("tokens_saved_pct"),
+            "model": r.get("model", ""),
+            "latency (s)": round(r["latency_s"], 2) if r.get("latency_s") else None,
+            "cost (USD)": round(r["cost_usd"], 5) if r.get("cost_usd") is not None else None,
+            "error": r.get("error", ""),
+        }
+        for r in results
+    ]
+
+
+# =========================
+# agents.yaml Schema Validation
+# =========================
+
+# Field -> rule. "type" is a tuple of accepted Python types; bools are never
+# accepted as numbers even though bool subclasses int.
+AGENT_SCHEMA: Dict[str, Dict[str, Any]] = {
+    "id": {"type": (str,), "required": True, "pattern": r"^[A-Za-z0-9][A-Za-z0-9_.-]*$"},
+    "name": {"type": (str,), "required": True},
+    "description": {"type": (str,)},
+    "model": {"type": (str,), "required": True, "provider": True},
+    "maxTokens": {"type": (int,), "min": 1, "max": MAX_TOKENS_LIMIT},
+    "temperature": {"type": (int, float), "min": 0.0, "max": 2.0},
+    "systemPrompt": {"type": (str,)},
+    "tags": {"type": (list,), "items": (str,)},
+    "hedgeBudgetUsd": {"type": (int, float), "min": 0.0, "max": 1000.0},
+}
+
+# Max number of per-agent validation results kept for incremental re-checks.
+AGENT_VALIDATION_CACHE_SIZE = 20000
+
+_AGENTS_HEADER_RE = re.compile(r"^agents:[ \t]*(#.*)?$", re.M)
+_TOP_LEVEL_LINE_RE = re.compile(r"^[^\s#-]", re.M)
+
+
+class LRUCache:
+    """Small thread-safe LRU map; instances are shared across reruns via st.cache_resource."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+@st.cache_resource
+def agent_validation_cache() -> LRUCache:
+    # The script module is re-executed on every rerun, so module globals would not survive.
+    return LRUCache(AGENT_VALIDATION_CACHE_SIZE)
+
+
+def make_issue(
+    line: int, column: int, message: str, severity: str = "error", agent_id: Optional[str] = None
+) -> Dict[str, Any]:
+    return {
+        "line": line,
+        "column": column,
+        "severity": severity,
+        "agent_id": agent_id,
+        "message": message,
+    }
+
+
+def has_errors(issues: List[Dict[str, Any]]) -> bool:
+    return any(i["severity"] == "error" for i in issues)
+
+
+def format_issue(issue: Dict[str, Any]) -> str:
+    where = f"line {issue['line']}, col {issue['column']}"
+    who = f" [{issue['agent_id']}]" if issue.get("agent_id") else ""
+    return f"{issue['severity'].upper()} {where}{who}: {issue['message']}"
+
+
+def compile_agent_schema(
+    schema: Dict[str, Dict[str, Any]],
+) -> List[Tuple[str, Callable[[Any], Optional[str]]]]:
+    """Turn AGENT_SCHEMA into a flat list of (field, check) closures.
+
+    Each check returns an error message or None; building them once keeps the
+    per-agent loop free of schema interpretation.
+    """
+    compiled = []
+    for field, rule in schema.items():
+        # Checks return the problem only; run() names the field, bound per field
+        # here, so a message can never report another field.
+        checks: List[Callable[[Any], Optional[str]]] = []
+        types = rule["type"]
+        type_names = " or ".join(t.__name__ for t in types)
+
+        def check_type(v, types=types, type_names=type_names):
+            if isinstance(v, bool) or not isinstance(v, types):
+                return f"must be {type_names}, got {type(v).__name__}"
+            return None
+
+        checks.append(check_type)
+        if "pattern" in rule:
+            rx = re.compile(rule["pattern"])
+            checks.append(
+                lambda v, rx=rx: None if rx.match(v) else f"value {v!r} does not match {rx.pattern}"
+            )
+        if "min" in rule or "max" in rule:
+            lo, hi = rule.get("min"), rule.get("max")
+            checks.append(
+                lambda v, lo=lo, hi=hi: None
+                if (lo is None or v >= lo) and (hi is None or v <= hi)
+                else f"must be between {lo} and {hi}, got {v}"
+            )
+        if rule.get("provider"):
+            checks.append(
+                lambda v: None if known_provider(v) else f"value {v!r} does not match any known provider"
+            )
+        if "items" in rule:
+            items = rule["items"]
+            checks.append(
+                lambda v, items=items: None
+                if all(isinstance(x, items) and not isinstance(x, bool) for x in v)
+                else f"entries must all be {items[0].__name__}"
+            )
+
+        def run(v, field=field, checks=checks):
+            for check in checks:
+                err = check(v)
+                if err:
+                    return f"'{field}' {err}"
+            return None
+
+        compiled.append((field, run))
+    return compiled
+
+
+COMPILED_AGENT_SCHEMA = compile_agent_schema(AGENT_SCHEMA)
+_AGENT_FIELD_LOOKUP = {f.lower(): f for f in AGENT_SCHEMA}
+
+
+def _load_yaml_node(text: str) -> Tuple[Any, Any]:
+    loader = YAML_LOADER(text)
+    try:
+        node = loader.get_single_node()
+        data = loader.construct_document(node) if node is not None else None
+        return node, data
+    finally:
+        loader.dispose()
+
+
+def _validate_agent_node(node: Any, agent: Any) -> List[Dict[str, Any]]:
+    """Validate one agent mapping. Lines are 0-based relative to the node's document."""
+    line, col = node.start_mark.line, node.start_mark.column + 1
+    if not isinstance(node, yaml.MappingNode) or not isinstance(agent, dict):
+        return [make_issue(line, col, "agent entry must be a mapping")]
+
+    agent_id = agent.get("id") if isinstance(agent.get("id"), str) else None
+    issues = []
+    positions = {}
+    for key_node, value_node in node.value:
+        key = key_node.value
+        if key in positions:
+            issues.append(
+                make_issue(key_node.start_mark.line, key_node.start_mark.column + 1,
+                           f"duplicate key '{key}'", agent_id=agent_id)
+            )
+        positions[key] = value_node.start_mark
+        if key not in AGENT_SCHEMA:
+            hint = _AGENT_FIELD_LOOKUP.get(str(key).replace("_", "").replace("-", "").lower())
+            msg = f"unknown key '{key}'" + (f" (did you mean '{hint}'?)" if hint else "")
+            issues.append(
+                make_issue(key_node.start_mark.line, key_node.start_mark.column + 1,
+                           msg, severity="warning", agent_id=agent_id)
+            )
+
+    for field, check in COMPILED_AGENT_SCHEMA:
+        if field not in agent:
+            if AGENT_SCHEMA[field].get("required"):
+                issues.append(make_issue(line, col, f"missing required key '{field}'", agent_id=agent_id))
+            continue
+        err = check(agent[field])
+        if err:
+            mark = positions[field]
+            issues.append(make_issue(mark.line, mark.column + 1, err, agent_id=agent_id))
+    return issues
+
+
+def _id_position(node: Any) -> Tuple[int, int]:
+    """0-based line and 1-based column of an agent's id value (or of the agent itself)."""
+    mark = node.start_mark
+    if isinstance(node, yaml.MappingNode):
+        for key_node, value_node in node.value:
+            if key_node.value == "id":
+                mark = value_node.start_mark
+                break
+    return mark.line, mark.column + 1
+
+
+def _validate_agent_chunk(chunk: str) -> Optional[Tuple[Any, List[Dict[str, Any]], Tuple[int, int]]]:
+    """Parse and validate one '- id: ...' list item, memoized on its exact text."""
+    cache = agent_validation_cache()
+    cached = cache.get(chunk)
+    if cached is not None:
+        return cached
+    try:
+        node, data = _load_yaml_node(chunk)
+    except yaml.YAMLError:
+        return None
+    if not isinstance(node, yaml.SequenceNode) or len(node.value) != 1:
+        return None
+    item = node.value[0]
+    result = (data[0], _validate_agent_node(item, data[0]), _id_position(item))
+    cache.set(chunk, result)
+    return result
+
+
+def _split_agent_chunks(yaml_text: str) -> Optional[List[Tuple[int, str]]]:
+    """Split the canonical 'agents:' layout into (start_line, item_text) chunks.
+
+    Returns None for any other layout so the caller can fall back to a full parse.
+    """
+    header = _AGENTS_HEADER_RE.search(yaml_text)
+    if header is None:
+        return None
+    before = yaml_text[: header.start()]
+    body = yaml_text[header.end():]
+    if _TOP_LEVEL_LINE_RE.search(before) or _TOP_LEVEL_LINE_RE.search(body):
+        return None
+
+    # 1-based line number of the first line after the header.
+    first_line = before.count("\n") + 2
+    lines = body.split("\n")[1:]
+    item = re.compile(r"^( *)- ")
+    indent = None
+    chunks: List[Tuple[int, str]] = []
+    current: List[str] = []
+    start = 0
+    for i, line in enumerate(lines):
+        m = item.match(line)
+        if m and (indent is None or len(m.group(1)) == indent):
+            indent = len(m.group(1))
+            if current:
+                chunks.append((start, "\n".join(current)))
+            current, start = [line], first_line + i
+        elif current:
+            current.append(line)
+        elif line.strip() and not line.lstrip().startswith("#"):
+            return None
+    if current:
+        chunks.append((start, "\n".join(current)))
+    return chunks
+
+
+def _check_duplicate_ids(agents: List[Any], id_positions: List[Tuple[int, int]]) -> List[Dict[str, Any]]:
+    seen: Dict[str, int] = {}
+    dupes = []
+    for agent, (line, col) in zip(agents, id_positions):
+        agent_id = agent.get("id") if isinstance(agent, dict) else None
+        if not isinstance(agent_id, str):
+            continue
+        if agent_id in seen:
+            dupes.append(
+                make_issue(line, col, f"duplicate id '{agent_id}' (first defined on line {seen[agent_id]})",
+                           agent_id=agent_id)
+            )
+        else:
+            seen[agent_id] = line
+    return dupes
+
+
+def validate_agents_yaml(yaml_text: str) -> Tuple[Optional[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """Validate agents.yaml text against AGENT_SCHEMA.
+
+    Returns (agents, issues); agents is None when the text cannot be read as an
+    agent list at all. Issue lines/columns are 1-based. In the canonical
+    'agents:' layout each list item is parsed and checked independently and
+    memoized, so edits only re-check the agents whose text changed.
+    """
+    chunks = _split_agent_chunks(yaml_text)
+    if chunks is not None:
+        results = [(_validate_agent_chunk(c), line) for line, c in chunks]
+        if all(r is not None for r, _ in results):
+            agents, issues, id_positions = [], [], []
+            for (agent, rel_issues, (id_line, id_col)), base in results:
+                agents.append(agent)
+                issues.extend(dict(i, line=i["line"] + base) for i in rel_issues)
+                id_positions.append((id_line + base, id_col))
+            issues.extend(_check_duplicate_ids(agents, id_positions))
+            issues.sort(key=lambda i: (i["line"], i["column"]))
+            return agents, issues
+
+    try:
+        node, data = _load_yaml_node(yaml_text)
+    except yaml.MarkedYAMLError as e:
+        mark = e.problem_mark or e.context_mark
+        line, col = (mark.line + 1, mark.column + 1) if mark else (1, 1)
+        return None, [make_issue(line, col, f"YAML syntax error: {e.problem or e}")]
+    except yaml.YAMLError as e:
+        return None, [make_issue(1, 1, f"YAML error: {e}")]
+
+    issues: List[Dict[str, Any]] = []
+    item_nodes: List[Any] = []
+    agents: List[Any] = []
+    if isinstance(node, yaml.MappingNode) and isinstance(data, dict) and isinstance(data.get("agents"), list):
+        for key_node, value_node in node.value:
+            if key_node.value == "agents":
+                item_nodes, agents = value_node.value, data["agents"]
+            else:
+                issues.append(make_issue(key_node.start_mark.line + 1, key_node.start_mark.column + 1,
+                                         f"unexpected top-level key '{key_node.value}'", severity="warning"))
+    elif isinstance(node, yaml.SequenceNode) and isinstance(data, list):
+        item_nodes, agents = node.value, data
+    elif isinstance(node, yaml.MappingNode) and isinstance(data, dict):
+        # Legacy form: a mapping of agents keyed by anything.
+        item_nodes = [v for _, v in node.value]
+        agents = list(data.values())
+        issues.append(make_issue(node.start_mark.line + 1, 1,
+                                 "expected an 'agents:' list; reading top-level mapping values as agents",
+                                 severity="warning"))
+    else:
+        line = node.start_mark.line + 1 if node is not None else 1
+        return None, [make_issue(line, 1, "document must contain an 'agents:' list")]
+
+    id_positions = []
+    for item_node, agent in zip(item_nodes, agents):
+        issues.extend(dict(i, line=i["line"] + 1) for i in _validate_agent_node(item_node, agent))
+        id_line, id_col = _id_position(item_node)
+        id_positions.append((id_line + 1, id_col))
+    issues.extend(_check_duplicate_ids(agents, id_positions))
+    issues.sort(key=lambda i: (i["line"], i["column"]))
+    return agents, issues
+
+
+# =========================
+# Agent Index
+# =========================
+
+# Agents per page in the Agent Studio picker, and the yaml_text size above which
+# the whole-file editor is only shown on request.
+AGENT_PAGE_SIZE = 25
+AGENT_FULL_EDITOR_MAX_CHARS = 100_000
+AGENT_TAG_OPTIONS = 200
+
+_INDEX_WORD_RE = re.compile(r"[\s\-_/.:,()]+")
+
+
+class AgentIndex:
+    """Prefix and tag lookups over one agent list, built once per list object.
+
+    Every word of an agent's id and name (and the whole id) is a sorted token,
+    so a query term is a bisect range rather than a scan over all agents.
+    """
+
+    def __init__(self, agents: List[Dict[str, Any]]):
+        self.agents = agents
+        self.positions: Dict[str, int] = {}
+        self.tags: Dict[str, List[int]] = {}
+        tokens = []
+        for i, agent in enumerate(agents):
+            if not isinstance(agent, dict):
+                continue
+            agent_id = str(agent.get("id", ""))
+            self.positions.setdefault(agent_id, i)
+            words = set(_INDEX_WORD_RE.split(f"{agent_id} {agent.get('name') or ''}".lower()))
+            words.add(agent_id.lower())
+            tokens.extend((w, i) for w in words if w)
+            for tag in agent.get("tags") or []:
+                self.tags.setdefault(str(tag).lower(), []).append(i)
+        tokens.sort()
+        self._tokens = [t for t, _ in tokens]
+        self._token_positions = [i for _, i in tokens]
+        self._searches = LRUCache(64)
+
+    def __len__(self) -> int:
+        return len(self.agents)
+
+    def _prefix(self, term: str) -> set:
+        lo = bisect.bisect_left(self._tokens, term)
+        hi = bisect.bisect_left(self._tokens, term + "\uffff")
+        return set(self._token_positions[lo:hi])
+
+    def search(self, query: str = "", tag: str = "") -> Sequence[int]:
+        """Positions of agents matching every query term (as a word prefix) and the tag, in file order."""
+        terms = tuple(query.lower().split())
+        if not terms and not tag:
+            return range(len(self.agents))
+        key = (terms, tag)
+        hits = self._searches.get(key)
+        if hits is None:
+            found = set(self.tags.get(tag.lower(), ())) if tag else None
+            for term in terms:
+                matches = self._prefix(term)
+                found = matches if found is None else found & matches
+            hits = sorted(found)
+            self._searches.set(key, hits)
+        return hits
+
+    def top_tags(self, limit: int = AGENT_TAG_OPTIONS) -> List[str]:
+        return sorted(self.tags, key=lambda t: (-len(self.tags[t]), t))[:limit]
+
+
+@st.cache_resource
+def _agent_indexes() -> LRUCache:
+    return LRUCache(16)
+
+
+def agent_index(agents: List[Dict[str, Any]]) -> AgentIndex:
+    """Shared index for an agent list; sessions showing the registry's list share one."""
+    cache = _agent_indexes()
+    index = cache.get(id(agents))
+    if index is None or index.agents is not agents:
+        index = AgentIndex(agents)
+        # The index holds the list, so its id cannot be reused while cached.
+        cache.set(id(agents), index)
+    return index
+
+
+def session_memo(name: str, text: str, fn: Callable[[str], Any]) -> Any:
+    """fn(text) for this session, recomputed only when text changes."""
+    cached = st.session_state.get(f"memo_{name}")
+    if cached is not None and (cached[0] is text or cached[0] == text):
+        return cached[1]
+    value = fn(text)
+    st.session_state[f"memo_{name}"] = (text, value)
+    return value
+
+
+def agent_spans(yaml_text: str) -> Optional[Dict[str, Tuple[int, int]]]:
+    """Character span of each agent's list item, by id, in the canonical layout; None otherwise."""
+    chunks = _split_agent_chunks(yaml_text)
+    if chunks is None:
+        return None
+    line_starts = [0] + [m.end() for m in re.finditer("\n", yaml_text)]
+    spans: Dict[str, Tuple[int, int]] = {}
+    for line, chunk in chunks:
+        parsed = _validate_agent_chunk(chunk)
+        agent = parsed[0] if parsed is not None else None
+        if isinstance(agent, dict) and isinstance(agent.get("id"), str):
+            start = line_starts[line - 1]
+            spans.setdefault(agent["id"], (start, start + len(chunk)))
+    return spans
+
+
+def replace_agent(
+    yaml_text: str,
+    agents: List[Dict[str, Any]],
+    agent_id: str,
+    chunk: str,
+    spans: Dict[str, Tuple[int, int]],
+) -> Tuple[str, List[Dict[str, Any]], List[str]]:
+    """Swap one agent's list item in yaml_text and agents without re-dumping the file.
+
+    Returns (yaml_text, agents, errors); on errors the inputs come back unchanged.
+    """
+    chunk = chunk.rstrip()
+    parsed = _validate_agent_chunk(chunk)
+    if parsed is None:
+        return yaml_text, agents, ["the text must be a single '- id: ...' list item"]
+    agent, issues, _ = parsed
+    errors = [format_issue(i) for i in issues if i["severity"] == "error"]
+    index = agent_index(agents)
+    if agent_id not in index.positions or agent_id not in spans:
+        return yaml_text, agents, [f"agent '{agent_id}' is not in both the YAML text and the loaded agents"]
+    new_id = agent.get("id") if isinstance(agent, dict) else None
+    if new_id != agent_id and new_id in index.positions:
+        errors.append(f"id '{new_id}' is already used by another agent")
+    start, end = spans[agent_id]
+    old = yaml_text[start:end]
+    if len(chunk) - len(chunk.lstrip(" ")) != len(old) - len(old.lstrip(" ")):
+        errors.append("keep the item's '- ' at its original indentation")
+    if errors:
+        return yaml_text, agents, errors
+    updated = list(agents)
+    updated[index.positions[agent_id]] = agent
+    # Keep the blank lines that separated this item from the next one.
+    trailing = old[len(old.rstrip()):]
+    return yaml_text[:start] + chunk + trailing + yaml_text[end:], updated, []
+
+
+# =========================
+# Large Outputs
+# =========================
+
+# Outputs longer than this are shown collapsed and one page at a time, so each
+# rerun only ships (and parses as Markdown) the visible page. Downloads of such
+# outputs are attached only after "Prepare download" is pressed.
+OUTPUT_PAGE_CHARS = 8000
+OUTPUT_PREVIEW_CHARS = 400
+
+
+def output_pages(text: str, page_chars: int = OUTPUT_PAGE_CHARS) -> List[Tuple[int, int]]:
+    """(start, end) spans of about page_chars that tile text.
+
+    Pages end at a blank line outside code fences when there is one, else at a
+    line end outside fences; a fence longer than a page is cut where it fills one.
+    """
+    spans: List[Tuple[int, int]] = []
+    start = pos = 0
+    in_fence = False
+    last_break = last_line = 0
+    for line in text.splitlines(keepends=True):
+        if _FENCE_RE.match(line):
+            in_fence = not in_fence
+        pos += len(line)
+        if not in_fence:
+            last_line = pos
+            if not line.strip():
+                last_break = pos
+        if pos - start >= page_chars:
+            cut = last_break if last_break > start else last_line if last_line > start else pos
+            spans.append((start, cut))
+            start = cut
+    if start < len(text) or not spans:
+        spans.append((start, len(text)))
+    return spans
+
+
+def output_page(key: str, text: str) -> Tuple[int, int, int]:
+    """Page picker for a long text: (page, start, end) of the visible page, 1-based."""
+    ss = st.session_state
+    spans = session_memo(f"pages_{key}", text, output_pages)
+    page_key = f"output_page_{key}"
+    # New content starts at page 1; set before the page widget is created.
+    if ss.get(f"{page_key}_len") != len(text) or ss.get(page_key, 1) > len(spans):
+        ss[page_key] = 1
+    ss[f"{page_key}_len"] = len(text)
+    page = int(st.number_input(f"Page (of {len(spans)})", min_value=1, max_value=len(spans), key=page_key))
+    start, end = spans[page - 1]
+    return page, start, end
+
+
+def render_large_output(text: str, key: str, markdown: bool = True, label: str = "Output") -> None:
+    """Show text as Markdown or in a read-only area; long texts start collapsed and are paged."""
+    if len(text) > OUTPUT_PAGE_CHARS:
+        st.caption(f"{len(text):,} characters · ~{estimate_tokens(text):,} tokens")
+        if not st.toggle("Show full output", key=f"output_open_{key}"):
+            st.caption(text[:OUTPUT_PREVIEW_CHARS].rstrip() + " …")
+            return
+        page, start, end = output_page(key, text)
+        text = text[start:end]
+        label = f"{label} (page {page})"
+    if markdown:
+        st.markdown(text)
+    else:
+        st.text_area(label, value=text, height=220)
+
+
+def download_on_demand(
+    label: str, key: str, content: str, data: Callable[[str], Any], file_name: str, mime: str
+) -> None:
+    """Download button whose payload, data(content), is only built and sent once the user asks.
+
+    The payload is built once per content; a Prepare click only holds for the
+    content it was made for. Small content (<= OUTPUT_PAGE_CHARS) gets a plain
+    download button.
+    """
+    ss = st.session_state
+    ready_key = f"download_ready_{key}"
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    if ss.get(ready_key) not in (None, digest):
+        # The content changed since Prepare was pressed.
+        del ss[ready_key]
+    if len(content) > OUTPUT_PAGE_CHARS and ss.get(ready_key) != digest:
+        slot = st.empty()
+        if not slot.button(f"Prepare {label.lower()}", key=f"download_prepare_{key}"):
+            return
+        ss[ready_key] = digest
+        target = slot
+    else:
+        target = st
+    target.download_button(
+        label,
+        data=session_memo(f"download_{key}", digest, lambda _: data(content)),
+        file_name=file_name,
+        mime=mime,
+        key=f"download_{key}",
+        on_click=lambda: ss.pop(ready_key, None),
+    )
+
+
+# =========================
+# Local agents.yaml Repair
+# =========================
+
+# Normalized key (lowercase, no separators) -> canonical agent field, on top of
+# the exact-case matches in _AGENT_FIELD_LOOKUP.
+AGENT_KEY_ALIASES = {
+    "title": "name",
+    "desc": "description",
+    "llm": "model",
+    "modelname": "model",
+    "tokens": "maxTokens",
+    "maxoutputtokens": "maxTokens",
+    "temp": "temperature",
+    "prompt": "systemPrompt",
+    "system": "systemPrompt",
+    "instructions": "systemPrompt",
+    "tag": "tags",
+}
+
+_FENCE_RE = re.compile(r"^\s*```")
+_KEY_LINE_RE = re.compile(r"^( *)([^\s#:][^:]*):(\s|$)")
+
+
+def to_kebab_case(value: str) -> str:
+    value = re.sub(r"([a-z0-9])([A-Z])", r"\1-\2", str(value).strip())
+    return re.sub(r"[\W_]+", "-", value.lower()).strip("-")
+
+
+def canonical_agent_key(key: Any) -> Optional[str]:
+    norm = re.sub(r"[\s_-]", "", str(key)).lower()
+    return _AGENT_FIELD_LOOKUP.get(norm) or AGENT_KEY_ALIASES.get(norm)
+
+
+def check_agent(agent: Any) -> List[str]:
+    """Schema errors for an already-constructed agent dict (no positions)."""
+    if not isinstance(agent, dict):
+        return ["agent entry must be a mapping"]
+    errors = []
+    for field, check in COMPILED_AGENT_SCHEMA:
+        if field not in agent:
+            if AGENT_SCHEMA[field].get("required"):
+                errors.append(f"missing required key '{field}'")
+            continue
+        err = check(agent[field])
+        if err:
+            errors.append(err)
+    return errors
+
+
+def _repair_yaml_text(text: str, fixes: List[str]) -> str:
+    """Line-level fixes that must happen before the text can be parsed at all."""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    if lines and _FENCE_RE.match(lines[0]):
+        fixes.append("removed code fences")
+        lines = [ln for ln in lines if not _FENCE_RE.match(ln)]
+
+    tabbed = 0
+    for i, line in enumerate(lines):
+        stripped = line.lstrip(" \t")
+        lead = line[: len(line) - len(stripped)]
+        if "\t" in lead:
+            lines[i] = lead.expandtabs(2) + stripped
+            tabbed += 1
+    if tabbed:
+        fixes.append(f"converted tab indentation on {tabbed} line(s)")
+
+    return "\n".join(_insert_missing_dashes(lines, fixes))
+
+
+def _insert_missing_dashes(lines: List[str], fixes: List[str]) -> List[str]:
+    """Turn 'agents:' followed by flat repeated mappings into a proper list.
+
+    The first key under 'agents:' marks where each item starts, so
+
+        agents:
+          id: a
+          name: A
+          id: b
+
+    becomes two list items.
+    """
+    try:
+        header = next(i for i, ln in enumerate(lines) if _AGENTS_HEADER_RE.match(ln))
+    except StopIteration:
+        return lines
+    body = [i for i in range(header + 1, len(lines)) if lines[i].strip() and not lines[i].lstrip().startswith("#")]
+    if not body:
+        return lines
+    first = _KEY_LINE_RE.match(lines[body[0]])
+    if first is None or lines[body[0]].lstrip().startswith("- "):
+        return lines
+    indent, first_key = len(first.group(1)), first.group(2)
+    # A mapping of mappings ("agents: {writer: {...}}") is valid YAML; handled after parsing.
+    value = lines[body[0]][first.end():].strip()
+    if not value:
+        return lines
+
+    out = lines[: header + 1]
+    items = 0
+    for i in range(header + 1, len(lines)):
+        line = lines[i]
+        lead = len(line) - len(line.lstrip(" "))
+        if line.strip() and lead < indent and not line.lstrip().startswith("#"):
+            out.extend(lines[i:])
+            break
+        m = _KEY_LINE_RE.match(line)
+        if m and len(m.group(1)) == indent and m.group(2) == first_key:
+            out.append(" " * indent + "- " + line[indent:])
+            items += 1
+        elif line.strip():
+            out.append("  " + line)
+        else:
+            out.append(line)
+    fixes.append(f"added list dashes for {items} agent(s)")
+    return out
+
+
+def normalize_agent(agent: Dict[str, Any], fixes: List[str]) -> Dict[str, Any]:
+    """Deterministically coerce one agent dict toward AGENT_SCHEMA."""
+    out: Dict[str, Any] = {}
+    extras: Dict[str, Any] = {}
+    for key, value in agent.items():
+        canon = canonical_agent_key(key)
+        if canon is None:
+            extras[key] = value
+            continue
+        if canon != key:
+            fixes.append(f"renamed '{key}' to '{canon}'")
+        if canon not in out:
+            out[canon] = value
+
+    label = out.get("id") or out.get("name") or "?"
+    if isinstance(out.get("tags"), str):
+        out["tags"] = [t for t in re.split(r"[,;]", out["tags"])]
+    if isinstance(out.get("tags"), list):
+        tags = []
+        for tag in out["tags"]:
+            kebab = to_kebab_case(tag)
+            if kebab and kebab not in tags:
+                tags.append(kebab)
+        if tags != out["tags"]:
+            fixes.append(f"normalized tags of '{label}'")
+        out["tags"] = tags
+
+    for field, cast, lo, hi in (("maxTokens", int, 1, MAX_TOKENS_LIMIT), ("temperature", float, 0.0, 2.0)):
+        if field not in out or isinstance(out[field], bool):
+            continue
+        try:
+            value = cast(float(str(out[field]).strip()))
+        except ValueError:
+            continue
+        value = min(max(value, lo), hi)
+        if value != out[field]:
+            fixes.append(f"coerced {field} of '{label}' to {value}")
+        out[field] = value
+
+    for field in ("id", "name", "description", "model", "systemPrompt"):
+        value = out.get(field)
+        if isinstance(value, list) and all(isinstance(v, str) for v in value):
+            out[field] = "\n".join(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[field] = str(value)
+        if isinstance(out.get(field), str):
+            out[field] = out[field].strip()
+
+    if not out.get("id") and out.get("name"):
+        out["id"] = to_kebab_case(out["name"])
+        fixes.append(f"derived id '{out['id']}' from name")
+    elif isinstance(out.get("id"), str) and not re.match(AGENT_SCHEMA["id"]["pattern"], out["id"]):
+        new_id = to_kebab_case(out["id"])
+        if new_id:
+            fixes.append(f"normalized id '{out['id']}' to '{new_id}'")
+            out["id"] = new_id
+    if not out.get("name") and out.get("id"):
+        out["name"] = out["id"].replace("-", " ").replace("_", " ").title()
+        fixes.append(f"derived name for '{out['id']}'")
+
+    ordered = {f: out[f] for f in AGENT_SCHEMA if f in out}
+    ordered.update(extras)
+    return ordered
+
+
+def dedupe_agent_ids(agents: List[Dict[str, Any]], fixes: List[str]) -> None:
+    seen = set()
+    for agent in agents:
+        agent_id = agent.get("id")
+        if not isinstance(agent_id, str):
+            continue
+        new_id, n = agent_id, 2
+        while new_id in seen:
+            new_id, n = f"{agent_id}-{n}", n + 1
+        if new_id != agent_id:
+            fixes.append(f"renamed duplicate id '{agent_id}' to '{new_id}'")
+            agent["id"] = new_id
+        seen.add(new_id)
+
+
+def _agents_from_data(data: Any) -> Optional[List[Any]]:
+    if isinstance(data, dict) and "agents" in data:
+        data = data["agents"]
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict) and data and all(isinstance(v, dict) for v in data.values()):
+        # Mapping of agents keyed by id.
+        return [dict(v, id=v.get("id", k)) for k, v in data.items()]
+    return None
+
+
+def local_repair_agents_yaml(yaml_text: str) -> Tuple[List[Any], List[str]]:
+    """Repair agents.yaml without any network call.
+
+    Returns (slots, fixes). Each slot is either a normalized agent dict or a
+    raw text fragment that could not be parsed locally.
+    """
+    fixes: List[str] = []
+    text = _repair_yaml_text(yaml_text, fixes)
+
+    slots: List[Any] = []
+    chunks = _split_agent_chunks(text)
+    if chunks is not None:
+        for _, chunk in chunks:
+            try:
+                data = yaml.load(chunk, Loader=YAML_LOADER)
+            except yaml.YAMLError:
+                slots.append(chunk)
+                continue
+            slots.extend(data if isinstance(data, list) else [chunk])
+    else:
+        try:
+            parsed = _agents_from_data(yaml.load(text, Loader=YAML_LOADER))
+        except yaml.YAMLError:
+            parsed = None
+        slots = parsed if parsed is not None else [text]
+
+    slots = [normalize_agent(s, fixes) if isinstance(s, dict) else s for s in slots]
+    dedupe_agent_ids([s for s in slots if isinstance(s, dict)], fixes)
+    return slots, fixes
+
+
+def repair_agents_yaml(yaml_text: str, model: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+    """Repair locally first; send only unfixable fragments to the LLM.
+
+    Without a model, fragments that still fail are kept as trailing comments so
+    nothing from the input is lost.
+    """
+    slots, fixes = local_repair_agents_yaml(yaml_text)
+    report: Dict[str, Any] = {"local_fixes": fixes, "llm_fragments": 0, "unresolved": []}
+
+    agents: List[Dict[str, Any]] = []
+    for slot in slots:
+        if isinstance(slot, dict) and not check_agent(slot):
+            agents.append(slot)
+            continue
+        fragment = slot if isinstance(slot, str) else dump_agents_yaml([slot])
+        repaired = None
+        if model:
+            report["llm_fragments"] += 1
+            try:
+                llm_slots, llm_fixes = local_repair_agents_yaml(ai_repair_yaml(fragment, model=model))
+                if all(isinstance(s, dict) and not check_agent(s) for s in llm_slots):
+                    repaired = llm_slots
+            except Exception as e:
+                report.setdefault("errors", []).append(str(e))
+        if repaired is not None:
+            agents.extend(repaired)
+        elif isinstance(slot, dict):
+            # Keep the best local attempt; validation will point at what is left.
+            agents.append(slot)
+            report["unresolved"].append(f"{slot.get('id', '?')}: " + "; ".join(check_agent(slot)))
+        else:
+            report["unresolved"].append(fragment)
+
+    dedupe_agent_ids(agents, fixes)
+    text = dump_agents_yaml(agents)
+    for fragment in report["unresolved"]:
+        if fragment in slots:
+            text += "\n# UNREPAIRED:\n" + "\n".join("# " + ln for ln in fragment.split("\n")) + "\n"
+    return text, report
+
+
+# =========================
+# Server Warm-up
+# =========================
+
+def _warm_step(timings: Dict[str, Any], name: str, fn: Callable[[], Any]) -> None:
+    start = time.perf_counter()
+    try:
+        fn()
+        timings[name] = round(time.perf_counter() - start, 4)
+    except Exception as e:
+        timings[name] = f"failed: {type(e).__name__}: {e}"
+
+
+def warm_up_local(timings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Load what a first render needs: agents.yaml, SKILL.md, every theme bundle, shared resources."""
+    timings = {} if timings is None else timings
+    _warm_step(timings, "agent_registry", lambda: agent_registry().refresh())
+    _warm_step(timings, "skill_md", load_skill_md)
+    _warm_step(
+        timings, "theme_css", lambda: [theme_css(s, t) for s in PAINTER_CSS for t in ("dark", "light")]
+    )
+    _warm_step(
+        timings,
+        "resources",
+        lambda: (
+            telemetry(), usage_ledger(), run_history(), model_prices(),
+            llm_scheduler(), provider_health(), cassettes(), hedge_stats(), similarity_index(),
+        ),
+    )
+    return timings
+
+
+def _warm_providers() -> Dict[str, str]:
+    # Replayed cassettes never reach a provider, so there is nothing to connect to.
+    if cassettes().mode == "replay":
+        return {}
+    return {p: k for p, k in env_api_keys().items() if k}
+
+
+def warm_up_connections(timings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Open a pooled connection to each provider with a server-side key, in parallel.
+
+    The health probe request is used, so results also feed the provider breakers.
+    """
+    timings = {} if timings is None else timings
+    health = provider_health()
+
+    def connect(provider: str, api_key: str) -> None:
+        start = time.perf_counter()
+        try:
+            _probe_provider(provider, api_key)
+        except Exception as e:
+            if is_provider_fault(e):
+                health.record(provider, False, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        health.record(provider, True, time.perf_counter() - start)
+
+    keyed = _warm_providers()
+    if keyed:
+        with ThreadPoolExecutor(max_workers=len(keyed)) as pool:
+            for provider, api_key in keyed.items():
+                pool.submit(_warm_step, timings, f"connect:{provider}", functools.partial(connect, provider, api_key))
+    return timings
+
+
+def warm_up(connect: bool = True) -> Dict[str, Any]:
+    """Whole warm-up, synchronously; returns seconds (or a failure note) per step."""
+    timings = warm_up_local()
+    if connect:
+        warm_up_connections(timings)
+    return timings
+
+
+@st.cache_resource
+def server_warm_up() -> Dict[str, Any]:
+    """Once per process, from the first script run: local preloads now, connections in the background."""
+    timings: Dict[str, Any] = {}
+    warm_up_local(timings)
+    threading.Thread(target=warm_up_connections, args=(timings,), name="warm-up-connections", daemon=True).start()
+    return timings
+
+
+async def awarm_up() -> Dict[str, Any]:
+    """Warm-up for the async API: local preloads, then connections in this event loop's client pool."""
+    timings = await asyncio.to_thread(warm_up_local)
+    health = provider_health()
+
+    async def connect(provider: str, api_key: str) -> None:
+        start = time.perf_counter()
+        try:
+            api = provider_api(provider)
+            if api == "openai":
+                await aprovider_client(provider, api_key).with_options(timeout=10).models.list()
+            elif api == "anthropic":
+                await aprovider_client(provider, api_key).with_options(timeout=10).models.list(limit=1)
+            else:
+                await asyncio.to_thread(_probe_provider, provider, api_key)
+        except Exception as e:
+            timings[f"connect:{provider}"] = f"failed: {type(e).__name__}: {e}"
+            if is_provider_fault(e):
+                health.record(provider, False, time.perf_counter() - start, error=type(e).__name__)
+            return
+        timings[f"connect:{provider}"] = round(time.perf_counter() - start, 4)
+        health.record(provider, True, time.perf_counter() - start)
+
+    await asyncio.gather(*(connect(p, k) for p, k in _warm_providers().items()))
+    return timings
+
+
+# =========================
+# Rerun Profiling
+# =========================
+
+_RERUN_PROFILE: contextvars.ContextVar = contextvars.ContextVar("rerun_profile", default=None)
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer into folded (flame graph) stacks."""
+
+    def __init__(self, thread_id: int, interval_s: float = PROFILE_SAMPLE_INTERVAL_S):
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                key = ";".join(reversed(names))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+class RerunProfiler:
+    """Rolling record of recent reruns per session: per-section wall time plus optional profiles.
+
+    Also counts full-script reruns ("app") against fragment-only reruns, whether
+    or not profiling is on.
+    """
+
+    def __init__(self, keep: int = PROFILE_HISTORY, sessions: int = PROFILE_SESSIONS):
+        self.keep = keep
+        self.max_sessions = sessions
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _session(self, session_id: str) -> Dict[str, Any]:
+        # Caller holds the lock.
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = self._sessions[session_id] = {"reruns": deque(maxlen=self.keep), "counts": {}}
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def count(self, session_id: str, kind: str) -> None:
+        with self._lock:
+            counts = self._session(session_id)["counts"]
+            counts[kind] = counts.get(kind, 0) + 1
+
+    def counts(self, session_id: str) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._session(session_id)["counts"])
+
+    def add(self, session_id: str, rerun: Dict[str, Any]) -> None:
+        with self._lock:
+            self._session(session_id)["reruns"].append(rerun)
+
+    def recent(self, session_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._session(session_id)["reruns"])
+
+    def slowest(self, session_id: str, n: int = 10) -> List[Dict[str, Any]]:
+        return sorted(self.recent(session_id), key=lambda r: r["total_s"], reverse=True)[:n]
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+@st.cache_resource
+def rerun_profiler() -> RerunProfiler:
+    return RerunProfiler()
+
+
+def profile_session_id() -> str:
+    return st.session_state.get("session_id", "")
+
+
+@contextmanager
+def profile_rerun(mode: str, label: str):
+    """Profile one script run; a no-op when mode is "off"."""
+    if mode not in PROFILE_MODES[1:]:
+        yield
+        return
+    rerun: Dict[str, Any] = {"ts": time.time(), "label": label, "mode": mode, "sections": [], "stack": []}
+    token = _RERUN_PROFILE.set(rerun)
+    profiler = sampler = None
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process; another
+            # session is being profiled, so this run records section timings only.
+            profiler = None
+            rerun["mode"] = "cprofile (busy)"
+    elif mode == "sampling":
+        sampler = StackSampler(threading.get_ident()).start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rerun["total_s"] = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            rerun["pstats"] = marshal.dumps(profiler_stats(profiler))
+        if sampler is not None:
+            rerun["folded"] = sampler.stop()
+        _RERUN_PROFILE.reset(token)
+        del rerun["stack"]
+        rerun_profiler().add(profile_session_id(), rerun)
+
+
+@contextmanager
+def profile_section(name: str):
+    """Time a block of the current rerun; nested sections are recorded as "outer/inner"."""
+    rerun = _RERUN_PROFILE.get()
+    if rerun is None:
+        yield
+        return
+    rerun["stack"].append(name)
+    path = "/".join(rerun["stack"])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rerun["sections"].append({"section": path, "seconds": time.perf_counter() - start})
+        rerun["stack"].pop()
+
+
+_FULL_RUN: contextvars.ContextVar = contextvars.ContextVar("full_run", default=False)
+
+
+@contextmanager
+def full_run():
+    """Mark the body as a full script run (as opposed to a fragment rerun)."""
+    rerun_profiler().count(profile_session_id(), "app")
+    token = _FULL_RUN.set(True)
+    try:
+        yield
+    finally:
+        _FULL_RUN.reset(token)
+
+
+def isolated_fragment(name: str):
+    """st.fragment that is profiled as a section of a full run, or as its own rerun when it reruns alone."""
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            if _FULL_RUN.get():
+                with profile_section(name):
+                    return fn(*args, **kwargs)
+            rerun_profiler().count(profile_session_id(), f"fragment:{name}")
+            with profile_rerun(st.session_state.get("profile_mode", "off"), f"fragment:{name}"):
+                with profile_section(name):
+                    return fn(*args, **kwargs)
+
+        return st.fragment(run)
+
+    return decorate
+
+
+def profiler_stats(profiler: "cProfile.Profile") -> Dict[Any, Any]:
+    """The raw stats dict pstats/snakeviz read back from a .prof file."""
+    profiler.create_stats()
+    return profiler.stats
+
+
+def folded_stacks(reruns: List[Dict[str, Any]]) -> str:
+    """Collapsed-stack text (flamegraph.pl, speedscope) merged across reruns.
+
+    Sampled reruns contribute their stacks; timing-only reruns contribute their
+    sections, weighted in milliseconds.
+    """
+    merged: Dict[str, int] = {}
+    for rerun in reruns:
+        if rerun.get("folded"):
+            for key, count in rerun["folded"].items():
+                merged[key] = merged.get(key, 0) + count
+            continue
+        inner: Dict[str, float] = {}
+        for sec in rerun["sections"]:
+            parent = sec["section"].rsplit("/", 1)[0] if "/" in sec["section"] else None
+            if parent:
+                inner[parent] = inner.get(parent, 0.0) + sec["seconds"]
+        for sec in rerun["sections"]:
+            # Self time only, so nested sections are not counted twice.
+            self_ms = int(round((sec["seconds"] - inner.get(sec["section"], 0.0)) * 1000))
+            if self_ms > 0:
+                key = "rerun;" + sec["section"].replace("/", ";")
+                merged[key] = merged.get(key, 0) + self_ms
+    return "\n".join(f"{k} {v}" for k, v in sorted(merged.items())) + "\n"
+
+
+def debug_enabled() -> bool:
+    try:
+        return APP_DEBUG or st.query_params.get("debug") == "1"
+    except Exception:
+        return APP_DEBUG
+
+
+def render_profiler_panel() -> None:
+    """Hidden debug panel: rolling per-rerun breakdown, slowest reruns and exports."""
+    with st.expander("🛠 Rerun profiler", expanded=False):
+        mode = st.selectbox(
+            "Profiling mode",
+            options=PROFILE_MODES,
+            index=PROFILE_MODES.index(st.session_state.get("profile_mode", "off")),
+            help="Takes effect from the next rerun. cProfile and sampling add overhead.",
+        )
+        st.session_state["profile_mode"] = mode
+        if WARMUP_ON_START:
+            st.caption(
+                "Server warm-up: "
+                + " · ".join(
+                    f"{k} {v * 1000:.0f} ms" if isinstance(v, float) else f"{k} {v}"
+                    for k, v in server_warm_up().items()
+                )
+            )
+        prof, session_id = rerun_profiler(), profile_session_id()
+        counts = prof.counts(session_id)
+        if counts:
+            st.caption(
+                "Reruns in this session: " + " · ".join(f"{k} {v}" for k, v in sorted(counts.items()))
+            )
+        reruns = prof.recent(session_id)
+        if not reruns:
+            st.caption("No profiled reruns yet.")
+            return
+
+        rows = [
+            {"rerun": i, "section": sec["section"], "ms": sec["seconds"] * 1000}
+            for i, r in enumerate(reruns)
+            for sec in r["sections"]
+            if "/" not in sec["section"]
+        ]
+        if rows:
+            chart = alt.Chart(alt.Data(values=rows)).mark_bar().encode(
+                x=alt.X("rerun:O", title="Rerun"),
+                y=alt.Y("ms:Q", title="ms", stack="zero"),
+                color=alt.Color("section:N"),
+                tooltip=["section:N", alt.Tooltip("ms:Q", format=".1f")],
+            )
+            st.altair_chart(chart, use_container_width=True)
+
+        st.markdown("**Slowest reruns**")
+        st.dataframe(
+            [
+                {
+                    "when": time.strftime("%H:%M:%S", time.localtime(r["ts"])),
+                    "view": r["label"],
+                    "mode": r["mode"],
+                    "total_ms": round(r["total_s"] * 1000, 1),
+                    "slowest section": max(r["sections"], key=lambda s: s["seconds"])["section"]
+                    if r["sections"]
+                    else "",
+                }
+                for r in prof.slowest(session_id)
+            ],
+            use_container_width=True,
+            hide_index=True,
+        )
+
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            st.download_button(
+                "Folded stacks", data=folded_stacks(reruns), file_name="reruns.folded", mime="text/plain"
+            )
+        with c2:
+            last_cprofile = next((r for r in reversed(reruns) if r.get("pstats")), None)
+            if last_cprofile is not None:
+                st.download_button(
+                    "Last cProfile (.prof)",
+                    data=last_cprofile["pstats"],
+                    file_name="rerun.prof",
+                    mime="application/octet-stream",
+                )
+        with c3:
+            if st.button("Clear"):
+                prof.clear(session_id)
+
+
+# =========================
+# Sidebar: Controls & Keys
+# =========================
+
+def render_sidebar():
+    labels = get_language_labels()
+
+    with st.sidebar:
+        # WOW header
+        st.markdown("#### 🎨 Artistic Intelligence Workspace")
+        st.caption("Multi-agent AI studio with painter-style theming")
+
+        # View selection
+        view = st.radio(
+            "View",
+            options=["dashboard", "agent_studio", "doc_intel"],
+            format_func=lambda v: {
+                "dashboard": labels["view_dashboard"],
+                "agent_studio": labels["view_agent_studio"],
+                "doc_intel": labels["view_doc_intel"],
+            }[v],
+            index=["dashboard", "agent_studio", "doc_intel"].index(
+                st.session_state["view"]
+            ),
+        )
+        st.session_state["view"] = view
+
+        st.markdown("---")
+        st.markdown(f"**{labels['language']}**")
+        lang = st.radio(
+            "Language",
+            options=["en", "tc"],
+            format_func=lambda v: "EN" if v == "en" else "繁體中文",
+            index=["en", "tc"].index(st.session_state["language"]),
+        )
+        st.session_state["language"] = lang
+        labels = get_language_labels()
+
+        st.markdown(f"**{labels['theme']}**")
+        theme = st.radio(
+            "Theme",
+            options=["dark", "light"],
+            format_func=lambda v: labels["dark"] if v == "dark" else labels["light"],
+            index=["dark", "light"].index(st.session_state["theme"]),
+        )
+        st.session_state["theme"] = theme
+
+        st.markdown(f"**{labels['painter_style']}**")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            style = st.selectbox(
+                "Painter",
+                options=PAINTER_STYLES,
+                index=PAINTER_STYLES.index(st.session_state["painter_style"]),
+            )
+            st.session_state["painter_style"] = style
+        with col2:
+            if st.button(labels["jackpot"]):
+                import random
+
+                st.session_state["painter_style"] = random.choice(PAINTER_STYLES)
+
+        render_keys_and_budget(labels)
+
+        if debug_enabled():
+            st.markdown("---")
+            render_profiler_panel()
+
+
+PROVIDER_STATUS_ICONS = {"ok": "🟢", "degraded": "🟡", "down": "🔴", "unknown": "⚪"}
+
+
+def provider_badge(provider: str, labels: Dict[str, str], locked: bool = False) -> str:
+    """Live status badge for a provider that has a key, from provider_health()."""
+    status = provider_health().status(provider)
+    text = {
+        "ok": labels["status_operational"],
+        "degraded": labels["status_degraded"],
+        "down": labels["status_down"],
+        "unknown": labels["status_unknown"],
+    }[status["state"]]
+    detail = ""
+    if status["calls"]:
+        detail = f" · {status['error_rate']:.0%} err"
+        if status["p50_s"] is not None:
+            detail += f" · p50 {status['p50_s']:.1f}s"
+    title = f" title='{html.escape(status['last_error'], quote=True)}'" if status["last_error"] else ""
+    lock = "🔒 " if locked else ""
+    return (
+        f"<span class='wow-badge'{title}>{lock}{PROVIDER_STATUS_ICONS[status['state']]} {text}{detail}</span>"
+    )
+
+
+@isolated_fragment("keys_budget")
+def render_keys_and_budget(labels: Dict[str, str]) -> None:
+    """API keys and budget; editing them reruns only this part of the sidebar."""
+    st.markdown("---")
+    st.markdown(f"**{labels['api_keys']}**")
+
+    env_keys = {p: bool(k) for p, k in env_api_keys().items()}
+
+    def api_key_row(name: str, env_present: bool, state_key: str, label: str):
+        st.markdown(f"_{label}_")
+        if env_present:
+            st.text_input(
+                label,
+                value="(using environment key)",
+                type="password",
+                disabled=True,
+            )
+        else:
+            val = st.text_input(
+                label,
+                value=st.session_state.setdefault(state_key, ""),
+                type="password",
+            )
+            st.session_state[state_key] = val
+        if env_present or st.session_state[state_key]:
+            st.markdown(provider_badge(name, labels, locked=env_present), unsafe_allow_html=True)
+        else:
+            st.markdown(
+                f"<span class='wow-badge'>🔴 {labels['status_missing']}</span>",
+                unsafe_allow_html=True,
+            )
+
+    api_key_row("gemini", env_keys["gemini"], "gemini_key_user", labels["gemini_key"])
+    api_key_row("openai", env_keys["openai"], "openai_key_user", labels["openai_key"])
+    api_key_row("anthropic", env_keys["anthropic"], "anthropic_key_user", labels["anthropic_key"])
+    api_key_row("grok", env_keys["grok"], "grok_key_user", labels["grok_key"])
+
+    registry = provider_registry()
+    builtin = {p["name"] for p in BUILTIN_PROVIDERS}
+    for name, cfg in registry.providers.items():
+        if name in builtin:
+            continue
+        if cfg.get("key_env"):
+            api_key_row(name, env_keys[name], f"{name}_key_user", f"{name} API key")
+        else:
+            where = html.escape(cfg.get("base_url") or "")
+            st.markdown(f"_{html.escape(name)}_ · {where}", unsafe_allow_html=True)
+            st.markdown(provider_badge(name, labels), unsafe_allow_html=True)
+    for issue in registry.issues:
+        st.warning(issue)
+
+    st.markdown("---")
+    st.markdown("**Budget**")
+    budget = st.session_state["budget"]
+    spent = usage_ledger().spent(session_id=st.session_state["session_id"])
+    budget["session_usd"] = st.number_input(
+        "Session budget (USD)", min_value=0.0, value=float(budget["session_usd"]), step=0.5
+    )
+    budget["action"] = st.radio(
+        "When exceeded",
+        options=BUDGET_ACTIONS,
+        format_func=lambda a: "Downgrade model" if a == "downgrade" else "Block call",
+        index=BUDGET_ACTIONS.index(budget["action"]),
+        horizontal=True,
+    )
+    st.progress(min(1.0, spent / budget["session_usd"]) if budget["session_usd"] else 1.0)
+    st.caption(f"Spent this session: ${spent:.4f} · per-key daily cap ${KEY_DAILY_BUDGET_USD:.2f}")
 
 
 # =========================
 # Views
 # =========================
 
+def api_status_summary() -> str:
+    keyed = [p for p, k in get_api_keys().items() if k]
+    if not keyed:
+        return "Missing keys"
+    health = provider_health()
+    states = {p: health.status(p)["state"] for p in keyed}
+    down = [p for p, s in states.items() if s == "down"]
+    degraded = [p for p, s in states.items() if s == "degraded"]
+    if down or degraded:
+        parts = [f"🔴 {', '.join(down)} down"] if down else []
+        parts += [f"🟡 {', '.join(degraded)} degraded"] if degraded else []
+        return "; ".join(parts)
+    return "OK"
+
+
 def render_dashboard():
     labels = get_language_labels()
-    apply_wow_theme()
+    with profile_section("apply_wow_theme"):
+        apply_wow_theme()
 
     st.markdown(
         f"<div class='wow-card'>"
         f"<div style='display:flex;justify-content:space-between;align-items:flex-start;'>"
         f"<div><h4>{labels['dashboard_title']}</h4>"
         f"<div class='wow-subtitle'>{labels['dashboard_subtitle']}</div></div>"
-        f"<div class='wow-badge'>📡 API status: "
-        f"{'OK' if any(get_api_keys().values()) else 'Missing keys'}</div>"
+        f"<div class='wow-badge'>📡 API status: {api_status_summary()}</div>"
         f"</div></div>",
         unsafe_allow_html=True,
     )
@@ -971,10 +6128,44 @@ def render_dashboard():
         )
         st.altair_chart(chart_data.properties(height=260), use_container_width=True)
 
+    st.write("")
+    st.markdown("<div class='wow-label'>Usage & cost</div>", unsafe_allow_html=True)
+    dims = {"agent": "Agent", "model": "Model", "day": "Day", "session_id": "Session", "key_hash": "API key (hash)"}
+    by = st.radio("Group by", options=list(dims), format_func=dims.get, horizontal=True)
+    rows = usage_ledger().totals(by)
+    if rows:
+        st.dataframe(rows, use_container_width=True, hide_index=True)
+    else:
+        st.caption("No LLM calls recorded yet.")
+
+    st.markdown("<div class='wow-label'>LLM scheduler (this server process)</div>", unsafe_allow_html=True)
+    st.dataframe(llm_scheduler().stats(), use_container_width=True, hide_index=True)
+
+    cancelled = telemetry().cancellations()
+    if cancelled:
+        st.caption(
+            f"⏹ {len(cancelled)} call(s) stopped early in the telemetry window; "
+            f"{sum(c['elapsed_s'] for c in cancelled):.1f}s of generation cut short."
+        )
+        st.dataframe(
+            [
+                {
+                    "time": time.strftime("%H:%M:%S", time.localtime(c["ts"])),
+                    "model": c["model"],
+                    "after (s)": round(c["elapsed_s"], 2),
+                    "chars kept": c["output_chars"],
+                }
+                for c in reversed(cancelled[-10:])
+            ],
+            use_container_width=True,
+            hide_index=True,
+        )
+
 
 def render_agent_studio():
     labels = get_language_labels()
-    apply_wow_theme()
+    with profile_section("apply_wow_theme"):
+        apply_wow_theme()
 
     agents = st.session_state["agents"]
     if not agents:
@@ -1001,207 +6192,579 @@ def render_agent_studio():
         col_left, col_right = st.columns([1, 2])
 
         with col_left:
-            # Agent selection
-            agent_names = [f"{a['name']} ({a['id']})" for a in agents]
-            agent_ids = [a["id"] for a in agents]
-            selected_index = 0
-            if "selected_agent_id" in st.session_state:
-                try:
-                    selected_index = agent_ids.index(st.session_state["selected_agent_id"])
-                except ValueError:
-                    selected_index = 0
-
-            agent_label = st.selectbox(
-                labels["select_agent"],
-                options=agent_names,
-                index=selected_index,
-            )
-            selected_agent = agents[agent_names.index(agent_label)]
-            st.session_state["selected_agent_id"] = selected_agent["id"]
-
-            # Model selection
-            model = st.selectbox(
-                labels["select_model"],
-                options=MODEL_OPTIONS,
-                index=MODEL_OPTIONS.index(st.session_state["agent_model"])
-                if st.session_state["agent_model"] in MODEL_OPTIONS
-                else 2,
-            )
-            st.session_state["agent_model"] = model
-
-            override_model = st.text_input(
-                labels["override_model"], value=st.session_state["agent_override_model"]
-            )
-            st.session_state["agent_override_model"] = override_model
-
-            max_tokens = st.number_input(
-                labels["max_tokens"],
-                min_value=256,
-                max_value=32768,
-                value=int(st.session_state["agent_max_tokens"]),
-                step=256,
-            )
-            st.session_state["agent_max_tokens"] = max_tokens
-
-            st.markdown(f"<div class='wow-label'>{labels['view_mode']}</div>", unsafe_allow_html=True)
-            view_mode = st.radio(
-                labels["view_mode"],
-                options=[labels["text_view"], labels["markdown_view"]],
-                index=0 if st.session_state["agent_view_mode"] == "Text" else 1,
-                horizontal=True,
-            )
-            st.session_state["agent_view_mode"] = (
-                "Text" if view_mode == labels["text_view"] else "Markdown"
-            )
+            selected_agent = select_agent(agents, labels)
+            render_agent_params(selected_agent, labels)
 
         with col_right:
-            # Prompt & output
-            st.markdown(f"**{labels['prompt']}**")
-            prompt = st.text_area(
-                labels["prompt"],
-                value=st.session_state["agent_prompt"],
-                height=180,
-            )
-            st.session_state["agent_prompt"] = prompt
-
-            col_buttons = st.columns([1, 1, 1])
-            with col_buttons[0]:
-                run_clicked = st.button(labels["run_agent"])
-            with col_buttons[1]:
-                copy_clicked = st.button(labels["copy"])
-            with col_buttons[2]:
-                use_as_input = st.button(labels["use_as_input"])
-
-            if copy_clicked and st.session_state["agent_output"]:
-                st.session_state["copy_feedback"] = labels["copied"]
-                st.success(labels["copied"])
-            if use_as_input and st.session_state["agent_output"]:
-                st.session_state["agent_prompt"] = st.session_state["agent_output"]
-
-            if run_clicked:
-                if not prompt.strip():
-                    st.warning("Prompt is empty.")
-                else:
-                    try:
-                        with st.spinner(labels["running"]):
-                            run_model = override_model or model or selected_agent["model"]
-                            system_prompt = selected_agent.get("systemPrompt", "")
-                            out = call_llm(
-                                prompt=prompt,
-                                system_prompt=system_prompt,
-                                model=run_model,
-                                max_tokens=max_tokens,
-                            )
-                            st.session_state["agent_output"] = out
-                    except Exception as e:
-                        st.error(f"Error: {e}")
-
-            st.markdown(f"**{labels['output']}**")
-            if st.session_state["agent_output"]:
-                if st.session_state["agent_view_mode"] == "Markdown":
-                    st.markdown(st.session_state["agent_output"])
-                else:
-                    st.text_area(
-                        labels["output"],
-                        value=st.session_state["agent_output"],
-                        height=220,
-                    )
-            else:
-                st.info("Agent output will appear here.")
+            render_agent_run(selected_agent, labels)
 
     # ---------- Manage Tab ----------
     with tabs[1]:
         st.write("")
         c1, c2 = st.columns(2)
 
-        # agents.yaml
         with c1:
-            st.markdown(f"**{labels['yaml_title']}**")
-            yaml_text = st.text_area(
-                labels["yaml_title"],
-                value=st.session_state["yaml_text"],
-                height=300,
+            render_yaml_editor(labels)
+
+        with c2:
+            render_skill_editor(labels)
+
+
+def select_agent(agents: List[Dict[str, Any]], labels: Dict[str, str]) -> Dict[str, Any]:
+    """Searchable, paginated picker; only the current page of agents is rendered."""
+    ss = st.session_state
+    index = agent_index(agents)
+    if len(agents) > AGENT_PAGE_SIZE:
+        c_query, c_tag = st.columns([3, 2])
+        with c_query:
+            query = st.text_input("Search agents", key="agent_search", placeholder="id or name prefix")
+        with c_tag:
+            tag = st.selectbox("Tag", options=[""] + index.top_tags(), key="agent_tag", format_func=lambda t: t or "(any)")
+        hits = index.search(query, tag)
+        pages = max(1, -(-len(hits) // AGENT_PAGE_SIZE))
+        # A new search starts at page 1; set before the page widget is created.
+        if ss.get("agent_search_last") != (query, tag) or ss.get("agent_page", 1) > pages:
+            ss["agent_page"] = 1
+        ss["agent_search_last"] = (query, tag)
+        page = 1
+        if pages > 1:
+            page = int(st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, key="agent_page"))
+        st.caption(f"{len(hits):,} of {len(agents):,} agents")
+        positions = list(hits[(page - 1) * AGENT_PAGE_SIZE:page * AGENT_PAGE_SIZE])
+    else:
+        positions = list(range(len(agents)))
+
+    selected_pos = index.positions.get(ss.get("selected_agent_id"))
+    if selected_pos is not None and selected_pos not in positions:
+        # Keep the current agent selectable while browsing other pages.
+        positions.insert(0, selected_pos)
+    if not positions:
+        st.info("No agents match.")
+        positions = [selected_pos if selected_pos is not None else 0]
+
+    pos = st.selectbox(
+        labels["select_agent"],
+        options=positions,
+        index=positions.index(selected_pos) if selected_pos in positions else 0,
+        format_func=lambda i: f"{agents[i].get('name') or agents[i]['id']} ({agents[i]['id']})",
+    )
+    selected_agent = agents[pos]
+    ss["selected_agent_id"] = selected_agent["id"]
+    return selected_agent
+
+
+def render_agent_params(selected_agent: Dict[str, Any], labels: Dict[str, str]) -> None:
+    """Run parameters.
+
+    Model and hedge choices sit outside the form because they reveal further
+    controls; the rest are submitted together so tweaking them does not rerun
+    the app per widget.
+    """
+    agent_default = selected_agent.get("model") or "gemini-2.5-flash"
+    model_choices = ["", AUTO_MODEL] + model_options()
+    model = st.selectbox(
+        labels["select_model"],
+        options=model_choices,
+        format_func=lambda m: m or f"(agent default: {agent_default})",
+        index=model_choices.index(st.session_state["agent_model"])
+        if st.session_state["agent_model"] in model_choices
+        else 0,
+    )
+    st.session_state["agent_model"] = model
+
+    if (model or agent_default) == AUTO_MODEL:
+        policy = st.session_state["router_policy"]
+        policy["policy"] = st.selectbox(
+            "Routing policy",
+            options=list(ROUTER_POLICIES),
+            format_func=lambda p: ROUTER_POLICIES[p],
+            index=list(ROUTER_POLICIES).index(policy["policy"]),
+        )
+        if policy["policy"] == "cheapest":
+            policy["max_p95_s"] = st.number_input(
+                "Max p95 latency (s)", min_value=0.5, max_value=120.0,
+                value=float(policy["max_p95_s"]), step=0.5,
+            )
+        else:
+            policy["max_cost_usd"] = st.number_input(
+                "Max cost per call (USD)", min_value=0.0001, max_value=10.0,
+                value=float(policy["max_cost_usd"]), step=0.01, format="%.4f",
             )
-            st.session_state["yaml_text"] = yaml_text
 
-            col_u, col_d, col_ai = st.columns(3)
-            with col_u:
-                uploaded_yaml = st.file_uploader(
-                    labels["upload_yaml"], type=["yml", "yaml"], key="upload_yaml"
-                )
-            with col_d:
-                st.download_button(
-                    labels["download_yaml"],
-                    data=st.session_state["yaml_text"],
-                    file_name="agents.yaml",
-                    mime="text/yaml",
-                )
-            with col_ai:
-                if st.button(labels["ai_repair"]):
-                    try:
-                        model = st.session_state["agent_model"] or "gemini-2.5-flash"
-                        repaired = ai_repair_yaml(st.session_state["yaml_text"], model=model)
-                        st.session_state["yaml_text"] = repaired
-                        parsed = safe_parse_yaml_agents(repaired)
-                        if parsed is not None:
-                            st.session_state["agents"] = parsed
-                            st.success("YAML repaired and agents updated.")
-                        else:
-                            st.warning("Repaired YAML could not be parsed into agents; please review.")
-                    except Exception as e:
-                        st.error(f"AI repair failed: {e}")
-
-            if uploaded_yaml is not None:
-                try:
-                    text = uploaded_yaml.read().decode("utf-8")
-                    st.session_state["yaml_text"] = text
-                    parsed = safe_parse_yaml_agents(text)
-                    if parsed is not None:
-                        st.session_state["agents"] = parsed
-                        st.success("Uploaded YAML loaded and normalized.")
-                    else:
-                        st.warning(
-                            "Uploaded YAML could not be parsed into standard agents. "
-                            "Use AI Repair & Normalize."
+    override_model = st.text_input(
+        labels["override_model"], value=st.session_state["agent_override_model"]
+    )
+    st.session_state["agent_override_model"] = override_model
+
+    hedge = st.checkbox(
+        "Hedge slow requests",
+        value=st.session_state["agent_hedge"],
+        help="If no token arrives by the model's usual time-to-first-token, "
+        "race a backup model and keep whichever answers first.",
+    )
+    st.session_state["agent_hedge"] = hedge
+    if hedge:
+        backup_choices = [""] + model_options()
+        backup_model = st.selectbox(
+            "Backup model",
+            options=backup_choices,
+            format_func=lambda m: m or "(automatic, other provider)",
+            index=backup_choices.index(st.session_state["agent_backup_model"])
+            if st.session_state["agent_backup_model"] in backup_choices
+            else 0,
+        )
+        st.session_state["agent_backup_model"] = backup_model
+
+    with st.form("agent_params", border=False):
+        conversation_mode = st.checkbox(
+            "Conversation mode",
+            value=st.session_state["agent_conversation_mode"],
+            help="Keep multi-turn history per agent; older turns are summarized automatically.",
+        )
+        st.session_state["agent_conversation_mode"] = conversation_mode
+
+        st.session_state["agent_adaptive_tokens"] = st.checkbox(
+            "Size max tokens per agent",
+            value=st.session_state["agent_adaptive_tokens"],
+            help="Use the agent's maxTokens, lowered to the p99 of its recent answer lengths plus a margin. "
+            "The value below applies to agents without maxTokens.",
+        )
+        max_tokens = st.number_input(
+            labels["max_tokens"],
+            min_value=256,
+            max_value=32768,
+            value=int(st.session_state["agent_max_tokens"]),
+            step=256,
+        )
+        st.session_state["agent_max_tokens"] = max_tokens
+        st.session_state["agent_auto_continue"] = st.checkbox(
+            "Continue answers cut off at the limit",
+            value=st.session_state["agent_auto_continue"],
+            help=f"Ask the model to continue, up to {AUTO_CONTINUE_MAX} times, when it stops at max tokens.",
+        )
+
+        st.markdown(f"<div class='wow-label'>{labels['view_mode']}</div>", unsafe_allow_html=True)
+        view_mode = st.radio(
+            labels["view_mode"],
+            options=[labels["text_view"], labels["markdown_view"]],
+            index=0 if st.session_state["agent_view_mode"] == "Text" else 1,
+            horizontal=True,
+        )
+        st.session_state["agent_view_mode"] = (
+            "Text" if view_mode == labels["text_view"] else "Markdown"
+        )
+        st.form_submit_button("Apply settings")
+    st.caption(
+        "Run uses the applied settings: "
+        f"max tokens {st.session_state['agent_max_tokens']}"
+        f"{' (sized per agent)' if st.session_state['agent_adaptive_tokens'] else ''}, "
+        f"conversation {'on' if st.session_state['agent_conversation_mode'] else 'off'}, "
+        f"auto-continue {'on' if st.session_state['agent_auto_continue'] else 'off'}, "
+        f"{st.session_state['agent_view_mode']} view. Press Apply settings after editing them."
+    )
+
+
+@isolated_fragment("agent_run")
+def render_agent_run(selected_agent: Dict[str, Any], labels: Dict[str, str]) -> None:
+    """Prompt, run buttons and output; prompt edits rerun only this fragment."""
+    if st.session_state["agent_conversation_mode"]:
+        conv = st.session_state["conversations"].get(selected_agent["id"])
+        if conv and conv["messages"]:
+            apply_compaction(conv)
+            with st.expander(f"Conversation ({len(conv['messages']) // 2} turns)", expanded=True):
+                if conv["summary_upto"]:
+                    st.caption(
+                        f"{conv['summary_upto'] // 2} earlier turn(s) summarized; "
+                        f"~{conversation_tokens(conv, selected_agent.get('systemPrompt', ''))} "
+                        f"prompt tokens carried."
+                    )
+                if conv["compact_error"]:
+                    st.caption(f"⚠️ Summarization failed: {conv['compact_error']}")
+                for m in conv["messages"][-CONVERSATION_KEEP_MESSAGES * 2:]:
+                    with st.chat_message(m["role"]):
+                        st.markdown(m["content"])
+            if st.button("New conversation"):
+                st.session_state["conversations"].pop(selected_agent["id"], None)
+                st.rerun(scope="fragment")
+
+    st.markdown(f"**{labels['prompt']}**")
+    prompt = st.text_area(
+        labels["prompt"],
+        value=st.session_state["agent_prompt"],
+        height=180,
+    )
+    st.session_state["agent_prompt"] = prompt
+
+    col_buttons = st.columns([1, 1, 1])
+    with col_buttons[0]:
+        run_clicked = st.button(labels["run_agent"])
+    with col_buttons[1]:
+        copy_clicked = st.button(labels["copy"])
+    with col_buttons[2]:
+        use_as_input = st.button(labels["use_as_input"])
+
+    if copy_clicked and st.session_state["agent_output"]:
+        st.session_state["copy_feedback"] = labels["copied"]
+        st.success(labels["copied"])
+    if use_as_input and st.session_state["agent_output"]:
+        st.session_state["agent_prompt"] = st.session_state["agent_output"]
+
+    if run_clicked:
+        if not prompt.strip():
+            st.warning("Prompt is empty.")
+        else:
+            try:
+                with usage_scope(agent=selected_agent["id"]):
+                    ss = st.session_state
+                    run_model = (
+                        ss["agent_override_model"] or ss["agent_model"] or selected_agent.get("model") or "gemini-2.5-flash"
+                    )
+                    max_tokens = int(ss["agent_max_tokens"])
+                    sizing: Dict[str, Any] = {}
+                    if ss["agent_adaptive_tokens"]:
+                        max_tokens, sizing = adaptive_max_tokens(selected_agent, max_tokens)
+                    system_prompt = selected_agent.get("systemPrompt", "")
+                    route_info: Dict[str, Any] = {}
+                    call_kwargs: Dict[str, Any] = {
+                        "tags": selected_agent.get("tags"),
+                        "policy": st.session_state["router_policy"],
+                        "meta": route_info,
+                    }
+                    call = call_llm
+                    if st.session_state["agent_hedge"]:
+                        call = call_llm_hedged
+                        call_kwargs.update(
+                            backup_model=st.session_state["agent_backup_model"] or None,
+                            agent_id=selected_agent["id"],
+                            hedge_budget_usd=selected_agent.get("hedgeBudgetUsd", HEDGE_BUDGET_USD),
+                        )
+                    if ss["agent_auto_continue"]:
+                        call = functools.partial(call_llm_continued, call=call)
+                    conv = None
+                    if st.session_state["agent_conversation_mode"]:
+                        conv = st.session_state["conversations"].setdefault(
+                            selected_agent["id"], new_conversation()
                         )
-                except Exception as e:
-                    st.error(f"Failed to read YAML: {e}")
 
-        # SKILL.md
-        with c2:
-            st.markdown(f"**{labels['skill_title']}**")
-            skill_md = st.text_area(
-                labels["skill_title"],
-                value=st.session_state["skill_md"],
-                height=300,
+                    def invoke() -> str:
+                        if conv is not None:
+                            return run_conversation_turn(
+                                conv, prompt, system_prompt, run_model, max_tokens, call=call, **call_kwargs
+                            )
+                        return call(
+                            prompt=prompt,
+                            system_prompt=system_prompt,
+                            model=run_model,
+                            max_tokens=max_tokens,
+                            **call_kwargs,
+                        )
+
+                    def on_stop(partial: str) -> None:
+                        # Runs while Streamlit is interrupting the script: state only, no st.* output.
+                        ss["agent_output"] = partial
+                        ss["agent_route_info"] = {**route_info, "stopped": True}
+                        record_run("agent", selected_agent["id"], prompt, partial, {**route_info, "stopped": True})
+
+                    # Clicking Stop reruns this fragment, which interrupts the polling
+                    # loop in run_stoppable and cancels the call.
+                    stop_slot, live = st.empty(), st.empty()
+                    stop_slot.button("⏹ Stop", key="agent_stop")
+                    out = run_stoppable(
+                        invoke,
+                        on_progress=lambda partial: live.markdown(
+                            f"{partial} ▌" if partial else f"_{labels['running']}_"
+                        ),
+                        on_stop=on_stop,
+                    )
+                    stop_slot.empty()
+                    live.empty()
+                    if conv is not None:
+                        st.session_state["agent_prompt"] = ""
+                    route_info["max_tokens"] = max_tokens
+                    route_info["sizing"] = sizing
+                    st.session_state["agent_output"] = out
+                    st.session_state["agent_route_info"] = route_info
+                    record_run("agent", selected_agent["id"], prompt, out, route_info)
+            except Exception as e:
+                st.error(f"Error: {e}")
+
+    st.markdown(f"**{labels['output']}**")
+    route_info = st.session_state["agent_route_info"]
+    if route_info.get("candidates"):
+        st.caption(
+            f"🧭 Routed to {route_info.get('model')} "
+            f"({ROUTER_POLICIES[st.session_state['router_policy']['policy']].lower()})"
+            + (f"; fell back after: {', '.join(route_info['failed'])}" if route_info.get("failed") else "")
+        )
+    if route_info.get("hedged"):
+        st.caption(
+            f"🏁 Hedged with {route_info['backup_model']}; "
+            f"{route_info.get('model')} answered first."
+        )
+    if route_info.get("stopped"):
+        st.caption("⏹ Stopped; showing the output received before the stop.")
+    sizing = route_info.get("sizing")
+    if sizing:
+        basis = (
+            f"p99 of the last {sizing['runs']} answers is {sizing['p99']:,} tokens"
+            if "p99" in sizing
+            else f"{sizing['runs']} past answer(s), too few to size from"
+        )
+        st.caption(f"📏 max_tokens {route_info['max_tokens']:,} (agent limit {sizing['limit']:,}; {basis}).")
+    if route_info.get("continuations"):
+        st.caption(
+            f"➕ Continued {route_info['continuations']}× after hitting the length limit"
+            + ("; still cut off." if route_info.get("truncated") else ".")
+        )
+    elif route_info.get("truncated"):
+        st.caption("✂️ The answer stopped at max_tokens.")
+    hedge_snapshot = hedge_stats().snapshot()
+    if hedge_snapshot:
+        with st.expander("Hedging metrics"):
+            st.table(
+                [
+                    {
+                        "agent": agent_id,
+                        "requests": e["requests"],
+                        "hedged": e["hedged"],
+                        "backup wins": e["backup_wins"],
+                        "win rate": f"{e['backup_wins'] / e['hedged']:.0%}" if e["hedged"] else "–",
+                        "spent (USD)": round(e["spent_usd"], 4),
+                    }
+                    for agent_id, e in hedge_snapshot.items()
+                ]
             )
-            st.session_state["skill_md"] = skill_md
+    if st.session_state["agent_output"]:
+        render_large_output(
+            st.session_state["agent_output"],
+            "agent",
+            markdown=st.session_state["agent_view_mode"] == "Markdown",
+            label=labels["output"],
+        )
+        download_on_demand(
+            "Download output",
+            "agent_output",
+            st.session_state["agent_output"],
+            lambda text: text,
+            file_name=f"{selected_agent['id']}.md",
+            mime="text/markdown",
+        )
+    else:
+        st.info("Agent output will appear here.")
+
+    with st.expander("Run history"):
+        render_run_history("agent", "agent_output")
+
+
+@isolated_fragment("yaml_editor")
+def render_yaml_editor(labels: Dict[str, str]) -> None:
+    """Typing reruns only this editor; replacing the agents reruns the app so the Run tab sees them."""
+    st.markdown(f"**{labels['yaml_title']}**")
+    notice = st.session_state.pop("yaml_notice", None)
+    if notice:
+        st.success(notice)
+    render_agent_editor(st.session_state["yaml_text"])
+
+    yaml_text = st.session_state["yaml_text"]
+    show_full = len(yaml_text) <= AGENT_FULL_EDITOR_MAX_CHARS or st.checkbox(
+        f"Edit the whole file ({len(yaml_text):,} characters)", key="yaml_full_editor"
+    )
+    if show_full:
+        yaml_text = st.text_area(
+            labels["yaml_title"],
+            value=yaml_text,
+            height=300,
+        )
+        st.session_state["yaml_text"] = yaml_text
+
+    _, yaml_issues = session_memo("yaml_validation", yaml_text, validate_agents_yaml)
+    if yaml_issues:
+        with st.expander(f"Validation: {len(yaml_issues)} issue(s)", expanded=has_errors(yaml_issues)):
+            st.code("\n".join(format_issue(i) for i in yaml_issues[:200]), language="text")
+    else:
+        st.caption("✅ agents.yaml is valid.")
 
-            col_u2, col_d2 = st.columns(2)
-            with col_u2:
-                uploaded_skill = st.file_uploader(
-                    labels["upload_skill"], type=["md", "markdown", "txt"], key="upload_skill"
+    col_u, col_d, col_ai = st.columns(3)
+    with col_u:
+        uploaded_yaml = st.file_uploader(
+            labels["upload_yaml"], type=["yml", "yaml"], key="upload_yaml"
+        )
+    with col_d:
+        st.download_button(
+            labels["download_yaml"],
+            data=st.session_state["yaml_text"],
+            file_name="agents.yaml",
+            mime="text/yaml",
+        )
+    with col_ai:
+        if st.button(labels["ai_repair"]):
+            try:
+                model = st.session_state["agent_model"] or "gemini-2.5-flash"
+                repaired, report = repair_agents_yaml(st.session_state["yaml_text"], model=model)
+                st.session_state["yaml_text"] = repaired
+                st.caption(
+                    f"{len(report['local_fixes'])} local fix(es), "
+                    f"{report['llm_fragments']} fragment(s) sent to the LLM."
                 )
-            with col_d2:
-                st.download_button(
-                    labels["download_skill"],
-                    data=st.session_state["skill_md"],
-                    file_name="SKILL.md",
-                    mime="text/markdown",
+                parsed = safe_parse_yaml_agents(repaired)
+                if parsed is not None:
+                    st.session_state["agents"] = parsed
+                    st.session_state["yaml_notice"] = "YAML repaired and agents updated."
+                    st.rerun()
+                else:
+                    st.warning("Repaired YAML could not be parsed into agents; please review.")
+            except Exception as e:
+                st.error(f"AI repair failed: {e}")
+
+    # The uploader keeps its file across reruns; apply each upload once.
+    if uploaded_yaml is not None and st.session_state.get("upload_yaml_id") != uploaded_yaml.file_id:
+        st.session_state["upload_yaml_id"] = uploaded_yaml.file_id
+        try:
+            text = uploaded_yaml.read().decode("utf-8")
+            st.session_state["yaml_text"] = text
+            parsed = safe_parse_yaml_agents(text)
+            if parsed is not None:
+                st.session_state["agents"] = parsed
+                st.session_state["yaml_notice"] = "Uploaded YAML loaded and normalized."
+                st.rerun()
+            else:
+                st.warning(
+                    "Uploaded YAML could not be parsed into standard agents. "
+                    "Use AI Repair & Normalize."
                 )
+        except Exception as e:
+            st.error(f"Failed to read YAML: {e}")
 
-            if uploaded_skill is not None:
-                try:
-                    text = uploaded_skill.read().decode("utf-8")
-                    st.session_state["skill_md"] = text
-                    st.success("SKILL.md uploaded.")
-                except Exception as e:
-                    st.error(f"Failed to read SKILL.md: {e}")
+
+def render_agent_editor(yaml_text: str) -> None:
+    """Edit the agent picked in the Run tab as its own YAML item, spliced back into the file."""
+    ss = st.session_state
+    agent_id = ss.get("selected_agent_id")
+    spans = session_memo("agent_spans", yaml_text, agent_spans)
+    with st.expander(f"Edit one agent: {agent_id}", expanded=len(yaml_text) > AGENT_FULL_EDITOR_MAX_CHARS):
+        if spans is None:
+            st.caption("Single-agent editing needs the canonical 'agents:' list layout; edit the whole file instead.")
+            return
+        if agent_id not in spans:
+            st.caption("Pick an agent in the Run tab to edit it here.")
+            return
+        start, end = spans[agent_id]
+        st.caption("Choose the agent in the Run tab. Only this item is re-checked and replaced.")
+        chunk = st.text_area(f"YAML for {agent_id}", value=yaml_text[start:end].rstrip(), height=240)
+        if st.button("Apply agent", key="apply_agent_chunk"):
+            pos = agent_index(ss["agents"]).positions.get(agent_id)
+            text, agents, errors = replace_agent(yaml_text, ss["agents"], agent_id, chunk, spans)
+            if errors:
+                st.error("\n".join(errors[:20]))
+                return
+            ss["yaml_text"], ss["agents"] = text, agents
+            ss["selected_agent_id"] = agents[pos]["id"]
+            ss["yaml_notice"] = f"Agent '{agent_id}' updated."
+            st.rerun()
+
+
+@isolated_fragment("skill_editor")
+def render_skill_editor(labels: Dict[str, str]) -> None:
+    st.markdown(f"**{labels['skill_title']}**")
+    skill_md = st.text_area(
+        labels["skill_title"],
+        value=st.session_state["skill_md"],
+        height=300,
+    )
+    st.session_state["skill_md"] = skill_md
+
+    col_u2, col_d2 = st.columns(2)
+    with col_u2:
+        uploaded_skill = st.file_uploader(
+            labels["upload_skill"], type=["md", "markdown", "txt"], key="upload_skill"
+        )
+    with col_d2:
+        st.download_button(
+            labels["download_skill"],
+            data=st.session_state["skill_md"],
+            file_name="SKILL.md",
+            mime="text/markdown",
+        )
+
+    if uploaded_skill is not None and st.session_state.get("upload_skill_id") != uploaded_skill.file_id:
+        st.session_state["upload_skill_id"] = uploaded_skill.file_id
+        try:
+            text = uploaded_skill.read().decode("utf-8")
+            st.session_state["skill_md"] = text
+            st.success("SKILL.md uploaded.")
+        except Exception as e:
+            st.error(f"Failed to read SKILL.md: {e}")
+
+
+@isolated_fragment("summary_editor")
+def render_summary_editor(labels: Dict[str, str]) -> None:
+    """Edit doc_summary in place; long summaries are edited one page at a time."""
+    summary = st.session_state.get("doc_summary", "")
+    st.markdown(f"**{labels['summary']}**")
+    if summary:
+        if len(summary) <= OUTPUT_PAGE_CHARS:
+            # Editable area
+            new_summary = st.text_area(
+                labels["summary"],
+                value=summary,
+                height=260,
+                key="summary_edit",
+            )
+        else:
+            st.caption(f"{len(summary):,} characters · ~{estimate_tokens(summary):,} tokens")
+            page, start, end = output_page("summary", summary)
+            # Unkeyed, so the widget follows the page and any restored summary.
+            edited = st.text_area(f"{labels['summary']} (page {page})", value=summary[start:end], height=260)
+            new_summary = summary[:start] + edited + summary[end:]
+        st.session_state["doc_summary"] = new_summary
+
+        col_d1, col_d2 = st.columns(2)
+        with col_d1:
+            download_on_demand(
+                labels["download_md"],
+                "summary_md",
+                new_summary,
+                lambda text: text,
+                file_name="summary.md",
+                mime="text/markdown",
+            )
+        with col_d2:
+            download_on_demand(
+                labels["download_txt"],
+                "summary_txt",
+                new_summary,
+                lambda text: text,
+                file_name="summary.txt",
+                mime="text/plain",
+            )
+    else:
+        st.info("Summary will appear here.")
+
+
+def render_related_summaries() -> None:
+    """Past documents most similar to the last one processed; 'Open' loads a summary."""
+    related = st.session_state.get("doc_related")
+    if not related:
+        return
+    with st.expander(f"Related past summaries ({len(related)})"):
+        for r in related:
+            c1, c2 = st.columns([5, 1])
+            with c1:
+                when = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["ts"]))
+                st.markdown(f"**{r['agent']}** · {r['model']} · {when} · similarity {r['similarity']:.2f}")
+            with c2:
+                if st.button("Open", key=f"related_open_{r['id']}"):
+                    run = run_history().get(r["id"])
+                    if run:
+                        st.session_state["doc_summary"] = run["output"]
+                        st.session_state.pop("summary_edit", None)
+                        st.rerun()
 
 
 def render_doc_intel():
     labels = get_language_labels()
-    apply_wow_theme()
+    with profile_section("apply_wow_theme"):
+        apply_wow_theme()
 
     st.markdown(
         f"<div class='wow-card'><h4>{labels['doc_title']}</h4>"
@@ -1210,93 +6773,222 @@ def render_doc_intel():
     )
     st.write("")
 
-    tabs = st.tabs([labels["paste_tab"], labels["upload_tab"]])
-    doc_text = ""
-    upload_file = None
+    # One form for the document and its options: pasting or tweaking settings
+    # does not rerun the app until "Process" is pressed.
+    with st.form("doc_input", border=False):
+        tabs = st.tabs([labels["paste_tab"], labels["upload_tab"]])
 
-    with tabs[0]:
-        doc_text = st.text_area(
-            labels["paste_tab"],
-            placeholder=labels["paste_placeholder"],
-            height=260,
-        )
+        with tabs[0]:
+            doc_text = st.text_area(
+                labels["paste_tab"],
+                placeholder=labels["paste_placeholder"],
+                height=260,
+            )
 
-    with tabs[1]:
-        st.markdown(labels["upload_prompt"])
-        upload_file = st.file_uploader(
-            labels["upload_tab"], type=["txt", "md", "pdf"], key="doc_file"
+        with tabs[1]:
+            st.markdown(labels["upload_prompt"])
+            upload_files = st.file_uploader(
+                labels["upload_tab"], type=["txt", "md", "pdf"], key="doc_file", accept_multiple_files=True
+            ) or []
+
+        opt_model, opt_font, opt_structured = st.columns(3)
+        with opt_model:
+            model_choices = [AUTO_MODEL] + model_options()
+            model = st.selectbox(
+                "Model",
+                options=model_choices,
+                index=model_choices.index(st.session_state["agent_model"])
+                if st.session_state["agent_model"] in model_choices
+                else 3,
+            )
+        with opt_font:
+            font_size = st.slider(labels["font_size"], min_value=11, max_value=20, value=13)
+        with opt_structured:
+            st.session_state["doc_structured"] = st.checkbox(
+                "Stream structured sections",
+                value=st.session_state["doc_structured"],
+                help="Render Overview, Key points, Risks and Next steps as each section completes.",
+            )
+        st.session_state["doc_reuse_similar"] = st.checkbox(
+            "Reuse the summary of a near-identical past document",
+            value=st.session_state["doc_reuse_similar"],
+            help=f"Skip the model call when a summarized document is at least {SIMILARITY_REUSE_MIN:.0%} similar.",
         )
 
+        process_clicked = st.form_submit_button(labels["process_doc"])
+
     col_left, col_right = st.columns([1, 1])
 
     with col_left:
-        model = st.selectbox(
-            "Model",
-            options=MODEL_OPTIONS,
-            index=MODEL_OPTIONS.index(st.session_state["agent_model"])
-            if st.session_state["agent_model"] in MODEL_OPTIONS
-            else 2,
-        )
-        font_size = st.slider(labels["font_size"], min_value=11, max_value=20, value=13)
-
-        if st.button(labels["process_doc"]):
+        if process_clicked and len(upload_files) > 1:
+            process_clicked = False
+            results = [{"file": f.name, "status": "queued"} for f in upload_files]
+            st.session_state["doc_batch"] = results
+            progress = st.progress(0.0)
+            table = st.empty()
+            table.dataframe(batch_rows(results), use_container_width=True, hide_index=True)
+            files = [(f.name, f.getvalue(), f.type) for f in upload_files]
+            finished = 0
+            stop_slot = st.empty()
+            stop_slot.button("⏹ Stop", key="batch_stop")
+            try:
+                with usage_scope(agent="doc-intel"):
+                    for index, update in run_document_batch(files, model=model):
+                        if index is None:
+                            progress.progress(finished / len(results))
+                            continue
+                        results[index].update(update)
+                        if update["status"] in ("done", "error"):
+                            finished += 1
+                            progress.progress(finished / len(results))
+                        table.dataframe(batch_rows(results), use_container_width=True, hide_index=True)
+            except BaseException:
+                # Finished summaries stay in doc_batch; the rest are marked as stopped.
+                for r in results:
+                    if r.get("status") not in ("done", "error"):
+                        r["status"] = "stopped"
+                raise
+            stop_slot.empty()
+            table.empty()
+
+        upload_file = upload_files[0] if len(upload_files) == 1 else None
+        if process_clicked:
             text = doc_text.strip()
             if upload_file is not None:
-                if upload_file.type in ("text/plain", "text/markdown"):
-                    text = upload_file.read().decode("utf-8")
-                elif upload_file.type == "application/pdf":
-                    try:
-                        from pypdf import PdfReader
-
-                        reader = PdfReader(upload_file)
-                        pages = [p.extract_text() or "" for p in reader.pages]
-                        text = "\n\n".join(pages)
-                    except Exception as e:
-                        st.error(f"Could not extract text from PDF: {e}")
-                        text = ""
-                else:
-                    st.warning("Unsupported file type; please use txt/md/pdf.")
-
+                try:
+                    clean_report: Dict[str, Any] = {}
+                    text = extract_document_text(
+                        upload_file.name, upload_file.getvalue(), upload_file.type, report=clean_report
+                    )
+                    if clean_report:
+                        st.caption(
+                            f"🧹 Preprocessing: ~{clean_report['tokens_before']:,} → "
+                            f"~{clean_report['tokens_after']:,} tokens "
+                            f"(−{clean_report['tokens_saved_pct']}%); "
+                            f"{clean_report['stripped_lines']} header/footer line(s) and "
+                            f"{clean_report['dropped_pages']} empty page(s) removed."
+                        )
+                except ValueError as e:
+                    st.warning(str(e))
+                except Exception as e:
+                    st.error(f"Could not extract text from PDF: {e}")
+                    text = ""
+
+            related = related_runs(text) if text else []
+            st.session_state["doc_related"] = [
+                {k: r[k] for k in ("id", "ts", "agent", "model", "similarity")} for r in related
+            ]
+            reuse = related[0] if related and related[0]["similarity"] >= SIMILARITY_REUSE_MIN else None
             if not text:
                 st.warning("No content to summarize.")
-            else:
+            elif reuse is not None and st.session_state["doc_reuse_similar"]:
+                st.session_state["doc_summary"] = reuse["output"]
+                st.session_state.pop("summary_edit", None)
+                when = time.strftime("%Y-%m-%d %H:%M", time.localtime(reuse["ts"]))
+                st.info(
+                    f"♻️ Reused the summary of **{reuse['agent']}** ({when}, similarity "
+                    f"{reuse['similarity']:.2f}); no model call was made."
+                )
+            elif st.session_state["doc_structured"]:
+                doc_meta = {}
+                source = getattr(upload_file, "name", "pasted text")
+                with col_right:
+                    stop_slot = st.empty()
+                    live = st.empty()
+                stop_slot.button("⏹ Stop", key="doc_stop")
+                parser = None
                 try:
-                    with st.spinner(labels["process_doc"]):
-                        summary = summarize_document(text, model=model)
+                    with live.container(), usage_scope(agent="doc-intel"):
+                        slots = {title: st.empty() for title in SUMMARY_SECTIONS}
+                        extra = st.empty()
+                        last_paint = 0.0
+                        for parser, finished in stream_structured_summary(text, model=model, meta=doc_meta):
+                            for section in finished:
+                                slot = slots.get(section["title"], extra)
+                                slot.markdown(f"#### ✅ {section['title']}\n\n{section['content']}")
+                            current = parser.current()
+                            if current and time.perf_counter() - last_paint > 0.1:
+                                slot = slots.get(current["title"], extra)
+                                slot.markdown(f"#### ⏳ {current['title']}\n\n{current['content']} ▌")
+                                last_paint = time.perf_counter()
+                    summary = sections_to_markdown(parser.finished, parser.missing())
+                    st.session_state["doc_summary"] = summary
+                    st.session_state.pop("summary_edit", None)
+                    record_run("doc", source, text, summary, doc_meta)
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                except BaseException:
+                    # Stop (or navigating away) interrupts the script mid-stream;
+                    # dropping the generator cancels the provider call. Keep what arrived.
+                    if parser is not None:
+                        sections = list(parser.finished)
+                        current = parser.current()
+                        if current and current["content"].strip():
+                            sections.append(current)
+                        summary = sections_to_markdown(sections, [])
                         st.session_state["doc_summary"] = summary
+                        st.session_state.pop("summary_edit", None)
+                        record_run("doc", source, text, summary, {**doc_meta, "stopped": True})
+                    raise
+                stop_slot.empty()
+                live.empty()
+            else:
+                source = getattr(upload_file, "name", "pasted text")
+                doc_meta: Dict[str, Any] = {}
+
+                def on_stop(partial: str) -> None:
+                    st.session_state["doc_summary"] = partial.strip()
+                    st.session_state.pop("summary_edit", None)
+                    record_run("doc", source, text, partial, {**doc_meta, "stopped": True})
+
+                with col_right:
+                    stop_slot = st.empty()
+                    live = st.empty()
+                stop_slot.button("⏹ Stop", key="doc_stop")
+                try:
+                    with usage_scope(agent="doc-intel"):
+                        summary = run_stoppable(
+                            lambda: summarize_document(text, model=model, meta=doc_meta),
+                            on_progress=lambda partial: live.markdown(
+                                f"{partial} ▌" if partial else f"_{labels['process_doc']}…_"
+                            ),
+                            on_stop=on_stop,
+                        )
+                    st.session_state["doc_summary"] = summary
+                    st.session_state.pop("summary_edit", None)
+                    record_run("doc", source, text, summary, doc_meta)
                 except Exception as e:
                     st.error(f"Error: {e}")
+                stop_slot.empty()
+                live.empty()
 
     with col_right:
-        summary = st.session_state.get("doc_summary", "")
-        st.markdown(f"**{labels['summary']}**")
-        if summary:
-            # Editable area
-            new_summary = st.text_area(
-                labels["summary"],
-                value=summary,
-                height=260,
-                key="summary_edit",
+        render_summary_editor(labels)
+        render_related_summaries()
+
+    batch = st.session_state.get("doc_batch")
+    if batch:
+        done = [r for r in batch if r.get("status") == "done"]
+        st.markdown(f"**Batch results** ({len(done)}/{len(batch)} summarized)")
+        st.dataframe(batch_rows(batch), use_container_width=True, hide_index=True)
+        download_on_demand(
+            "Download all summaries (.zip)",
+            "batch_zip",
+            json.dumps(batch, sort_keys=True, default=str),
+            lambda _: batch_archive(batch),
+            file_name="summaries.zip",
+            mime="application/zip",
+        )
+        if done:
+            # Only the chosen file's summary is rendered.
+            shown = st.selectbox(
+                "Show summary", options=range(len(done)), format_func=lambda i: done[i]["file"], key="batch_shown"
             )
-            st.session_state["doc_summary"] = new_summary
+            if shown is not None and shown < len(done):
+                render_large_output(done[shown]["summary"], f"batch_{shown}")
 
-            col_d1, col_d2 = st.columns(2)
-            with col_d1:
-                st.download_button(
-                    labels["download_md"],
-                    data=new_summary,
-                    file_name="summary.md",
-                    mime="text/markdown",
-                )
-            with col_d2:
-                st.download_button(
-                    labels["download_txt"],
-                    data=new_summary,
-                    file_name="summary.txt",
-                    mime="text/plain",
-                )
-        else:
-            st.info("Summary will appear here.")
+    with st.expander("Run history"):
+        render_run_history("doc", "doc_summary", clear_keys=("summary_edit",))
 
 
 # =========================
@@ -1304,17 +6996,25 @@ def render_doc_intel():
 # =========================
 
 def main():
-    render_sidebar()
-
-    view = st.session_state["view"]
-    if view == "dashboard":
-        render_dashboard()
-    elif view == "agent_studio":
-        render_agent_studio()
-    elif view == "doc_intel":
-        render_doc_intel()
-    else:
-        st.error("Unknown view")
+    if WARMUP_ON_START:
+        server_warm_up()
+    init_session_state()
+    with full_run(), profile_rerun(st.session_state.get("profile_mode", "off"), st.session_state["view"]):
+        with profile_section("sync_session_agents"):
+            sync_session_agents()
+        with profile_section("render_sidebar"):
+            render_sidebar()
+
+        view = st.session_state["view"]
+        with profile_section(f"render_{view}"):
+            if view == "dashboard":
+                render_dashboard()
+            elif view == "agent_studio":
+                render_agent_studio()
+            elif view == "doc_intel":
+                render_doc_intel()
+            else:
+                st.error("Unknown view")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+"""Cold-start benchmark: time-to-first-render and first-call latency, before and after warm-up.
+
+    python bench_cold_start.py [--runs 3] [--models gpt-4o-mini gemini-2.5-flash]
+
+Every sample runs in a fresh interpreter so imports, caches and connection
+pools start cold. Three scenarios are compared:
+
+    cold    nothing is preloaded (WARMUP_ON_START=0); the first user pays for it all
+    second  no warm-up, but an earlier session has already rendered the app
+    warm    the process ran app.warm_up() before the first user arrives
+
+time-to-first-render is one full run of app.py for a new session, driven by
+Streamlit's AppTest. The warm scenario calls app.warm_up() (local steps and
+provider connections) and nothing else, which is what a server does at
+startup. The second scenario renders one session first, without warm-up, and
+is the baseline that shows what the warm-up adds beyond reusing a process.
+
+first-call latency is one short call_llm() per model, made through the same
+code path as the UI. Models whose provider has no key in the environment are
+skipped. Cassettes are switched off so the calls are live.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# Run main() from the imported module so warm_up() and the session share caches
+# (from_file would execute a separate copy of app.py).
+APP_SCRIPT = "import app\napp.main()\n"
+DEFAULT_MODELS = ["gemini-2.5-flash", "gpt-4o-mini", "claude-3-5-sonnet-20241022", "grok-3-mini"]
+
+
+def _child_render(scenario: str) -> Dict[str, Any]:
+    from streamlit.testing.v1 import AppTest
+
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    result: Dict[str, Any] = {}
+    if scenario == "warm":
+        import app
+
+        result["warm_up"] = app.warm_up()
+    elif scenario == "second":
+        AppTest.from_string(APP_SCRIPT, default_timeout=120).run()
+    start = time.perf_counter()
+    at = AppTest.from_string(APP_SCRIPT, default_timeout=120).run()
+    result["first_render_s"] = time.perf_counter() - start
+    result["exceptions"] = [e.value for e in at.exception]
+    return result
+
+
+def _child_call(scenario: str, models: List[str]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    import app
+
+    result: Dict[str, Any] = {"import_s": time.perf_counter() - start}
+    if scenario == "warm":
+        result["warm_up"] = app.warm_up()
+    keys = app.env_api_keys()
+    calls: Dict[str, Any] = {}
+    with app.api_key_scope(keys), app.usage_scope(session_id="bench", agent="bench"):
+        for model in models:
+            if not keys.get(app.detect_provider(model)):
+                continue
+            start = time.perf_counter()
+            try:
+                app.call_llm(prompt="Reply with OK.", system_prompt="", model=model, max_tokens=8)
+                calls[model] = time.perf_counter() - start
+            except Exception as e:
+                calls[model] = f"{type(e).__name__}: {e}"
+    result["first_call_s"] = calls
+    return result
+
+
+def _sample(kind: str, scenario: str, models: List[str]) -> Dict[str, Any]:
+    env = dict(os.environ, WARMUP_ON_START="0", LLM_CASSETTE_MODE="off", HEALTH_PROBE_INTERVAL_S="0")
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", kind, scenario, "--models", *models]
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True, cwd=os.path.dirname(APP_PATH))
+    if out.returncode != 0:
+        raise RuntimeError(f"{kind}/{scenario} sample failed:\n{out.stderr[-2000:]}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _ms(values: List[float]) -> str:
+    if not values:
+        return "n/a"
+    return f"{statistics.median(values) * 1000:8.0f} ms (min {min(values) * 1000:.0f})"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="fresh processes per scenario")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--child", nargs=2, metavar=("KIND", "SCENARIO"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, scenario = args.child
+        result = _child_render(scenario) if kind == "render" else _child_call(scenario, args.models)
+        print(json.dumps(result, default=str))
+        return
+
+    for scenario in ("cold", "second", "warm"):
+        renders = [_sample("render", scenario, args.models) for _ in range(args.runs)]
+        # A second session changes nothing for a direct call, so only renders are sampled.
+        calls = [_sample("call", scenario, args.models) for _ in range(args.runs)] if scenario != "second" else []
+        print(f"[{scenario}]")
+        print(f"  time-to-first-render  {_ms([r['first_render_s'] for r in renders])}")
+        for r in renders:
+            for error in r["exceptions"]:
+                print(f"    script error: {error}")
+        if not calls:
+            continue
+        for model in args.models:
+            values = [c["first_call_s"].get(model) for c in calls]
+            if all(v is None for v in values):
+                print(f"  first call {model:<28} skipped (no key in environment)")
+                continue
+            errors = [v for v in values if isinstance(v, str)]
+            print(f"  first call {model:<28} {_ms([v for v in values if isinstance(v, float)])}")
+            for error in errors[:1]:
+                print(f"    error: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Rerun benchmark: full-script runs vs fragment reruns per UI interaction.
+
+    python bench_reruns.py
+
+Drives app.py with Streamlit's AppTest through three interactions in Agent
+Studio and reports, for each, how many full-script runs ("app") and fragment
+reruns ("fragment:<name>") it cost, read from rerun_profiler().counts() for
+the test session before and after the interaction:
+
+    prompt edit     type into the Run tab prompt (agent_run fragment)
+    yaml edit       change the agents.yaml editor text (yaml_editor fragment)
+    params change   change max tokens and press Apply settings (run settings form)
+
+AppTest itself always reruns the whole script, which is what every interaction
+cost before the fragments were introduced; that is reported as "AppTest". A
+browser instead sends a fragment-scoped rerun when the changed widget lives in
+a fragment, so the "browser" column replays each interaction that way (using
+the fragment id the widget was rendered under) and re-syncs the element tree
+with a full run afterwards, outside the measured window.
+
+No provider calls are made, and cassettes and warm-up are switched off.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Any, Callable, Dict, List, Tuple
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+os.environ.setdefault("LLM_CASSETTE_MODE", "off")
+os.environ.setdefault("HEALTH_PROBE_INTERVAL_S", "0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class _FragmentReplay:
+    """Patch AppTest's script runner to record and replay fragment reruns.
+
+    Every run records which fragment (if any) rendered each widget; while
+    ``target`` is set, runs are requested as fragment-scoped reruns of it,
+    the way the browser requests them.
+    """
+
+    def __init__(self) -> None:
+        from streamlit.testing.v1 import local_script_runner
+
+        self.module = local_script_runner
+        self.rerun_data = local_script_runner.RerunData
+        self.run = local_script_runner.LocalScriptRunner.run
+        self.widget_fragment: Dict[str, str] = {}
+        self.target = ""
+
+    def __enter__(self) -> "_FragmentReplay":
+        replay = self
+
+        def rerun_data(**kwargs):
+            if replay.target:
+                kwargs.update(fragment_id_queue=[replay.target], is_fragment_scoped_rerun=True)
+            return replay.rerun_data(**kwargs)
+
+        def run(runner, *args, **kwargs):
+            tree = replay.run(runner, *args, **kwargs)
+            for msg in runner.forward_msgs():
+                if msg.WhichOneof("type") != "delta" or msg.delta.WhichOneof("type") != "new_element":
+                    continue
+                element = msg.delta.new_element
+                kind = element.WhichOneof("type")
+                widget_id = getattr(getattr(element, kind), "id", "") if kind else ""
+                if widget_id and isinstance(widget_id, str):
+                    replay.widget_fragment[widget_id] = msg.delta.fragment_id
+            return tree
+
+        self.module.RerunData = rerun_data
+        self.module.LocalScriptRunner.run = run
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.module.RerunData = self.rerun_data
+        self.module.LocalScriptRunner.run = self.run
+
+
+def _counts(at) -> Dict[str, int]:
+    import app
+
+    return app.rerun_profiler().counts(at.session_state["session_id"])
+
+
+def _delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+    return {k: after.get(k, 0) - before.get(k, 0) for k in sorted(set(before) | set(after)) if after.get(k, 0) - before.get(k, 0)}
+
+
+def _widget(widgets, label: str):
+    for w in widgets:
+        if w.label == label:
+            return w
+    raise LookupError(f"No widget labelled {label!r}")
+
+
+def _prompt(at):
+    return _widget(at.text_area, "Prompt")
+
+
+def _edit_prompt(at) -> None:
+    _prompt(at).input("Summarize the benchmark in one line.").run()
+
+
+def _yaml(at):
+    return _widget(at.text_area, "agents.yaml")
+
+
+def _edit_yaml(at) -> None:
+    editor = _yaml(at)
+    editor.input(editor.value + "\n# edited by bench_reruns\n").run()
+
+
+def _apply(at):
+    return _widget(at.button, "Apply settings")
+
+
+def _change_params(at) -> None:
+    tokens = _widget(at.number_input, "Max tokens")
+    tokens.set_value(int(tokens.value) + 256)
+    _apply(at).click().run()
+
+
+# (name, widget that triggers the rerun, interaction)
+INTERACTIONS: List[Tuple[str, Callable[[Any], Any], Callable[[Any], None]]] = [
+    ("prompt edit", _prompt, _edit_prompt),
+    ("yaml edit", _yaml, _edit_yaml),
+    ("params change", _apply, _change_params),
+]
+
+
+def _session():
+    from streamlit.testing.v1 import AppTest
+
+    # Run main() from the imported module, so the profiler read below is the
+    # one the script counts into (from_file would execute a separate copy).
+    at = AppTest.from_string("import app\napp.main()\n", default_timeout=120).run()
+    _widget(at.sidebar.radio, "View").set_value("agent_studio").run()
+    return at
+
+
+def _measure(at, interact: Callable[[Any], None]) -> Dict[str, Any]:
+    before = _counts(at)
+    interact(at)
+    after = _counts(at)
+    return {"before": before, "after": after, "delta": _delta(before, after), "exceptions": [e.value for e in at.exception]}
+
+
+def measure() -> List[Dict[str, Any]]:
+    results = []
+    with _FragmentReplay() as replay:
+        apptest, browser = _session(), _session()
+        for name, trigger, interact in INTERACTIONS:
+            row = {"interaction": name, "apptest": _measure(apptest, interact)}
+            fragment = replay.widget_fragment.get(trigger(browser).id, "")
+            replay.target = fragment
+            try:
+                row["browser"] = _measure(browser, interact)
+            finally:
+                replay.target = ""
+            row["fragment_id"] = fragment
+            if fragment:
+                browser.run()
+            results.append(row)
+    return results
+
+
+def _summary(delta: Dict[str, int]) -> str:
+    fragments = {k: v for k, v in delta.items() if k.startswith("fragment:")}
+    return (
+        f"full runs {delta.get('app', 0)}  fragment reruns {sum(fragments.values())}"
+        + (f" ({', '.join(f'{k[9:]} {v}' for k, v in fragments.items())})" if fragments else "")
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", action="store_true", help="print the raw counts as JSON")
+    args = parser.parse_args()
+
+    results = measure()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print(f"{r['interaction']}")
+        for column in ("apptest", "browser"):
+            label = "AppTest" if column == "apptest" else "browser"
+            print(f"    {label:<8} {_summary(r[column]['delta'])}")
+            for error in r[column]["exceptions"]:
+                print(f"        script error: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Prompt-regression evaluation: run a JSONL dataset through two agents.yaml versions and compare.
+
+    python eval_agents.py dataset.jsonl --base HEAD:agents.yaml --candidate agents.yaml --fake
+    python eval_agents.py dataset.jsonl --base old.yaml --candidate agents.yaml --cassettes replay
+
+Each dataset line is a JSON object:
+
+    {"agent": "summarizer", "prompt": "...", "expect_contains": ["..."], "expect_regex": "..."}
+
+"agent" and "prompt" are required; "id" and the expect_* fields are optional.
+A version is a file path or a git object such as HEAD:agents.yaml.
+
+Both versions run concurrently through call_llm(), so routing, budgets,
+scheduling and cassettes behave as in the app. Responses come from:
+
+    --fake             a local fake OpenAI-compatible server, deterministic per
+                       (model, system prompt, prompt); nothing leaves the machine
+    --cassettes MODE   LLM_CASSETTE_MODE for this run: "replay" serves recorded
+                       responses only, "auto" replays and records misses
+
+Per agent and version the report has latency percentiles, token usage,
+output-length distribution and the mean of every score. Scores come from the
+built-in scorers (nonempty, contains, regex) and from --score module:function
+hooks, called as function(row, output) -> float or None (None = not scored).
+
+With any of the --max-* / --min-* gates set, the exit status is 1 when the
+candidate breaks one of them, so the script can gate config changes in CI.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import importlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_MODEL = "gemini-2.5-flash"
+FAKE_WORDS = (
+    "the model summary agent document result section risk value table update plan data "
+    "report review change output prompt token latency quality check note"
+).split()
+
+Scorer = Callable[[Dict[str, Any], str], Optional[float]]
+
+
+# =========================
+# Fake provider
+# =========================
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions with a deterministic, model-dependent reply and latency."""
+
+    protocol_version = "HTTP/1.1"
+    ms_per_token = 2.0
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length") or 0)) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions") or body.get("stream"):
+            self._send(404, {"error": {"message": "the fake provider only serves non-streamed chat completions"}})
+            return
+        model = body.get("model", "")
+        messages = body.get("messages") or []
+        system = "".join(m["content"] for m in messages if m.get("role") == "system")
+        prompt = messages[-1]["content"] if messages else ""
+        text, usage = fake_completion(model, system, prompt, int(body.get("max_tokens") or 1024))
+        # Models get a fixed speed of their own, so a model change shows up in latency.
+        speed = 0.5 + int(hashlib.sha256(model.encode()).hexdigest()[:4], 16) / 0xFFFF
+        time.sleep(0.02 + usage["completion_tokens"] * self.ms_per_token * speed / 1000)
+        self._send(
+            200,
+            {
+                "id": "fake-" + hashlib.sha256(text.encode()).hexdigest()[:12],
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {**usage, "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]},
+            },
+        )
+
+    def _send(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+def fake_completion(model: str, system_prompt: str, prompt: str, max_tokens: int) -> Tuple[str, Dict[str, int]]:
+    """Reply and usage that depend only on the inputs: the first prompt line, then filler words.
+
+    Longer system prompts and prompts give longer replies, capped by max_tokens.
+    """
+    seed = hashlib.sha256("\0".join((model, system_prompt, prompt)).encode("utf-8")).digest()
+    rng = random.Random(seed)
+    first_line = next((line.strip() for line in prompt.splitlines() if line.strip()), "")[:200]
+    budget = min(max_tokens, 20 + (len(system_prompt) + len(prompt)) // 40 + rng.randint(0, 60))
+    words = [rng.choice(FAKE_WORDS) for _ in range(max(1, budget - len(first_line) // 4))]
+    text = (first_line + "\n\n" if first_line else "") + " ".join(words)
+    return text, {"prompt_tokens": (len(system_prompt) + len(prompt)) // 4 + 1, "completion_tokens": len(text) // 4 + 1}
+
+
+def start_fake_provider(ms_per_token: float = 2.0) -> Tuple[ThreadingHTTPServer, str]:
+    """Serve the fake provider on a free local port; returns (server, base_url)."""
+    handler = type("FakeHandler", (_FakeHandler,), {"ms_per_token": ms_per_token})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-provider", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+# =========================
+# Inputs
+# =========================
+
+def read_version(spec: str) -> str:
+    """agents.yaml text from a file path or a git object (e.g. HEAD~1:agents.yaml)."""
+    if os.path.exists(spec):
+        with open(spec, "r", encoding="utf-8") as f:
+            return f.read()
+    out = subprocess.run(["git", "show", spec], capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(f"{spec}: not a file or git object ({out.stderr.strip()})")
+    return out.stdout
+
+
+def load_agents_version(app: Any, spec: str) -> Dict[str, Dict[str, Any]]:
+    agents, issues = app.validate_agents_yaml(read_version(spec))
+    if agents is None or app.has_errors(issues):
+        details = "\n".join(app.format_issue(i) for i in issues[:20])
+        raise SystemExit(f"{spec}: agents.yaml is not valid\n{details}")
+    return {a["id"]: a for a in agents}
+
+
+def load_dataset(path: str) -> List[Dict[str, Any]]:
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if not isinstance(row, dict) or not isinstance(row.get("agent"), str) or not isinstance(row.get("prompt"), str):
+                raise SystemExit(f"{path}:{n}: each line needs string 'agent' and 'prompt' fields")
+            row.setdefault("id", str(n))
+            rows.append(row)
+    return rows
+
+
+# =========================
+# Scoring
+# =========================
+
+def score_nonempty(row: Dict[str, Any], output: str) -> Optional[float]:
+    return 1.0 if output.strip() else 0.0
+
+
+def score_contains(row: Dict[str, Any], output: str) -> Optional[float]:
+    """Share of expect_contains strings found in the output (case-insensitive)."""
+    expected = row.get("expect_contains")
+    if not expected:
+        return None
+    expected = [expected] if isinstance(expected, str) else expected
+    lowered = output.lower()
+    return sum(1 for e in expected if str(e).lower() in lowered) / len(expected)
+
+
+def score_regex(row: Dict[str, Any], output: str) -> Optional[float]:
+    pattern = row.get("expect_regex")
+    if not pattern:
+        return None
+    return 1.0 if re.search(pattern, output) else 0.0
+
+
+BUILTIN_SCORERS: Dict[str, Scorer] = {"nonempty": score_nonempty, "contains": score_contains, "regex": score_regex}
+
+
+def load_scorer(spec: str) -> Tuple[str, Scorer]:
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise SystemExit(f"--score {spec}: expected module:function")
+    return attr, getattr(importlib.import_module(module_name), attr)
+
+
+# =========================
+# Running
+# =========================
+
+def run_case(
+    app: Any,
+    version: str,
+    agent: Optional[Dict[str, Any]],
+    row: Dict[str, Any],
+    keys: Dict[str, str],
+    default_model: str,
+    scorers: Dict[str, Scorer],
+) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"version": version, "id": row["id"], "agent": row["agent"]}
+    if agent is None:
+        result["error"] = "agent not defined in this version"
+        return result
+    meta: Dict[str, Any] = {}
+    with app.api_key_scope(keys), app.usage_scope(session_id="", agent=f"eval:{row['agent']}"):
+        try:
+            output = app.call_llm(
+                prompt=row["prompt"],
+                system_prompt=agent.get("systemPrompt", ""),
+                model=agent.get("model") or default_model,
+                max_tokens=int(agent.get("maxTokens", 4096)),
+                tags=agent.get("tags"),
+                meta=meta,
+            )
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            return result
+    result.update(
+        {
+            "model": meta.get("model"),
+            "latency_s": meta.get("latency_s", 0.0),
+            "input_tokens": meta.get("input_tokens", 0),
+            "output_tokens": meta.get("output_tokens", 0),
+            "cost_usd": meta.get("cost_usd", 0.0),
+            "output_chars": len(output),
+            "output": output,
+            "scores": {name: fn(row, output) for name, fn in scorers.items()},
+        }
+    )
+    return result
+
+
+def agent_changed(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> bool:
+    fields = ("systemPrompt", "model", "maxTokens", "tags")
+    return a is None or b is None or any(a.get(f) != b.get(f) for f in fields)
+
+
+def summarize_results(app: Any, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    ok = [r for r in results if "error" not in r]
+    latency = [r["latency_s"] for r in ok]
+    out_tokens = [r["output_tokens"] for r in ok]
+    scores: Dict[str, List[float]] = {}
+    for r in ok:
+        for name, value in r["scores"].items():
+            if value is not None:
+                scores.setdefault(name, []).append(value)
+    return {
+        "runs": len(results),
+        "errors": len(results) - len(ok),
+        "latency_p50_s": app.percentile(latency, 50),
+        "latency_p95_s": app.percentile(latency, 95),
+        "latency_max_s": max(latency) if latency else None,
+        "input_tokens": sum(r["input_tokens"] for r in ok),
+        "output_tokens": sum(out_tokens),
+        "cost_usd": round(sum(r["cost_usd"] for r in ok), 6),
+        "output_tokens_mean": sum(out_tokens) / len(out_tokens) if out_tokens else None,
+        "output_tokens_p10": app.percentile(out_tokens, 10),
+        "output_tokens_p50": app.percentile(out_tokens, 50),
+        "output_tokens_p90": app.percentile(out_tokens, 90),
+        "output_tokens_max": max(out_tokens) if out_tokens else None,
+        "scores": {name: sum(v) / len(v) for name, v in sorted(scores.items())},
+    }
+
+
+def _relative(base: Optional[float], candidate: Optional[float]) -> Optional[float]:
+    if base is None or candidate is None or base == 0:
+        return None
+    return (candidate - base) / base
+
+
+def gate_failures(agent_id: str, base: Dict[str, Any], cand: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    failures = []
+    if args.max_new_errors is not None and cand["errors"] - base["errors"] > args.max_new_errors:
+        failures.append(f"{agent_id}: {cand['errors']} errors (base {base['errors']})")
+    p95 = _relative(base["latency_p95_s"], cand["latency_p95_s"])
+    if args.max_p95_increase is not None and p95 is not None and p95 > args.max_p95_increase:
+        failures.append(f"{agent_id}: p95 latency +{p95:.0%}")
+    length = _relative(base["output_tokens_mean"], cand["output_tokens_mean"])
+    if args.max_length_change is not None and length is not None and abs(length) > args.max_length_change:
+        failures.append(f"{agent_id}: mean output tokens {length:+.0%}")
+    if args.min_score_delta is not None:
+        for name, value in cand["scores"].items():
+            if name in base["scores"] and value - base["scores"][name] < args.min_score_delta:
+                failures.append(f"{agent_id}: score {name} {value - base['scores'][name]:+.3f}")
+    return failures
+
+
+def _fmt(value: Any) -> str:
+    if value is None:
+        return "–"
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    for agent_id, entry in report["agents"].items():
+        base, cand = entry["base"], entry["candidate"]
+        print(f"\n== {agent_id}{'' if entry['changed'] else ' (unchanged)'}")
+        print(f"  {'metric':<22}{'base':>12}{'candidate':>12}{'change':>10}")
+        for metric in (
+            "runs", "errors", "latency_p50_s", "latency_p95_s", "latency_max_s", "input_tokens", "output_tokens",
+            "cost_usd", "output_tokens_mean", "output_tokens_p10", "output_tokens_p50", "output_tokens_p90",
+            "output_tokens_max",
+        ):
+            change = _relative(base[metric], cand[metric])
+            print(
+                f"  {metric:<22}{_fmt(base[metric]):>12}{_fmt(cand[metric]):>12}"
+                f"{'' if change is None else f'{change:+.0%}':>10}"
+            )
+        for name in sorted(set(base["scores"]) | set(cand["scores"])):
+            b, c = base["scores"].get(name), cand["scores"].get(name)
+            delta = "" if b is None or c is None else f"{c - b:+.3f}"
+            print(f"  {'score:' + name:<22}{_fmt(b):>12}{_fmt(c):>12}{delta:>10}")
+    print(f"\n{report['cases']} cases in {report['elapsed_s']:.1f}s")
+    for failure in report["failures"]:
+        print(f"GATE FAILED: {failure}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dataset", help="JSONL file of {agent, prompt, ...} rows")
+    parser.add_argument("--base", default="HEAD:agents.yaml", help="baseline agents.yaml (path or git object)")
+    parser.add_argument("--candidate", default="agents.yaml", help="candidate agents.yaml (path or git object)")
+    parser.add_argument("--fake", action="store_true", help="answer every model from a local fake provider")
+    parser.add_argument("--fake-ms-per-token", type=float, default=2.0)
+    parser.add_argument("--cassettes", choices=["off", "auto", "replay", "record"], help="LLM_CASSETTE_MODE for this run")
+    parser.add_argument("--cassette-dir", help="LLM_CASSETTE_DIR for this run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="model for agents that do not set one")
+    parser.add_argument("--changed-only", action="store_true", help="skip rows whose agent is the same in both versions")
+    parser.add_argument("--score", action="append", default=[], metavar="MODULE:FUNCTION", help="extra scorer")
+    parser.add_argument("--max-new-errors", type=int, help="gate: extra failed calls allowed per agent")
+    parser.add_argument("--max-p95-increase", type=float, help="gate: e.g. 0.2 = p95 latency may grow 20%%")
+    parser.add_argument("--max-length-change", type=float, help="gate: e.g. 0.3 = mean output tokens within ±30%%")
+    parser.add_argument("--min-score-delta", type=float, help="gate: e.g. -0.05 = mean scores may drop by 0.05")
+    parser.add_argument("--json", help="write the full report, including every output, to this file")
+    args = parser.parse_args()
+
+    # Must be set before app is imported: its settings are read at import time.
+    workdir = tempfile.mkdtemp(prefix="eval-agents-")
+    os.environ.setdefault("SHARED_STATE_BACKEND", "memory")
+    os.environ.setdefault("RUN_HISTORY_DB", os.path.join(workdir, "usage.sqlite3"))
+    os.environ["WARMUP_ON_START"] = "0"
+    os.environ["HEALTH_PROBE_INTERVAL_S"] = "0"
+    os.environ["SCHEDULER_SESSION_CONCURRENCY"] = str(args.concurrency)
+    if args.cassettes:
+        os.environ["LLM_CASSETTE_MODE"] = args.cassettes
+    if args.cassette_dir:
+        os.environ["LLM_CASSETTE_DIR"] = args.cassette_dir
+    if args.fake:
+        _, base_url = start_fake_provider(args.fake_ms_per_token)
+        providers_file = os.path.join(workdir, "providers.yaml")
+        with open(providers_file, "w", encoding="utf-8") as f:
+            # Configured providers match before the built-ins, so "*" takes every model.
+            json.dump({"providers": [{"name": "fake", "api": "openai", "base_url": base_url, "patterns": ["*"]}]}, f)
+        os.environ["PROVIDERS_FILE"] = providers_file
+
+    import app
+
+    versions = {"base": load_agents_version(app, args.base), "candidate": load_agents_version(app, args.candidate)}
+    rows = load_dataset(args.dataset)
+    changed = {
+        agent_id: agent_changed(versions["base"].get(agent_id), versions["candidate"].get(agent_id))
+        for agent_id in {r["agent"] for r in rows}
+    }
+    if args.changed_only:
+        rows = [r for r in rows if changed[r["agent"]]]
+    scorers = dict(BUILTIN_SCORERS)
+    scorers.update(load_scorer(spec) for spec in args.score)
+    keys = app.env_api_keys()
+
+    start = time.perf_counter()
+    results: List[Dict[str, Any]] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = [
+            pool.submit(run_case, app, version, agents.get(row["agent"]), row, keys, args.model, scorers)
+            for row in rows
+            for version, agents in versions.items()
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            results.append(future.result())
+
+    report: Dict[str, Any] = {"cases": len(rows), "elapsed_s": time.perf_counter() - start, "agents": {}, "failures": []}
+    for agent_id in sorted({r["agent"] for r in rows}):
+        entry = {"changed": changed[agent_id]}
+        for version in versions:
+            entry[version] = summarize_results(app, [r for r in results if r["agent"] == agent_id and r["version"] == version])
+        report["agents"][agent_id] = entry
+        report["failures"] += gate_failures(agent_id, entry["base"], entry["candidate"], args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({**report, "results": sorted(results, key=lambda r: (r["agent"], r["id"], r["version"]))}, f, indent=1)
+    sys.exit(1 if report["failures"] else 0)
+
+
+if __name__ == "__main__":
+    main()
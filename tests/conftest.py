@@ -0,0 +1,19 @@
+"""Point app.py at throwaway state before it is imported, and keep it offline."""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = tempfile.mkdtemp(prefix="agents-tests-")
+
+os.environ.update(
+    RUN_HISTORY_DB=os.path.join(STATE_DIR, "run_history.sqlite3"),
+    SHARED_STATE_BACKEND="memory",
+    SIMILARITY_DIR=os.path.join(STATE_DIR, "similarity_index"),
+    AGENTS_YAML_PATH=os.path.join(ROOT, "agents.yaml"),
+    LLM_CASSETTE_MODE="off",
+    WARMUP_ON_START="0",
+    HEALTH_PROBE_INTERVAL_S="0",
+)
+sys.path.insert(0, ROOT)
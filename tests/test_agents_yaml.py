@@ -0,0 +1,64 @@
+import app
+
+AGENT = """  - id: writer
+    name: Writer
+    description: Writes
+    model: gpt-4o-mini
+    maxTokens: 512
+    temperature: 0.3
+    systemPrompt: Write.
+    tags: [a]
+"""
+
+
+def test_valid_yaml_has_no_issues():
+    agents, issues = app.validate_agents_yaml("agents:\n" + AGENT)
+    assert issues == []
+    assert agents[0]["id"] == "writer" and agents[0]["maxTokens"] == 512
+
+
+def test_issues_point_at_the_offending_line():
+    agents, issues = app.validate_agents_yaml("agents:\n" + AGENT.replace("maxTokens: 512", "maxTokens: lots"))
+    assert [(i["line"], i["agent_id"], i["severity"]) for i in issues] == [(6, "writer", "error")]
+    assert "maxTokens" in issues[0]["message"]
+
+
+def test_duplicate_ids_and_syntax_errors_are_reported():
+    _, issues = app.validate_agents_yaml("agents:\n" + AGENT + AGENT)
+    assert [i["line"] for i in issues] == [10]
+    assert "duplicate id 'writer'" in issues[0]["message"]
+
+    agents, issues = app.validate_agents_yaml("agents: [\n")
+    assert agents is None
+    assert issues[0]["message"].startswith("YAML syntax error")
+
+
+def test_local_repair_renames_aliases_and_coerces_types():
+    messy = 'agents:\n  - ID: writer\n    title: Writer\n    llm: gpt-4o-mini\n    tokens: "512"\n    systemPrompt: Write.\n'
+    repaired, report = app.repair_agents_yaml(messy)
+    agents, issues = app.validate_agents_yaml(repaired)
+    assert not [i for i in issues if i["severity"] == "error"]
+    assert agents[0]["name"] == "Writer" and agents[0]["maxTokens"] == 512
+    assert "renamed 'llm' to 'model'" in report["local_fixes"]
+    assert report["llm_fragments"] == 0 and report["unresolved"] == []
+
+
+def test_unfixable_fragments_are_kept_as_comments_without_a_model():
+    repaired, report = app.repair_agents_yaml("agents:\n  - id: [unclosed\n")
+    assert "# UNREPAIRED:" in repaired and "#   - id: [unclosed" in repaired
+    assert report["unresolved"] == ["  - id: [unclosed\n"]
+
+
+def test_only_unfixable_fragments_go_to_the_model(monkeypatch):
+    sent = []
+
+    def fake_ai_repair(fragment, model):
+        sent.append(fragment)
+        return "agents:\n" + AGENT.replace("writer", "fixed")
+
+    monkeypatch.setattr(app, "ai_repair_yaml", fake_ai_repair)
+    repaired, report = app.repair_agents_yaml("agents:\n" + AGENT + "  - id: [unclosed\n", model="gpt-4o-mini")
+    agents, _ = app.validate_agents_yaml(repaired)
+    assert [a["id"] for a in agents] == ["writer", "fixed"]
+    assert sent == ["  - id: [unclosed\n"]
+    assert report["llm_fragments"] == 1
@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import api
+import app as core
+
+
+def fake_stream(chunks, calls=None):
+    """A stand-in for app.astream_llm that streams chunks and records its arguments."""
+
+    async def stream_fn(prompt, system_prompt, model, max_tokens, meta, tags=None):
+        if calls is not None:
+            calls.append({"prompt": prompt, "model": model, "max_tokens": max_tokens})
+        meta.update(model=model, provider="fake")
+        for chunk in chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+    return stream_fn
+
+
+def request(asgi, method, path, body=None):
+    """Drive one ASGI HTTP request; returns (status, headers, body bytes)."""
+    payload = body if isinstance(body, bytes) else json.dumps(body).encode() if body is not None else b""
+    sent = []
+
+    async def run():
+        delivered = asyncio.Event()
+
+        async def receive():
+            if not delivered.is_set():
+                delivered.set()
+                return {"type": "http.request", "body": payload, "more_body": False}
+            await asyncio.Event().wait()  # the client stays connected
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "headers": []}
+        await asgi(scope, receive, send)
+
+    asyncio.run(run())
+    start = sent[0]
+    return start["status"], dict(start["headers"]), b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def parse_sse(body):
+    events = []
+    for block in body.decode("utf-8").split("\n\n"):
+        if not block.strip():
+            continue
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def first_agent_id():
+    return core.agent_registry().refresh().agents[0]["id"]
+
+
+def test_health_and_agents():
+    asgi = api.create_app(stream_fn=fake_stream([]))
+    status, _, body = request(asgi, "GET", "/health")
+    assert status == 200 and json.loads(body)["status"] == "ok"
+    status, _, body = request(asgi, "GET", "/agents")
+    assert status == 200
+    assert first_agent_id() in [a["id"] for a in json.loads(body)["agents"]]
+
+
+def test_run_agent_json():
+    calls = []
+    asgi = api.create_app(stream_fn=fake_stream(["Hello", ", ", "world"], calls))
+    status, headers, body = request(
+        asgi, "POST", f"/agents/{first_agent_id()}/run", {"prompt": "Hi", "model": "gpt-4o-mini", "max_tokens": 64}
+    )
+    assert status == 200 and headers[b"content-type"] == b"application/json"
+    result = json.loads(body)
+    assert result["output"] == "Hello, world"
+    assert result["meta"]["model"] == "gpt-4o-mini"
+    assert calls == [{"prompt": "Hi", "model": "gpt-4o-mini", "max_tokens": 64}]
+
+
+def test_run_agent_sse():
+    asgi = api.create_app(stream_fn=fake_stream(["a", "b"]))
+    status, headers, body = request(asgi, "POST", f"/agents/{first_agent_id()}/run", {"prompt": "Hi", "stream": True})
+    assert status == 200 and headers[b"content-type"] == b"text/event-stream"
+    events = parse_sse(body)
+    assert events[:2] == [("delta", {"text": "a"}), ("delta", {"text": "b"})]
+    assert events[-1][0] == "done" and events[-1][1]["output"] == "ab"
+
+
+def test_run_agent_validation():
+    asgi = api.create_app(stream_fn=fake_stream(["x"]))
+    agent = first_agent_id()
+    assert request(asgi, "POST", "/agents/no-such-agent/run", {"prompt": "Hi"})[0] == 404
+    assert request(asgi, "POST", f"/agents/{agent}/run", {"prompt": ""})[0] == 400
+    assert request(asgi, "POST", f"/agents/{agent}/run", {"prompt": "Hi", "model": 5})[0] == 400
+    assert request(asgi, "POST", f"/agents/{agent}/run", {"prompt": "Hi", "max_tokens": 0})[0] == 400
+    assert request(asgi, "POST", f"/agents/{agent}/run", b"{not json")[0] == 400
+    assert request(asgi, "GET", f"/agents/{agent}/run")[0] == 405
+    assert request(asgi, "GET", "/nowhere")[0] == 404
+
+
+def test_summarize_streams_sections_and_records_a_doc_run():
+    summary = "## Overview\nShort.\n## Key points\n- one\n## Risks\nNone.\n## Next steps\nShip it.\n"
+    chunks = [summary[i:i + 5] for i in range(0, len(summary), 5)]
+    asgi = api.create_app(stream_fn=fake_stream(chunks))
+    before = core.run_history().count("doc")
+    status, _, body = request(asgi, "POST", "/summarize", {"text": "A document.", "stream": True})
+    assert status == 200
+    events = parse_sse(body)
+    sections = [data["title"] for event, data in events if event == "section"]
+    assert sections == ["Overview", "Key points", "Risks or caveats", "Suggested next steps"]
+    assert events[-1][0] == "done" and events[-1][1]["missing"] == []
+    assert core.run_history().count("doc") == before + 1
+
+
+def test_stream_errors_become_error_events():
+    async def failing(**kwargs):
+        yield "partial"
+        raise RuntimeError("provider went away")
+
+    asgi = api.create_app(stream_fn=failing)
+    status, _, body = request(asgi, "POST", f"/agents/{first_agent_id()}/run", {"prompt": "Hi", "stream": True})
+    events = parse_sse(body)
+    assert status == 200
+    assert events[0] == ("delta", {"text": "partial"})
+    assert events[-1] == ("error", {"detail": "RuntimeError: provider went away"})
+
+
+def test_repair_yaml_uses_repair_fn():
+    seen = []
+
+    def repair_fn(text, model):
+        seen.append((text, model))
+        return "agents: []\n", {"local_fixes": []}
+
+    asgi = api.create_app(stream_fn=fake_stream([]), repair_fn=repair_fn)
+    status, _, body = request(asgi, "POST", "/repair-yaml", {"yaml": "agents: [", "model": "gpt-4o-mini"})
+    assert status == 200 and json.loads(body) == {"yaml": "agents: []\n", "report": {"local_fixes": []}}
+    assert seen == [("agents: [", "gpt-4o-mini")]
+    assert request(asgi, "POST", "/repair-yaml", {"yaml": "x", "model": ["a"]})[0] == 400
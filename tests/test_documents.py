@@ -0,0 +1,81 @@
+import csv
+import io
+import zipfile
+
+import app
+
+
+def test_summary_parser_handles_headings_split_across_chunks():
+    text = (
+        "## Overview\nA short report.\n\n**Key points:**\n- one\n- two\n"
+        "### Risks\nNone known.\n## Next steps\nShip it."
+    )
+    for size in (1, 2, 7):
+        parser = app.SummarySectionParser()
+        sections = []
+        for i in range(0, len(text), size):
+            sections += parser.feed(text[i:i + size])
+        sections += parser.finish()
+        assert [s["title"] for s in sections] == list(app.SUMMARY_SECTIONS)
+        assert sections[1]["content"] == "- one\n- two"
+        assert sections[-1]["content"] == "Ship it."
+        assert parser.missing() == []
+
+
+def test_summary_parser_reports_missing_sections_and_unstructured_text():
+    parser = app.SummarySectionParser()
+    parser.feed("## Overview\nOnly this.\n")
+    parser.finish()
+    assert parser.missing() == ["Key points", "Risks or caveats", "Suggested next steps"]
+
+    parser = app.SummarySectionParser()
+    parser.feed("Just a paragraph\nwith two lines")
+    assert parser.finish() == [{"title": "Summary", "content": "Just a paragraph\nwith two lines", "unstructured": True}]
+    assert parser.missing() == []
+
+
+def _pages(n):
+    return [
+        f"ACME Quarterly Report\n"
+        f"Findings for region {chr(65 + i)} are described at length in this paragraph of body text.\n"
+        f"Subtotal for page: ${1000 + 37 * i:,}.01\n"
+        f"Printed 2026-03-{10 + i}\n"
+        f"Page {i + 1} of {n}"
+        for i in range(n)
+    ]
+
+
+def test_clean_document_pages_strips_running_headers_and_page_numbers():
+    report = {}
+    out = app.clean_document_pages(_pages(6), report)
+    assert "ACME Quarterly Report" not in out
+    assert "Printed" not in out and "Page 1 of 6" not in out
+    assert "Findings for region A" in out and "Findings for region F" in out
+    assert report["pages"] == 6 and report["stripped_lines"] == 18
+    assert report["tokens_after"] < report["tokens_before"]
+
+
+def test_clean_document_pages_keeps_lines_that_differ_only_in_numbers():
+    out = app.clean_document_pages(_pages(6))
+    for i in range(6):
+        assert f"Subtotal for page: ${1000 + 37 * i:,}.01" in out
+
+
+def test_clean_document_pages_joins_hyphenated_breaks_and_drops_empty_pages():
+    out = app.clean_document_pages(["An exam-\nple of a long enough sentence to keep this page.", " \n\n"])
+    assert out == "An example of a long enough sentence to keep this page."
+
+
+def test_batch_archive_has_one_summary_per_done_file_and_a_csv_index():
+    results = [
+        {"file": "report.pdf", "status": "done", "model": "gpt-4o-mini", "summary": "## Overview\nA"},
+        {"file": "report.txt", "status": "done", "model": "gpt-4o-mini", "summary": "## Overview\nB"},
+        {"file": "broken, \"quoted\".pdf", "status": "error", "error": "Bad PDF, page 3"},
+    ]
+    with zipfile.ZipFile(io.BytesIO(app.batch_archive(results))) as zf:
+        assert sorted(zf.namelist()) == ["index.csv", "report-2.summary.md", "report.summary.md"]
+        assert zf.read("report-2.summary.md").decode() == "## Overview\nB"
+        rows = list(csv.reader(io.StringIO(zf.read("index.csv").decode())))
+    assert rows[0] == ["file", "status", "model", "summary", "error"]
+    assert rows[1] == ["report.pdf", "done", "gpt-4o-mini", "report.summary.md", ""]
+    assert rows[3] == ["broken, \"quoted\".pdf", "error", "", "", "Bad PDF, page 3"]
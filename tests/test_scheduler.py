@@ -0,0 +1,46 @@
+import app
+
+
+def test_sessions_take_turns_within_a_class():
+    scheduler = app.LlmScheduler(max_concurrency=1, session_concurrency=1, interactive_reserve=0)
+    holder = scheduler.submit("batch", "holder")
+    assert holder["granted"].is_set()
+    tickets = [scheduler.submit("batch", s) for s in ("a", "a", "a", "b", "b")]
+    order = []
+    running = holder
+    for _ in tickets:
+        scheduler.release(running)
+        running = next(t for t in tickets if t["granted"].is_set() and not t["released"])
+        order.append(running["session"])
+    assert order == ["a", "b", "a", "b", "a"]
+
+
+def test_interactive_is_granted_before_queued_batch_work():
+    scheduler = app.LlmScheduler(max_concurrency=1, session_concurrency=4, interactive_reserve=0)
+    holder = scheduler.submit("interactive", "x")
+    batch = scheduler.submit("batch", "y")
+    interactive = scheduler.submit("interactive", "z")
+    scheduler.release(holder)
+    assert interactive["granted"].is_set() and not batch["granted"].is_set()
+    scheduler.release(interactive)
+    assert batch["granted"].is_set()
+
+
+def test_batch_never_takes_the_interactive_reserve():
+    scheduler = app.LlmScheduler(max_concurrency=3, session_concurrency=4, interactive_reserve=1)
+    batch = [scheduler.submit("batch", f"s{i}") for i in range(3)]
+    assert [t["granted"].is_set() for t in batch] == [True, True, False]
+    interactive = scheduler.submit("interactive", "user")
+    assert interactive["granted"].is_set()
+    scheduler.release(batch[0])
+    assert batch[2]["granted"].is_set()
+
+
+def test_withdrawn_request_is_never_granted():
+    scheduler = app.LlmScheduler(max_concurrency=1, session_concurrency=1, interactive_reserve=0)
+    holder = scheduler.submit("interactive", "a")
+    waiting = scheduler.submit("interactive", "b")
+    scheduler.release(waiting)
+    scheduler.release(holder)
+    assert not waiting["granted"].is_set()
+    assert scheduler.stats()[0]["running"] == 0
@@ -0,0 +1,49 @@
+import threading
+
+import app
+
+
+def test_reserve_is_atomic_across_threads_and_connections(tmp_path):
+    path = str(tmp_path / "usage.sqlite3")
+    ledgers = [app.UsageLedger(path) for _ in range(4)]
+    results = []
+    start = threading.Barrier(20)
+
+    def reserve(i):
+        start.wait()
+        results.append(ledgers[i % len(ledgers)].reserve(0.1, "session", 1.0, "key", 100.0))
+
+    threads = [threading.Thread(target=reserve, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    held = [r for r in results if r is not None]
+    assert len(held) == 10 and len(set(held)) == 10
+
+
+def test_release_and_settle_free_the_hold(tmp_path):
+    ledger = app.UsageLedger(str(tmp_path / "usage.sqlite3"))
+    first = ledger.reserve(0.6, "s", 1.0, "k", 100.0)
+    assert first is not None
+    assert ledger.reserve(0.6, "s", 1.0, "k", 100.0) is None
+    ledger.release(first)
+    second = ledger.reserve(0.6, "s", 1.0, "k", 100.0)
+    assert second is not None
+    # Settling replaces the hold with the actual cost.
+    ledger.add(
+        {
+            "ts": 0.0, "day": "2026-01-01", "session_id": "s", "agent": "a", "model": "m",
+            "key_hash": "k", "input_tokens": 1, "output_tokens": 1, "cost_usd": 0.2, "exact": True,
+        },
+        reservation=second,
+    )
+    assert ledger.spent(session_id="s") == 0.2
+    assert ledger.reserve(0.7, "s", 1.0, "k", 100.0) is not None
+
+
+def test_key_budget_is_shared_across_sessions(tmp_path):
+    ledger = app.UsageLedger(str(tmp_path / "usage.sqlite3"))
+    assert ledger.reserve(0.5, "one", 10.0, "k", 1.0) is not None
+    assert ledger.reserve(0.6, "two", 10.0, "k", 1.0) is None
+    assert ledger.reserve(0.6, "two", 10.0, "other", 1.0) is not None